@@ -0,0 +1,80 @@
+"""Compare two benchmark results of load.py
+
+Prints the throughput and latency percentiles per endpoint and the ingestion
+lag percentiles of both runs and the change between them. Exits with 1 if any
+of them got worse by more than --threshold percent, so it can gate a commit.
+"""
+import argparse
+import json
+import sys
+
+THRESHOLD_PERCENT = 10
+PERCENTILES = ("p50", "p90", "p99")
+
+
+def metrics(results):
+    """Flatten results to {name: (value, whether higher is better)}"""
+    flat = {}
+    for endpoint, summary in results["requests"].items():
+        flat[f"{endpoint} rps"] = (summary["throughput_rps"], True)
+        for p in PERCENTILES:
+            flat[f"{endpoint} {p} ms"] = (summary["latency_ms"][p], False)
+    lag = results["ingestion_lag_sec"]
+    if lag["count"]:
+        for p in PERCENTILES:
+            flat[f"ingestion lag {p} s"] = (lag[p], False)
+    return flat
+
+
+def compare(old, new, threshold: float):
+    """Print the comparison, return the names of the regressed metrics"""
+    old_metrics, new_metrics = metrics(old), metrics(new)
+    regressions = []
+    print(f"{'':32} {'old':>10} {'new':>10} {'change':>8}")
+    for name, (new_value, higher_is_better) in new_metrics.items():
+        if name not in old_metrics:
+            print(f"{name:32} {'-':>10} {new_value:10.2f}")
+            continue
+        old_value = old_metrics[name][0]
+        change = (new_value - old_value) / old_value * 100 if old_value else 0
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > threshold:
+            regressions.append(name)
+            mark = " !"
+        print(
+            f"{name:32} {old_value:10.2f} {new_value:10.2f} {change:+7.1f}%{mark}"
+        )
+    return regressions
+
+
+def load(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark results")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD_PERCENT,
+        help="Percent a metric may get worse by before it is a regression",
+    )
+    args = parser.parse_args()
+
+    old, new = load(args.old), load(args.new)
+    for label, results in (("old", old), ("new", new)):
+        print(
+            f"{label}: {(results['commit'] or 'unknown')[:8]}"
+            + (" (dirty)" if results["dirty"] else "")
+            + f", {results['started_at']}"
+        )
+    if old["config"] != new["config"]:
+        print("Warning: the runs have different configurations")
+    regressions = compare(old, new, args.threshold)
+    if regressions:
+        print(f"Regressions over {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
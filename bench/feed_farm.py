@@ -0,0 +1,194 @@
+"""Synthetic feed server for benchmarks
+
+Serves RSS feeds at /feeds/<n> (n from 0 to the number of feeds), generated on
+the fly, so thousands of feeds cost nothing but CPU. Every feed gets a new
+item every --change-interval seconds, with the feeds shifted in time evenly so
+that the changes are spread out. The guid of an item carries its publishing
+time with sub-second precision, so that clients can measure ingestion lag.
+
+Run standalone with `python3 feed_farm.py`; load.py runs one itself.
+"""
+import argparse
+import email.utils
+import hashlib
+import math
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+PORT = 5100
+FEEDS = 1000
+ITEMS = 20
+ITEM_SIZE = 500
+CHANGE_INTERVAL_SEC = 60
+# How the feeds validate requests: "etag" (ETag, 304 on If-None-Match),
+# "modified" (Last-Modified, 304 on If-Modified-Since), "none" (no validators)
+# or "broken" (an ETag which changes with every response, a common failure)
+VALIDATORS = ("etag", "modified", "none", "broken")
+
+
+def item_published(farm_start: float, feed: int, feeds: int, interval: float, n: int):
+    """Publishing time of item @n of @feed"""
+    return farm_start + interval * (n + feed / feeds)
+
+
+def item_guid(feed: int, n: int, published: float):
+    return f"farm-{feed}-{n}@{published:.3f}"
+
+
+def guid_published(guid: str):
+    """Publishing time of a farm item by its guid, None for other guids"""
+    if not guid or not guid.startswith("farm-") or "@" not in guid:
+        return None
+    return float(guid.rpartition("@")[2])
+
+
+def guid_feed(guid: str):
+    """Feed number of a farm item by its guid"""
+    return int(guid.split("-")[1])
+
+
+class FeedFarm:
+    def __init__(
+        self,
+        feeds: int = FEEDS,
+        items: int = ITEMS,
+        item_size: int = ITEM_SIZE,
+        change_interval_sec: float = CHANGE_INTERVAL_SEC,
+        validators: str = "etag",
+    ):
+        self.feeds = feeds
+        self.items = items
+        self.item_size = item_size
+        self.change_interval_sec = change_interval_sec
+        self.validators = validators
+        self.start_time = time.time()
+        # feed: (latest item number, body, etag, last modified)
+        self.bodies = {}
+        self.stats = {"requests": 0, "not_modified": 0, "not_found": 0, "bytes": 0}
+
+    def latest_item(self, feed: int):
+        if not self.change_interval_sec:
+            return 0
+        return math.floor(
+            (time.time() - self.start_time) / self.change_interval_sec
+            - feed / self.feeds
+        )
+
+    def render(self, feed: int, latest: int):
+        filler = ("lorem ipsum " * (self.item_size // 12 + 1))[: self.item_size]
+        items = []
+        for n in range(latest, latest - self.items, -1):
+            published = item_published(
+                self.start_time, feed, self.feeds, self.change_interval_sec, n
+            )
+            pub_date = email.utils.format_datetime(
+                datetime.fromtimestamp(published, timezone.utc)
+            )
+            items.append(
+                f"""<item>
+<title>Feed {feed} item {n}</title>
+<link>http://farm.local/{feed}/{n}</link>
+<guid isPermaLink="false">{item_guid(feed, n, published)}</guid>
+<pubDate>{pub_date}</pubDate>
+<description>{filler}</description>
+</item>"""
+            )
+        body = f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel>
+<title>Farm feed {feed}</title>
+<link>http://farm.local/{feed}</link>
+<description>Synthetic feed {feed}</description>
+{"".join(items)}
+</channel></rss>
+""".encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        modified = email.utils.format_datetime(
+            datetime.fromtimestamp(
+                item_published(
+                    self.start_time, feed, self.feeds, self.change_interval_sec, latest
+                ),
+                timezone.utc,
+            ),
+            usegmt=True,
+        )
+        return body, etag, modified
+
+    def feed(self, feed: int):
+        latest = self.latest_item(feed)
+        cached = self.bodies.get(feed)
+        if cached is None or cached[0] != latest:
+            cached = (latest, *self.render(feed, latest))
+            self.bodies[feed] = cached
+        return cached[1:]
+
+    async def handle(self, request):
+        self.stats["requests"] += 1
+        feed = int(request.match_info["feed"])
+        if not 0 <= feed < self.feeds:
+            self.stats["not_found"] += 1
+            raise web.HTTPNotFound()
+        body, etag, modified = self.feed(feed)
+        headers = {}
+        if self.validators == "etag":
+            headers["ETag"] = etag
+            not_modified = request.headers.get("If-None-Match") == etag
+        elif self.validators == "modified":
+            headers["Last-Modified"] = modified
+            not_modified = request.headers.get("If-Modified-Since") == modified
+        elif self.validators == "broken":
+            headers["ETag"] = f'"{time.time_ns()}"'
+            not_modified = False
+        else:
+            not_modified = False
+        if not_modified:
+            self.stats["not_modified"] += 1
+            return web.Response(status=304, headers=headers)
+        self.stats["bytes"] += len(body)
+        return web.Response(
+            body=body, headers=headers, content_type="application/rss+xml"
+        )
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/feeds/{feed}", self.handle)
+        return app
+
+    async def start(self, port: int = PORT):
+        """Start serving in the running event loop, return the runner to clean up"""
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, port=port).start()
+        return runner
+
+
+def add_arguments(parser):
+    parser.add_argument("--feeds", type=int, default=FEEDS, help="Number of feeds")
+    parser.add_argument(
+        "--items", type=int, default=ITEMS, help="Items in every feed body"
+    )
+    parser.add_argument(
+        "--item-size", type=int, default=ITEM_SIZE, help="Item description bytes"
+    )
+    parser.add_argument(
+        "--change-interval",
+        type=float,
+        default=CHANGE_INTERVAL_SEC,
+        help="Seconds between new items of a feed, 0 for feeds which never change",
+    )
+    parser.add_argument("--validators", choices=VALIDATORS, default="etag")
+
+
+def make_farm(args):
+    return FeedFarm(
+        args.feeds, args.items, args.item_size, args.change_interval, args.validators
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic feed server")
+    add_arguments(parser)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+    web.run_app(make_farm(args).app(), port=args.port, access_log=None)
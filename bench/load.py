@@ -0,0 +1,319 @@
+"""Load generator for the RSS service
+
+Runs a feed farm (see feed_farm.py), makes --users users follow --follows
+random farm feeds each and has them poll /all_items for unread items and mark
+the new ones read, as clients do, for --duration seconds. Reports request
+throughput and latency percentiles per endpoint, and ingestion lag: the time
+from an item being published by the farm to its first appearance in
+/all_items (which includes up to a poll interval of the client).
+The results are saved as JSON, to be compared between commits with
+compare.py.
+
+The service (and the updater) must be running, e.g. with `docker compose up`
+in the top directory; the feeds are followed by the URLs the updater sees the
+farm at (--farm-url).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+
+import feed_farm
+
+SERVICE_URL = "http://localhost:8000"
+FARM_URL = f"http://host.docker.internal:{feed_farm.PORT}"
+USERS = 100
+FOLLOWS = 20
+DURATION_SEC = 60
+POLL_INTERVAL_SEC = 5
+PAGE_SIZE = 100
+# Concurrent requests made while setting up the users
+SETUP_CONCURRENCY = 20
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+    return {
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": values[-1],
+        "mean": statistics.fmean(values),
+    }
+
+
+class Stats:
+    def __init__(self):
+        # endpoint: latencies in ms
+        self.latencies = {}
+        # endpoint: {status: count}
+        self.statuses = {}
+        self.errors = {}
+        # Seconds from publishing to the first appearance of the items
+        self.lags = []
+
+    def request(self, endpoint: str, latency_sec: float, status):
+        self.latencies.setdefault(endpoint, []).append(latency_sec * 1000)
+        statuses = self.statuses.setdefault(endpoint, {})
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def error(self, endpoint: str, error: Exception):
+        name = type(error).__name__
+        errors = self.errors.setdefault(endpoint, {})
+        errors[name] = errors.get(name, 0) + 1
+
+    def summary(self, duration_sec: float):
+        return {
+            endpoint: {
+                "count": len(latencies),
+                "throughput_rps": len(latencies) / duration_sec,
+                "statuses": self.statuses[endpoint],
+                "errors": self.errors.get(endpoint, {}),
+                "latency_ms": percentiles(latencies),
+            }
+            for endpoint, latencies in sorted(self.latencies.items())
+        }
+
+
+class Client:
+    def __init__(self, session, service_url: str, stats: Stats):
+        self.session = session
+        self.service_url = service_url
+        self.stats = stats
+
+    async def call(self, method: str, endpoint: str, headers=None, **params):
+        """Make a request, return the response status, headers and JSON body"""
+        params = {
+            key: str(value).lower() if isinstance(value, bool) else value
+            for key, value in params.items()
+        }
+        start_time = time.monotonic()
+        try:
+            async with self.session.request(
+                method, f"{self.service_url}/{endpoint}", params=params, headers=headers
+            ) as resp:
+                body = await resp.json() if resp.status == 200 else None
+                self.stats.request(endpoint, time.monotonic() - start_time, resp.status)
+                return resp.status, resp.headers, body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.stats.error(endpoint, e)
+            return None, {}, None
+
+
+async def set_up_user(client, username: str, feed_urls):
+    await client.call("POST", "add_user", username=username)
+    for feed_url in feed_urls:
+        await client.call("POST", "follow", username=username, feed_url=feed_url)
+
+
+async def poll_user(client, username: str, feed_urls, args, bench_start, deadline):
+    """Poll unread items of a user and mark them read until @deadline"""
+    seen = set()
+    etag = None
+    # Spread the polls of the users over the poll interval
+    await asyncio.sleep(random.uniform(0, args.poll_interval))
+    while time.monotonic() < deadline:
+        poll_start = time.monotonic()
+        after = None
+        latest = {}
+        while True:
+            params = dict(username=username, unread_only=True, limit=args.page_size)
+            if after:
+                params["after"] = after
+            status, headers, body = await client.call(
+                "GET",
+                "all_items",
+                headers={"If-None-Match": etag} if etag and not after else None,
+                **params,
+            )
+            if status != 200:
+                break
+            if not after:
+                etag = headers.get("ETag")
+            now = time.time()
+            for item in body["items"]:
+                published = feed_farm.guid_published(item["guid"])
+                if published is None or item["id"] in seen:
+                    continue
+                seen.add(item["id"])
+                if published >= bench_start:
+                    client.stats.lags.append(now - published)
+                feed = feed_farm.guid_feed(item["guid"])
+                latest[feed] = max(latest.get(feed, 0), item["id"])
+            after = body["next_cursor"]
+            if not after:
+                break
+        for feed, item_id in latest.items():
+            await client.call(
+                "POST",
+                "mark_read",
+                username=username,
+                feed_url=f"{args.farm_url}/feeds/{feed}",
+                item_id=item_id,
+            )
+        await asyncio.sleep(
+            max(0, args.poll_interval - (time.monotonic() - poll_start))
+        )
+
+
+def git_commit():
+    """Commit the benchmark runs at and whether the tree has changes"""
+
+    def git(*args):
+        return subprocess.run(
+            ["git", *args],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+
+    return git("rev-parse", "HEAD") or None, bool(git("status", "--porcelain"))
+
+
+async def run(args):
+    random.seed(args.seed)
+    farm = feed_farm.make_farm(args)
+    runner = await farm.start(args.farm_port)
+    stats = Stats()
+    run_id = int(time.time())
+    users = {
+        f"bench-{run_id}-{i}": [
+            f"{args.farm_url}/feeds/{feed}"
+            for feed in random.sample(range(args.feeds), min(args.follows, args.feeds))
+        ]
+        for i in range(args.users)
+    }
+    timeout = aiohttp.ClientTimeout(total=30)
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        setup = Client(session, args.service_url, Stats())
+        semaphore = asyncio.Semaphore(SETUP_CONCURRENCY)
+
+        async def set_up(username, feed_urls):
+            async with semaphore:
+                await set_up_user(setup, username, feed_urls)
+
+        setup_start = time.monotonic()
+        await asyncio.gather(*(set_up(u, f) for u, f in users.items()))
+        setup_sec = time.monotonic() - setup_start
+        print(f"Set up {len(users)} users in {setup_sec:.1f}s")
+
+        client = Client(session, args.service_url, stats)
+        bench_start = time.time()
+        start = time.monotonic()
+        deadline = start + args.duration
+        await asyncio.gather(
+            *(
+                poll_user(client, username, feed_urls, args, bench_start, deadline)
+                for username, feed_urls in users.items()
+            )
+        )
+        duration_sec = time.monotonic() - start
+    await runner.cleanup()
+
+    commit, dirty = git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "started_at": datetime.fromtimestamp(bench_start, timezone.utc).isoformat(),
+        "duration_sec": duration_sec,
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "service_url")
+        },
+        "setup": {
+            "duration_sec": setup_sec,
+            "requests": setup.stats.summary(setup_sec),
+        },
+        "requests": stats.summary(duration_sec),
+        "ingestion_lag_sec": {
+            "count": len(stats.lags),
+            **(percentiles(stats.lags) or {}),
+        },
+        "farm": {
+            **farm.stats,
+            "not_modified_ratio": farm.stats["not_modified"]
+            / max(1, farm.stats["requests"]),
+        },
+    }
+
+
+def print_results(results):
+    for endpoint, summary in results["requests"].items():
+        latency = summary["latency_ms"]
+        print(
+            f"{endpoint}: {summary['count']} requests, "
+            f"{summary['throughput_rps']:.1f} rps, "
+            f"p50 {latency['p50']:.1f}ms, p90 {latency['p90']:.1f}ms, "
+            f"p99 {latency['p99']:.1f}ms, statuses {summary['statuses']}"
+            + (f", errors {summary['errors']}" if summary["errors"] else "")
+        )
+    lag = results["ingestion_lag_sec"]
+    if lag["count"]:
+        print(
+            f"ingestion lag: {lag['count']} items, p50 {lag['p50']:.2f}s, "
+            f"p90 {lag['p90']:.2f}s, p99 {lag['p99']:.2f}s, max {lag['max']:.2f}s"
+        )
+    else:
+        print("ingestion lag: no new items seen")
+    farm = results["farm"]
+    print(
+        f"farm: {farm['requests']} requests, "
+        f"{farm['not_modified_ratio']:.0%} not modified"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RSS service load generator")
+    parser.add_argument("--service-url", default=SERVICE_URL)
+    parser.add_argument(
+        "--farm-url",
+        default=FARM_URL,
+        help="URL of the feed farm as seen by the updater",
+    )
+    parser.add_argument("--farm-port", type=int, default=feed_farm.PORT)
+    feed_farm.add_arguments(parser)
+    parser.add_argument("--users", type=int, default=USERS)
+    parser.add_argument(
+        "--follows", type=int, default=FOLLOWS, help="Feeds followed by every user"
+    )
+    parser.add_argument("--duration", type=float, default=DURATION_SEC)
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL_SEC)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument(
+        "--connections", type=int, default=100, help="Connections to the service"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        help="Results file, by default results/<time>-<commit>.json next to this file",
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIR,
+            f"{int(time.time())}-{(results['commit'] or 'unknown')[:8]}.json",
+        )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}")
@@ -0,0 +1,421 @@
+import asyncpg
+import contextlib
+from typing import List, Optional
+
+import cache
+import db as db_handler
+import metrics
+import queries
+
+# asyncpg prepares every statement it runs and keeps the prepared statements
+# in a per-connection LRU cache, so repeated queries skip parsing and planning
+STATEMENT_CACHE_SIZE = 256
+# User and feed ids by name cached by each of the caches
+ID_CACHE_SIZE = 100000
+ID_CACHE_TTL_SEC = 300
+
+
+@metrics.time_db_methods(
+    "async",
+    untimed={
+        "connect",
+        "close",
+        "conn",
+        "fetch",
+        "fetchrow",
+        "fetch_follow",
+        "cache_stats",
+        "cache_ids",
+        "forget_feed",
+    },
+)
+class AsyncDB:
+    """asyncio counterpart of db.DB for the FastAPI service
+
+    Has the same API as db.DB with coroutine methods, backed by an asyncpg
+    connection pool. Raises the exceptions defined in the db module.
+    Feed update scheduling and ingestion (claim_due_feeds, start_updates,
+    put_updates, record_failure) is only done by the updater and stays in the
+    sync db.DB.
+    The pool is created by connect(), which must be awaited from the running
+    event loop before the first query.
+    User and feed ids are cached by name and passed to the queries which take
+    them (see queries.py); @id_cache_backend shares the cached ids between the
+    API replicas.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        user,
+        password,
+        id_cache_size: int = ID_CACHE_SIZE,
+        id_cache_ttl_sec: float = ID_CACHE_TTL_SEC,
+        id_cache_backend=None,
+    ):
+        self.connect_args = dict(
+            host=host,
+            port=int(port),
+            database=db_handler.DBNAME,
+            user=user,
+            password=password,
+        )
+        self.pool = None
+        self.user_ids = cache.IdCache(
+            "users", id_cache_size, id_cache_ttl_sec, id_cache_backend
+        )
+        self.feed_ids = cache.IdCache(
+            "feeds", id_cache_size, id_cache_ttl_sec, id_cache_backend
+        )
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(
+            min_size=db_handler.POOL_MIN_CONNECTIONS,
+            max_size=db_handler.POOL_MAX_CONNECTIONS,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
+            **self.connect_args,
+        )
+        metrics.DB_POOL_CONNECTIONS.labels("async", "max").inc(
+            db_handler.POOL_MAX_CONNECTIONS
+        )
+
+    async def close(self):
+        await self.pool.close()
+        metrics.DB_POOL_CONNECTIONS.labels("async", "max").dec(
+            db_handler.POOL_MAX_CONNECTIONS
+        )
+
+    @contextlib.asynccontextmanager
+    async def conn(self):
+        with metrics.DB_POOL_CHECKOUT_SECONDS.labels("async").time():
+            conn = await self.pool.acquire(
+                timeout=db_handler.POOL_CHECKOUT_TIMEOUT_SEC
+            )
+        in_use = metrics.DB_POOL_CONNECTIONS.labels("async", "in_use")
+        in_use.inc()
+        try:
+            yield conn
+        finally:
+            in_use.dec()
+            await self.pool.release(conn)
+
+    async def fetch(self, query: str, *args):
+        db_handler.run_query_hooks(query)
+        async with self.conn() as conn:
+            return await conn.fetch(query, *args)
+
+    async def fetchrow(self, query: str, *args):
+        db_handler.run_query_hooks(query)
+        async with self.conn() as conn:
+            return await conn.fetchrow(query, *args)
+
+    async def fetch_follow(self, query: str, *args):
+        """Run FOLLOW_FEED or FOLLOW_FEEDS, once more if the followed feed was
+        deleted meanwhile (see db.DB.fetch_follow)
+        """
+        try:
+            return await self.fetch(query, *args)
+        except asyncpg.exceptions.ForeignKeyViolationError:
+            return await self.fetch(query, *args)
+
+    async def stream(self, query: str, *args):
+        """Generate the query result rows through a server-side cursor"""
+        db_handler.run_query_hooks(query)
+        async with self.conn() as conn:
+            async with conn.transaction(readonly=True):
+                async for row in conn.cursor(
+                    query, *args, prefetch=db_handler.STREAM_BATCH_SIZE
+                ):
+                    yield row
+
+    def cache_stats(self):
+        return {"users": self.user_ids.stats, "feeds": self.feed_ids.stats}
+
+    async def cache_ids(self, username: str, user_id, feed_url=None, feed_id=None):
+        """Cache the ids returned by a query, forget the ones not found"""
+        if user_id is None:
+            await self.user_ids.invalidate(username)
+        else:
+            await self.user_ids.put(username, user_id)
+        if feed_url is None:
+            return
+        if feed_id is None:
+            await self.feed_ids.invalidate(feed_url)
+        else:
+            await self.feed_ids.put(feed_url, feed_id)
+
+    async def forget_feed(self, feed_url: str):
+        """Drop the cached id of a feed deleted from the database"""
+        await self.feed_ids.invalidate(feed_url)
+
+    async def add_user(self, username: str):
+        row = await self.fetchrow(queries.INSERT_USER, username)
+        if row is None:
+            raise db_handler.UserAlreadyExists(username)
+        await self.user_ids.put(username, row[0])
+
+    async def follow_feed(self, username: str, url: str):
+        """
+        Return a tuple of whether the feed was not followed beforehand
+        and whether the feed was created
+        """
+        [(user_id, feed_created, new_follow, feed_id)] = await self.fetch_follow(
+            queries.FOLLOW_FEED, username, db_handler.canonical_feed_url(url), url
+        )
+        await self.cache_ids(username, user_id, url, feed_id)
+        if user_id is None:
+            raise db_handler.UserNotFound(username)
+        return new_follow, feed_created
+
+    async def unfollow_feed(self, username: str, feed_url: str):
+        """
+        After this call the feed is no longer followed.
+        Return True if it existed beforehand, False otherwise
+        """
+        user_id, success = await self.fetchrow(
+            queries.UNFOLLOW_FEED, username, feed_url
+        )
+        await self.cache_ids(username, user_id)
+        if user_id is None:
+            raise db_handler.UserNotFound(username)
+        return success
+
+    async def follow_feeds(self, username: str, feed_urls: List[str]):
+        """Follow many feeds at once, as follow_feed for every url
+
+        Return {"followed": [feed_url], "already_followed": [feed_url],
+        "invalid": [feed_url]}
+        """
+        feed_urls, canonical_urls, invalid = db_handler.bulk_feed_urls(feed_urls)
+        rows = await self.fetch_follow(
+            queries.FOLLOW_FEEDS, username, canonical_urls, feed_urls
+        )
+        await self.cache_ids(username, rows[0][0] if rows else None)
+        return db_handler.follow_feeds_result(rows, username, feed_urls, invalid)
+
+    async def unfollow_feeds(self, username: str, feed_urls: List[str]):
+        """Unfollow many feeds at once, as unfollow_feed for every url
+
+        Return {"unfollowed": [feed_url], "not_followed": [feed_url]}
+        """
+        feed_urls, _, invalid = db_handler.bulk_feed_urls(feed_urls)
+        rows = await self.fetch(queries.UNFOLLOW_FEEDS, username, feed_urls)
+        await self.cache_ids(username, rows[0][0] if rows else None)
+        return db_handler.unfollow_feeds_result(rows, username, feed_urls, invalid)
+
+    async def list_feeds(self, username: str, known_version: Optional[str] = None):
+        """Return {"feeds": [feed_url], "version": version of the list}
+
+        The feeds are not listed when the version is still @known_version
+        """
+        rows = await self.fetch(
+            queries.LIST_FEEDS,
+            username,
+            await self.user_ids.get(username),
+            known_version,
+        )
+        await self.cache_ids(username, rows[0][0] if rows else None)
+        feeds = db_handler.feeds_result(rows, username)
+        return {"feeds": feeds, "version": rows[0][1]}
+
+    async def followed_feeds(self, username: str):
+        """Return {feed_url: feed_id} of the followed feeds"""
+        rows = await self.fetch(
+            queries.LIST_FEEDS, username, await self.user_ids.get(username), None
+        )
+        await self.cache_ids(username, rows[0][0] if rows else None)
+        return db_handler.followed_feeds_result(rows, username)
+
+    async def get_feed_last_updated(self, feed_url: str):
+        result = await self.fetchrow(queries.GET_FEED_LAST_UPDATED, feed_url)
+        if result is None:
+            return None
+        return {"etag": result[0], "modified": result[1]}
+
+    async def list_update_chains(self, feed_url: Optional[str] = None):
+        rows = await self.fetch(queries.LIST_UPDATE_CHAINS, feed_url)
+        return db_handler.update_chains_result(rows)
+
+    async def list_all_feeds(self):
+        return [res[0] for res in await self.fetch(queries.LIST_ALL_FEEDS)]
+
+    async def unread_counts(self, username: str):
+        """Return {"feeds": {feed_url: unread items}, "total": unread items}"""
+        rows = await self.fetch(
+            queries.UNREAD_COUNTS, username, await self.user_ids.get(username)
+        )
+        await self.cache_ids(username, rows[0][0] if rows else None)
+        return db_handler.unread_counts_result(rows, username)
+
+    async def get_feed_items(
+        self,
+        username: str,
+        feed_url: str,
+        unread_only: bool,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+        include_content: bool = False,
+        known_version: Optional[str] = None,
+    ):
+        """List items of a followed feed ordered by publishing time
+
+        Returns at most @limit items following the @after page cursor, and the
+        cursor of the next page (None if this page is the last one). The item
+        content is only included when asked for, as it is the bulk of an item.
+        The version of the listing is returned too; the items are not listed
+        when it is still @known_version (of a cached listing).
+        """
+        after_published, after_item_id = db_handler.decode_cursor(after)
+        rows = await self.fetch(
+            queries.GET_FEED_ITEMS,
+            username,
+            feed_url,
+            unread_only,
+            after_published,
+            after_item_id,
+            db_handler.page_size(limit),
+            include_content,
+            await self.user_ids.get(username),
+            await self.feed_ids.get(feed_url),
+            known_version,
+        )
+        if rows:
+            await self.cache_ids(username, rows[0][0], feed_url, rows[0][1])
+        else:
+            await self.cache_ids(username, None, feed_url)
+        return db_handler.feed_items_result(
+            rows, username, feed_url, limit, include_content
+        )
+
+    async def iter_feed_items(
+        self,
+        username: str,
+        feed_url: str,
+        unread_only: bool,
+        after: Optional[str] = None,
+        include_content: bool = False,
+    ):
+        """Stream items of a followed feed through a server-side cursor
+
+        The first value generated is {"failed": bool}, the items follow
+        """
+        after_published, after_item_id = db_handler.decode_cursor(after)
+        rows = self.stream(
+            queries.GET_FEED_ITEMS,
+            username,
+            feed_url,
+            unread_only,
+            after_published,
+            after_item_id,
+            None,
+            include_content,
+            await self.user_ids.get(username),
+            await self.feed_ids.get(feed_url),
+            None,
+        )
+        column = db_handler.FEED_ITEMS_COLUMN
+        async with contextlib.aclosing(rows):
+            first = await anext(rows, None)
+            if first is not None:
+                await self.cache_ids(username, first[0], feed_url, first[1])
+            else:
+                await self.cache_ids(username, None, feed_url)
+            db_handler.check_feed_items_row(first, username, feed_url)
+            yield {"failed": first[2]}
+            if first[column] is not None:
+                yield db_handler.make_item(first[column:], include_content)
+                async for row in rows:
+                    yield db_handler.make_item(row[column:], include_content)
+
+    async def get_all_items(
+        self,
+        username: str,
+        unread_only: bool,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+        include_content: bool = False,
+        known_version: Optional[str] = None,
+    ):
+        """List items of all followed feeds ordered by publishing time
+
+        Paginated and versioned the same way as get_feed_items
+        """
+        after_published, after_item_id = db_handler.decode_cursor(after)
+        rows = await self.fetch(
+            queries.GET_ALL_ITEMS,
+            username,
+            unread_only,
+            after_published,
+            after_item_id,
+            db_handler.page_size(limit),
+            include_content,
+            await self.user_ids.get(username),
+            known_version,
+        )
+        await self.cache_ids(username, rows[0][0] if rows else None)
+        return db_handler.all_items_result(rows, username, limit, include_content)
+
+    async def iter_all_items(
+        self,
+        username: str,
+        unread_only: bool,
+        after: Optional[str] = None,
+        include_content: bool = False,
+    ):
+        """Stream items of all followed feeds through a server-side cursor
+
+        The first value generated is {"failed": [failed_feed_url]}, the items follow
+        """
+        after_published, after_item_id = db_handler.decode_cursor(after)
+        rows = self.stream(
+            queries.GET_ALL_ITEMS,
+            username,
+            unread_only,
+            after_published,
+            after_item_id,
+            None,
+            include_content,
+            await self.user_ids.get(username),
+            None,
+        )
+        column = db_handler.ALL_ITEMS_COLUMN
+        async with contextlib.aclosing(rows):
+            first = await anext(rows, None)
+            await self.cache_ids(username, first[0] if first else None)
+            if first is None:
+                raise db_handler.UserNotFound(username)
+            yield {"failed": list(first[1])}
+            if first[column] is not None:
+                yield db_handler.make_item(first[column:], include_content)
+                async for row in rows:
+                    yield db_handler.make_item(row[column:], include_content)
+
+    async def mark_as_read(self, username: str, feed_url: str, item_id: int):
+        row = await self.fetchrow(
+            queries.MARK_AS_READ,
+            username,
+            feed_url,
+            item_id,
+            await self.user_ids.get(username),
+            await self.feed_ids.get(feed_url),
+        )
+        await self.cache_ids(username, row[0], feed_url, row[1])
+        db_handler.check_mark_as_read_result(row, username, feed_url)
+
+    async def mark_as_read_batch(self, marks):
+        rows = await self.fetch(
+            queries.MARK_AS_READ_BATCH, *db_handler.mark_as_read_batch_args(marks)
+        )
+        for username, feed_url, user_id, feed_id in rows:
+            await self.cache_ids(username, user_id, feed_url, feed_id)
+        return db_handler.mark_as_read_batch_result(rows)
+
+    async def request_feed_update(self, feed_url: str):
+        """Reset the failed state of a feed, return True if it was failed"""
+        feed_id, was_failed = await self.fetchrow(
+            queries.REQUEST_FEED_UPDATE, feed_url
+        )
+        if feed_id is None:
+            raise db_handler.FeedNotFound(feed_url)
+        return was_failed
@@ -0,0 +1,185 @@
+import collections
+import threading
+import time
+from typing import Optional
+
+
+class LRUCache:
+    """Thread-safe mapping keeping the @max_size most recently used keys
+
+    With @ttl_sec, keys also expire that long after they are put. With
+    @max_bytes, the least recently used keys are also evicted while the total
+    size of the values (as given to put()) is larger than that.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl_sec: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        # key: (value, expiry time or None, size)
+        self.items = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        """Remove a cached key, return its value; the lock must be held"""
+        value, _, size = self.items.pop(key)
+        self.total_bytes -= size
+        return value
+
+    def _alive(self, key):
+        """Whether the key is cached and not expired; the lock must be held"""
+        if key not in self.items:
+            return False
+        expires_at = self.items[key][1]
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            return False
+        return True
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._alive(key)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if not self._alive(key):
+                return default
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, value, size: int = 0):
+        """Cache @value, of @size bytes (counted against @max_bytes)"""
+        expires_at = None
+        if self.ttl_sec is not None:
+            expires_at = time.monotonic() + self.ttl_sec
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+            self.items[key] = (value, expires_at, size)
+            self.total_bytes += size
+            while len(self.items) > self.max_size or (
+                self.max_bytes is not None and self.total_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self.items)))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if not self._alive(key):
+                return default
+            return self._remove(key)
+
+
+class MemoryBackend:
+    """Shared cache backend kept in memory
+
+    Stands in for a shared backend (e.g. in tests, or with a single API
+    replica): caches sharing an instance see each other's entries
+    """
+
+    def __init__(self, max_size: int = 1_000_000):
+        self.items = LRUCache(max_size)
+
+    async def get(self, key: str):
+        value, expires_at = self.items.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return value
+
+    async def set(self, key: str, value: int, ttl_sec: float):
+        self.items.put(key, (value, time.time() + ttl_sec))
+
+    async def delete(self, key: str):
+        self.items.pop(key)
+
+
+class RedisBackend:
+    """Cache backend shared by the API replicas through redis
+
+    redis is an optional dependency, imported only when this backend is used
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio
+
+        self.redis = redis.asyncio.from_url(url)
+
+    async def get(self, key: str):
+        value = await self.redis.get(key)
+        return None if value is None else int(value)
+
+    async def set(self, key: str, value: int, ttl_sec: float):
+        await self.redis.set(key, value, px=int(ttl_sec * 1000))
+
+    async def delete(self, key: str):
+        await self.redis.delete(key)
+
+
+def make_backend(url: Optional[str]):
+    """Shared cache backend by url: redis://... or memory://, None for no backend"""
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    return RedisBackend(url)
+
+
+class IdCache:
+    """Read-through cache of ids by name (usernames, feed urls)
+
+    Ids are looked up in the in-process LRU first, then in the shared
+    @backend if any. Names are mapped to ids by the queries themselves, which
+    put the ids they return into the cache. Counts hits and misses.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size: int,
+        ttl_sec: float,
+        backend=None,
+    ):
+        self.name = name
+        self.ttl_sec = ttl_sec
+        self.local = LRUCache(max_size, ttl_sec)
+        self.backend = backend
+        self.stats = {"hits": 0, "backend_hits": 0, "misses": 0}
+
+    def backend_key(self, key: str):
+        return f"rss:{self.name}:{key}"
+
+    async def get(self, key: str):
+        """Return the cached id, None on a miss"""
+        value = self.local.get(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+        if self.backend is not None:
+            value = await self.backend.get(self.backend_key(key))
+            if value is not None:
+                self.stats["backend_hits"] += 1
+                self.local.put(key, value)
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, value: Optional[int]):
+        if value is None or self.local.get(key) == value:
+            return
+        self.local.put(key, value)
+        if self.backend is not None:
+            await self.backend.set(self.backend_key(key), value, self.ttl_sec)
+
+    async def invalidate(self, key: str):
+        self.local.pop(key)
+        if self.backend is not None:
+            await self.backend.delete(self.backend_key(key))
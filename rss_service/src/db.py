@@ -1,15 +1,53 @@
 import psycopg2
-from psycopg2 import pool
-from psycopg2.extras import execute_values
+import base64
+import functools
+import io
+import itertools
+import json
 import logging
-from dataclasses import dataclass
-from typing import List, Optional
+import os
+import re
+import urllib.parse
+import zlib
+from typing import List, Optional, Sequence, Set
+
+import db_pool
+import metrics
+import migrations
+import queries
 
 DBNAME = "rss_db"
-POOL_MIN_CONNECTIONS = 1
-POOL_MAX_CONNECTIONS = 10
+# Connections of a pool (of every DB and AsyncDB)
+POOL_MIN_CONNECTIONS = int(os.environ.get("DB_POOL_MIN_CONNECTIONS", 1))
+POOL_MAX_CONNECTIONS = int(os.environ.get("DB_POOL_MAX_CONNECTIONS", 10))
+# How long to wait for a connection when all of them are in use, before
+# failing with db_pool.PoolTimeout
+POOL_CHECKOUT_TIMEOUT_SEC = float(
+    os.environ.get("DB_POOL_CHECKOUT_TIMEOUT_SEC", 10)
+)
+# Connections are reopened after this long, and checked with a query before
+# reuse when idle for this long
+POOL_MAX_LIFETIME_SEC = float(os.environ.get("DB_POOL_MAX_LIFETIME_SEC", 3600))
+POOL_VALIDATE_IDLE_SEC = float(os.environ.get("DB_POOL_VALIDATE_IDLE_SEC", 30))
+
+# Rows fetched per round trip when streaming items through a server-side cursor
+STREAM_BATCH_SIZE = 500
+
+# Retention of the items, enforced by `python3 jobs.py compact-items`: items
+# published more than RETENTION_MAX_AGE_DAYS ago and all but the latest
+# RETENTION_MAX_ITEMS_PER_FEED items of every feed are deleted (0 for no
+# limit), and so are the feeds nobody follows, with their items, unless
+# RETENTION_PURGE_ORPHANS is 0. The updater doesn't store entries older than
+# the age limit.
+RETENTION_MAX_AGE_DAYS = float(os.environ.get("RETENTION_MAX_AGE_DAYS", 0))
+RETENTION_MAX_ITEMS_PER_FEED = int(
+    os.environ.get("RETENTION_MAX_ITEMS_PER_FEED", 10000)
+)
+RETENTION_PURGE_ORPHANS = os.environ.get("RETENTION_PURGE_ORPHANS", "1") != "0"
 
-MAX_ENTRY_SIZE = 64 * 1024
+# Feed urls are VARCHAR(255) in the database (see migrations.py)
+MAX_FEED_URL_LENGTH = 255
+DEFAULT_PORTS = {"http": 80, "https": 443}
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -31,24 +69,384 @@ class FeedNotFound(Exception):
         super().__init__(f"No feed found: {feed_url}")
 
 
+class InvalidCursor(Exception):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        super().__init__(f"Invalid page cursor: {cursor}")
+
+
+def encode_cursor(published: int, item_id: int):
+    return base64.urlsafe_b64encode(f"{published}:{item_id}".encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]):
+    """Return (published, item_id) of the last item of the previous page
+
+    (None, None) is returned when there is no cursor, i.e. for the first page
+    """
+    if cursor is None:
+        return None, None
+    try:
+        published, item_id = base64.urlsafe_b64decode(cursor).decode().split(":")
+        return int(published), int(item_id)
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+
+# Index of the first item column in the GET_FEED_ITEMS and GET_ALL_ITEMS rows
+FEED_ITEMS_COLUMN = 4
+ALL_ITEMS_COLUMN = 3
+
+
+def make_page(rows, limit: Optional[int], include_content: bool):
+    """Turn item columns (see make_item) into items and the next page cursor
+
+    The rows are expected to be fetched with LIMIT limit + 1 so that the extra
+    row tells whether there is a next page. A row with NULL item id means there
+    are no items.
+    """
+    rows = [row for row in rows if row[0] is not None]
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    return [make_item(row, include_content) for row in rows], next_cursor
+
+
+def make_item(columns, include_content: bool):
+    """Item from item id, published, guid, title, link, author, summary, content"""
+    item_id, published, guid, title, link, author, summary, content = columns
+    item = {
+        "id": item_id,
+        "published": published,
+        "guid": guid,
+        "title": title,
+        "link": link,
+        "author": author,
+        "summary": summary,
+    }
+    if include_content:
+        item["content"] = zlib.decompress(content).decode() if content else None
+    return item
+
+
+def page_size(limit: Optional[int]):
+    return None if limit is None else limit + 1
+
+
+# Helpers interpreting the results of the queries, shared with async_db
+
+
+# Item record fields, in the order of the item columns of StagedItems
+ITEM_FIELDS = (
+    "published",
+    "fingerprint",
+    "guid",
+    "title",
+    "link",
+    "author",
+    "summary",
+    "content",
+)
+
+
+def item_columns(items: List[dict]):
+    """Arrays of the ITEM_FIELDS values of item records"""
+    return [[item[field] for item in items] for field in ITEM_FIELDS]
+
+
+def copy_value(value):
+    """A value in the text format of COPY"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        value = "\\x" + value.hex()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def staged_items(updates: List[dict]):
+    """COPY data of the entries of updates, numbered by the update from 1"""
+    data = io.StringIO()
+    for update_no, update in enumerate(updates, start=1):
+        for entry in update["entries"]:
+            values = [update_no] + [entry[field] for field in ITEM_FIELDS]
+            values.append(entry.get("undated", False))
+            data.write("\t".join(map(copy_value, values)) + "\n")
+    data.seek(0)
+    return data
+
+
+def feeds_result(rows, username: str):
+    """Feed urls from LIST_FEEDS rows"""
+    if not rows:
+        raise UserNotFound(username)
+    return [row[2] for row in rows if row[2] is not None]
+
+
+def check_feed_items_row(row, username: str, feed_url: str):
+    if row is None:
+        raise UserNotFound(username)
+    if row[1] is None:
+        # Feed not found for particular user
+        raise FeedNotFound(feed_url)
+
+
+def feed_items_result(
+    rows, username: str, feed_url: str, limit: Optional[int], include_content: bool
+):
+    """get_feed_items result from GET_FEED_ITEMS rows"""
+    check_feed_items_row(rows[0] if rows else None, username, feed_url)
+    items, next_cursor = make_page(
+        [row[FEED_ITEMS_COLUMN:] for row in rows], limit, include_content
+    )
+    return {
+        "items": items,
+        "failed": rows[0][2],
+        "next_cursor": next_cursor,
+        "version": rows[0][3],
+    }
+
+
+def all_items_result(rows, username: str, limit: Optional[int], include_content: bool):
+    """get_all_items result from GET_ALL_ITEMS rows"""
+    if not rows:
+        raise UserNotFound(username)
+    items, next_cursor = make_page(
+        [row[ALL_ITEMS_COLUMN:] for row in rows], limit, include_content
+    )
+    return {
+        "items": items,
+        "failed": list(rows[0][1]),
+        "next_cursor": next_cursor,
+        "version": rows[0][2],
+    }
+
+
+def check_mark_as_read_result(row, username: str, feed_url: str):
+    user_id, feed_id = row
+    if user_id is None:
+        raise UserNotFound(username)
+    if feed_id is None:
+        # Feed not found for particular user
+        raise FeedNotFound(feed_url)
+
+
+def followed_feeds_result(rows, username: str):
+    """{feed_url: feed_id} from LIST_FEEDS rows"""
+    if not rows:
+        raise UserNotFound(username)
+    return {row[2]: row[3] for row in rows if row[2] is not None}
+
+
+def unread_counts_result(rows, username: str):
+    """unread_counts result from UNREAD_COUNTS rows"""
+    if not rows:
+        raise UserNotFound(username)
+    feeds = {row[1]: row[2] for row in rows if row[1] is not None}
+    return {"feeds": feeds, "total": sum(feeds.values())}
+
+
+def canonical_feed_url(url: str):
+    """Normalized form of a feed url, which refers to the same resource
+
+    The scheme and the host are lowercased, and the default port and the
+    fragment are dropped. Variants which may be different resources (http
+    and https, trailing slashes) are left as they are: feeds found to be the
+    same are merged by the updater instead.
+    """
+    url = url.strip()
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+    netloc = parts.hostname
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc = f"{netloc}:{port}"
+    userinfo, at, _ = parts.netloc.rpartition("@")
+    if at:
+        netloc = f"{userinfo}@{netloc}"
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path, parts.query, ""))
+
+
+def feed_host(url: str):
+    """Host a feed is fetched from, which its fetches are rate limited by"""
+    try:
+        return urllib.parse.urlsplit(url).hostname or ""
+    except ValueError:
+        return ""
+
+
+def bulk_feed_urls(feed_urls):
+    """Unique feed urls of a bulk follow or unfollow in their order, their
+    normalized forms, and the invalid urls (empty or too long to be stored)
+    """
+    valid = {}
+    invalid = {}
+    for feed_url in feed_urls:
+        feed_url = feed_url.strip()
+        canonical_url = canonical_feed_url(feed_url)
+        if feed_url and max(len(feed_url), len(canonical_url)) <= MAX_FEED_URL_LENGTH:
+            valid[feed_url] = canonical_url
+        else:
+            invalid[feed_url] = None
+    return list(valid), list(valid.values()), list(invalid)
+
+
+def follow_feeds_result(rows, username, feed_urls, invalid):
+    """follow_feeds result from FOLLOW_FEEDS rows of @feed_urls"""
+    if not rows:
+        raise UserNotFound(username)
+    new_follows = {feed_url: new_follow for _, feed_url, new_follow in rows}
+    return {
+        "followed": [url for url in feed_urls if new_follows.get(url)],
+        "already_followed": [url for url in feed_urls if new_follows.get(url) is False],
+        "invalid": invalid,
+    }
+
+
+def unfollow_feeds_result(rows, username, feed_urls, invalid):
+    """unfollow_feeds result from UNFOLLOW_FEEDS rows of @feed_urls"""
+    if not rows:
+        raise UserNotFound(username)
+    unfollowed = {feed_url for _, feed_url in rows}
+    return {
+        "unfollowed": [url for url in feed_urls if url in unfollowed],
+        "not_followed": [url for url in feed_urls if url not in unfollowed] + invalid,
+    }
+
+
+def mark_as_read_batch_args(marks):
+    """MARK_AS_READ_BATCH arguments from (username, feed_url, item_id) marks"""
+    usernames, feed_urls, item_ids = zip(*marks) if marks else ((), (), ())
+    return list(usernames), list(feed_urls), list(item_ids)
+
+
+def mark_as_read_batch_result(rows):
+    """mark_as_read_batch result from MARK_AS_READ_BATCH rows"""
+    return {
+        "users_not_found": sorted({row[0] for row in rows if row[2] is None}),
+        "feeds_not_found": [
+            (row[0], row[1]) for row in rows if row[2] is not None and row[3] is None
+        ],
+    }
+
+
+def update_chains_result(rows):
+    """list_update_chains result from LIST_UPDATE_CHAINS rows
+
+    A feed has an active update chain while it holds an unexpired lease; an
+    expired lease is a lost chain which the dispatcher is going to recover
+    """
+    feeds = [
+        {
+            "feed_url": feed_url,
+            "active_chains": int(bool(active)),
+            "lease_owner": owner,
+            "lease_acquired_at": acquired_at,
+            "lease_expires_at": expires_at,
+            "next_update_at": next_update_at,
+            "failed": failed,
+        }
+        for feed_url, active, owner, acquired_at, expires_at, next_update_at, failed in rows
+    ]
+    return {
+        "active_chains": sum(feed["active_chains"] for feed in feeds),
+        "expired_leases": sum(
+            1 for feed in feeds if feed["lease_owner"] and not feed["active_chains"]
+        ),
+        "feeds": feeds,
+    }
+
+
+# Callables invoked with the text of every query sent to the database by both
+# DB backends, e.g. to count database round trips per API call
+query_hooks = []
+
+
+def run_query_hooks(query: str):
+    for hook in query_hooks:
+        hook(query)
+
+
+_PLACEHOLDER = re.compile(r"\$(\d+)")
+
+
+@functools.lru_cache(maxsize=None)
+def to_pyformat(query: str):
+    """Convert a query with asyncpg-style placeholders ($1) to psycopg2 format"""
+    return _PLACEHOLDER.sub(r"%(\1)s", query.replace("%", "%%"))
+
+
+def execute(cursor, query: str, *args):
+    """Execute a query from the queries module on a psycopg2 cursor"""
+    run_query_hooks(query)
+    cursor.execute(
+        to_pyformat(query), {str(i): arg for i, arg in enumerate(args, start=1)}
+    )
+
+
 class ConnectionManager(object):
+    """Connection taken from the pool for a transaction
+
+    The transaction is committed on success and rolled back on an exception;
+    connections broken by an error are closed by the pool
+    """
+
     def __init__(self, pool):
         self.pool = pool
 
     def __enter__(self):
-        self.conn = self.pool.getconn()
+        with metrics.DB_POOL_CHECKOUT_SECONDS.labels("sync").time():
+            self.conn = self.pool.getconn()
+        metrics.DB_POOL_CONNECTIONS.labels("sync", "in_use").inc()
         return self.conn
 
-    def __exit__(self, *args):
-        self.conn.commit()
-        self.pool.putconn(self.conn)
+    def __exit__(self, exc_type, exc, traceback):
+        broken = isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        try:
+            if exc_type is None:
+                self.conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            # Rolls back an uncommitted transaction
+            self.pool.putconn(self.conn, broken=broken)
+            metrics.DB_POOL_CONNECTIONS.labels("sync", "in_use").dec()
 
 
+@metrics.time_db_methods(
+    "sync", untimed={"conn", "close", "pool_stats", "fetch_follow"}
+)
 class DB:
-    def __init__(self, host, port, user, password, create=False):
-        self.pool = psycopg2.pool.SimpleConnectionPool(
-            POOL_MIN_CONNECTIONS,
-            POOL_MAX_CONNECTIONS,
+    def __init__(
+        self,
+        host,
+        port,
+        user,
+        password,
+        create=False,
+        min_connections: int = POOL_MIN_CONNECTIONS,
+        max_connections: int = POOL_MAX_CONNECTIONS,
+    ):
+        self.pool = db_pool.ConnectionPool(
+            min_connections,
+            max_connections,
+            POOL_CHECKOUT_TIMEOUT_SEC,
+            POOL_MAX_LIFETIME_SEC,
+            POOL_VALIDATE_IDLE_SEC,
             host=host,
             port=port,
             database=DBNAME,
@@ -58,135 +456,55 @@ class DB:
         if create:
             with self.conn() as conn:
                 with conn.cursor() as cursor:
-                    self.create_feeds_table(cursor)
-                    self.create_feed_items_table(cursor)
-                    self.create_users_table(cursor)
-                    self.create_user_feeds_table(cursor)
+                    migrations.migrate(cursor)
 
     def conn(self):
         return ConnectionManager(self.pool)
 
-    def create_feeds_table(self, cursor):
-        table = "Feeds"
-        cursor.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {table} (
-                feed_id SERIAL PRIMARY KEY,
-                feed_url VARCHAR(255) UNIQUE,
-                etag VARCHAR(255),
-                modified VARCHAR(255),
-                failed BOOLEAN DEFAULT false
-            );
-        """
-        )
-        if cursor.rowcount > 0:
-            logging.info(f"Created table {table}")
-        else:
-            logging.info(f"Table {table} already exists")
-
-    def create_feed_items_table(self, cursor):
-        table = "FeedItems"
-        cursor.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {table} (
-                item_id SERIAL PRIMARY KEY,
-                feed_id INTEGER,
-                published INTEGER,
-                entry VARCHAR({MAX_ENTRY_SIZE}),
-                FOREIGN KEY (feed_id) REFERENCES Feeds (feed_id),
-                UNIQUE(feed_id, published, entry)
-            );
-        """
-        )
-        if cursor.rowcount > 0:
-            logging.info(f"Created table {table}")
-        else:
-            logging.info(f"Table {table} already exists")
-
-    def create_users_table(self, cursor):
-        table = "Users"
-        cursor.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {table} (
-                user_id SERIAL PRIMARY KEY,
-                username VARCHAR(255) UNIQUE
-            );
-        """
-        )
-        if cursor.rowcount > 0:
-            logging.info(f"Created table {table}")
-        else:
-            logging.info(f"Table {table} already exists")
-
-    def create_user_feeds_table(self, cursor):
-        table = "UserFeeds"
-        cursor.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {table} (
-                user_feed_id SERIAL PRIMARY KEY,
-                user_id INTEGER,
-                feed_id INTEGER,
-                last_read_item_id INTEGER DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES Users (user_id),
-                FOREIGN KEY (feed_id) REFERENCES Feeds (feed_id),
-                UNIQUE(user_id, feed_id)
-            );
-        """
-        )
-        if cursor.rowcount > 0:
-            logging.info(f"Created table {table}")
-        else:
-            logging.info(f"Table {table} already exists")
+    def close(self):
+        self.pool.closeall()
+
+    def pool_stats(self):
+        """Connections of the pool by state and counts of the pool events"""
+        return self.pool.pool_stats()
 
     def add_user(self, username: str):
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(
-                    """INSERT INTO Users (username) VALUES(%s)
-                       ON CONFLICT DO NOTHING
-                       RETURNING user_id""",
-                    (username,),
-                )
+                execute(cursor, queries.INSERT_USER, username)
                 result = cursor.fetchone()
                 if not result:
                     raise UserAlreadyExists(username)
 
-    def get_user_id(self, cursor, username: str):
-        cursor.execute("SELECT user_id FROM users WHERE username = %s", (username,))
-        result = cursor.fetchone()
-        if not result:
-            raise UserNotFound(username)
-        return result[0]
-
-    def get_feed_id(self, cursor, feed_url):
-        cursor.execute("SELECT feed_id FROM feeds WHERE feed_url = %s", (feed_url,))
-        result = cursor.fetchone()
-        if not result:
-            raise FeedNotFound(feed_url)
-        return result[0]
-
-    def get_or_put_feed(self, cursor, url: str):
-        cursor.execute("SELECT feed_id FROM feeds WHERE feed_url = %s", (url,))
-        result = cursor.fetchone()
-        if result:
-            return result[0], False
-        cursor.execute(
-            "INSERT INTO feeds (feed_url) VALUES(%s) RETURNING feed_id", (url,)
-        )
-        return cursor.fetchone()[0], True
+    def fetch_follow(self, query: str, *args):
+        """Run FOLLOW_FEED or FOLLOW_FEEDS, return the result rows
+
+        A feed deleted (purged as an orphan or merged into a duplicate) right
+        after the query looked it up fails the foreign key check of the
+        follow; the query is run again then, and looks the feed up anew
+        """
+        try:
+            with self.conn() as conn:
+                with conn.cursor() as cursor:
+                    execute(cursor, query, *args)
+                    return cursor.fetchall()
+        except psycopg2.errors.ForeignKeyViolation:
+            with self.conn() as conn:
+                with conn.cursor() as cursor:
+                    execute(cursor, query, *args)
+                    return cursor.fetchall()
 
     def follow_feed(self, username: str, url: str):
-        with self.conn() as conn:
-            with conn.cursor() as cursor:
-                user_id = self.get_user_id(cursor, username)
-                feed_id, feed_created = self.get_or_put_feed(cursor, url)
-                cursor.execute(
-                    """INSERT INTO UserFeeds (user_id, feed_id) VALUES (%s, %s)
-                    ON CONFLICT DO NOTHING
-                    RETURNING user_feed_id""",
-                    (user_id, feed_id),
-                )
-                return cursor.fetchone() is not None, feed_created
+        """
+        Return a tuple of whether the feed was not followed beforehand
+        and whether the feed was created
+        """
+        [(user_id, feed_created, new_follow, _)] = self.fetch_follow(
+            queries.FOLLOW_FEED, username, canonical_feed_url(url), url
+        )
+        if user_id is None:
+            raise UserNotFound(username)
+        return new_follow, feed_created
 
     def unfollow_feed(self, username: str, feed_url: str):
         """
@@ -195,167 +513,641 @@ class DB:
         """
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                user_id = self.get_user_id(cursor, username)
-                feed_id = self.get_feed_id(cursor, feed_url)
-                cursor.execute(
-                    "DELETE FROM UserFeeds WHERE user_id = %s AND feed_id = %s",
-                    (user_id, feed_id),
-                )
-                success = cursor.rowcount != 0
+                execute(cursor, queries.UNFOLLOW_FEED, username, feed_url)
+                user_id, success = cursor.fetchone()
+                if user_id is None:
+                    raise UserNotFound(username)
                 return success
 
+    def follow_feeds(self, username: str, feed_urls: List[str]):
+        """Follow many feeds at once, as follow_feed for every url
+
+        Return {"followed": [feed_url], "already_followed": [feed_url],
+        "invalid": [feed_url]}
+        """
+        feed_urls, canonical_urls, invalid = bulk_feed_urls(feed_urls)
+        rows = self.fetch_follow(
+            queries.FOLLOW_FEEDS, username, canonical_urls, feed_urls
+        )
+        return follow_feeds_result(rows, username, feed_urls, invalid)
+
+    def unfollow_feeds(self, username: str, feed_urls: List[str]):
+        """Unfollow many feeds at once, as unfollow_feed for every url
+
+        Return {"unfollowed": [feed_url], "not_followed": [feed_url]}
+        """
+        feed_urls, _, invalid = bulk_feed_urls(feed_urls)
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.UNFOLLOW_FEEDS, username, feed_urls)
+                return unfollow_feeds_result(
+                    cursor.fetchall(), username, feed_urls, invalid
+                )
+
     def list_feeds(self, username: str):
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                user_id = self.get_user_id(cursor, username)
-                cursor.execute(
-                    """SELECT Feeds.feed_url FROM Feeds
-                       JOIN UserFeeds ON Feeds.feed_id = UserFeeds.feed_id
-                       WHERE UserFeeds.user_id = %s""",
-                    (user_id,),
+                execute(cursor, queries.LIST_FEEDS, username, None, None)
+                return feeds_result(cursor.fetchall(), username)
+
+    def unread_counts(self, username: str):
+        """Return {"feeds": {feed_url: unread items}, "total": unread items}"""
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.UNREAD_COUNTS, username, None)
+                return unread_counts_result(cursor.fetchall(), username)
+
+    def reconcile_unread_counts(self, after, batch_size: int):
+        """Fix the unread counts of the next batch of user feeds after @after
+
+        @after is a (user_id, feed_id) pair, (0, 0) for the first batch.
+        Return the number of fixed counts and the last user feed of the batch,
+        None after the last batch
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.RECONCILE_UNREAD_COUNTS, *after, batch_size)
+                row = cursor.fetchone()
+                if row is None:
+                    return 0, None
+                return row[0], (row[1], row[2])
+
+    def compact_items(
+        self,
+        after: int,
+        feeds_batch_size: int,
+        items_batch_size: int,
+        published_before: Optional[int],
+        max_items_per_feed: Optional[int],
+        purge_orphans: bool,
+    ):
+        """Delete at most @items_batch_size items beyond the retention limits
+        from the next batch of feeds after feed id @after (0 for the first one)
+
+        Items published before @published_before and all but the latest
+        @max_items_per_feed items of every feed are deleted (None for no
+        limit), and all the items of the feeds nobody follows with
+        @purge_orphans. Return the number of deleted items and the last feed
+        id of the batch, None after the last batch
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(
+                    cursor,
+                    queries.COMPACT_ITEMS,
+                    after,
+                    feeds_batch_size,
+                    items_batch_size,
+                    published_before,
+                    max_items_per_feed,
+                    purge_orphans,
                 )
-                return [res[0] for res in cursor.fetchall()]
+                return cursor.fetchone()
+
+    def purge_orphan_feeds(self, batch_size: int):
+        """Delete at most @batch_size feeds nobody follows which have no items
+
+        Return the number of deleted feeds
+        """
+        try:
+            with self.conn() as conn:
+                with conn.cursor() as cursor:
+                    execute(cursor, queries.PURGE_ORPHAN_FEEDS, batch_size)
+                    return cursor.fetchone()[0]
+        except psycopg2.errors.ForeignKeyViolation:
+            # A feed was followed again right before it was deleted; it is
+            # left for the next run
+            return 0
 
     def get_feed_last_updated(self, feed_url: str):
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(
-                    """SELECT etag, modified FROM Feeds WHERE feed_url = %s""",
-                    (feed_url,),
-                )
+                execute(cursor, queries.GET_FEED_LAST_UPDATED, feed_url)
                 result = cursor.fetchone()
                 if result is None:
                     return None
                 else:
                     return {"etag": result[0], "modified": result[1]}
 
-    def put_updates(
+    def claim_due_feeds(
+        self,
+        batch_size: int,
+        lookahead_sec: float,
+        claim_timeout_sec: float,
+        owner: str,
+        shard: Optional[str] = None,
+    ):
+        """Lease feeds due for an update within @lookahead_sec seconds
+
+        The leases are held by @owner. Unless the update is started within
+        @claim_timeout_sec seconds after the due time, the lease expires and
+        the feed can be claimed again. Only the feeds of @shard (see
+        sharding.HashRing.multirange) are leased, if given.
+        Return a list of (feed_url, lease token, seconds until the feed is due)
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(
+                    cursor,
+                    queries.CLAIM_DUE_FEEDS,
+                    batch_size,
+                    lookahead_sec,
+                    claim_timeout_sec,
+                    owner,
+                    shard,
+                )
+                return cursor.fetchall()
+
+    def start_updates(
+        self,
+        leases: List[tuple],
+        owner: str,
+        timeout_sec: float,
+        load_fingerprints: Set[str] = frozenset(),
+        fingerprints_limit: int = 0,
+        published_limit: int = 0,
+    ):
+        """Take over the update leases given as (feed_url, token) for @timeout_sec seconds
+
+        Return {feed_url: {"etag", "modified", "body_hash", "fingerprints",
+        "lag_sec", "feed_id", "fail_count", "unchanged_count",
+        "declared_interval_sec", "published"}} for the feeds whose leases are
+        not lost (expired and claimed again, or the feed is gone), with the
+        number of seconds the updates are late in "lag_sec". Fingerprints of at most
+        @fingerprints_limit latest items are loaded for the feeds in
+        @load_fingerprints, None for the others, and publish times of at most
+        @published_limit latest items for all of them.
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(
+                    cursor,
+                    queries.START_UPDATES,
+                    [feed_url for feed_url, _ in leases],
+                    [token for _, token in leases],
+                    owner,
+                    timeout_sec,
+                    [feed_url in load_fingerprints for feed_url, _ in leases],
+                    fingerprints_limit,
+                    published_limit,
+                )
+                return {
+                    feed_url: {
+                        "etag": etag,
+                        "modified": modified,
+                        "body_hash": body_hash,
+                        "fingerprints": fingerprints,
+                        "lag_sec": lag_sec,
+                        "feed_id": feed_id,
+                        "fail_count": fail_count,
+                        "unchanged_count": unchanged_count,
+                        "declared_interval_sec": declared_interval_sec,
+                        "published": published,
+                    }
+                    for (
+                        feed_url,
+                        etag,
+                        modified,
+                        body_hash,
+                        fingerprints,
+                        lag_sec,
+                        feed_id,
+                        fail_count,
+                        unchanged_count,
+                        declared_interval_sec,
+                        published,
+                    ) in cursor
+                }
+
+    def count_overdue_feeds(self, shard: Optional[str] = None):
+        """Return numbers of the overdue feeds not leased and leased for
+        updates, of @shard if given
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.COUNT_OVERDUE_FEEDS, shard)
+                return cursor.fetchone()
+
+    def updater_node_heartbeat(self, node_id: str, timeout_sec: float):
+        """Record a heartbeat of updater node @node_id
+
+        Return the ids of the live nodes: the ones with a heartbeat within
+        @timeout_sec seconds
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.UPDATER_NODE_HEARTBEAT, node_id, timeout_sec)
+                return {row[0] for row in cursor.fetchall()}
+
+    def delete_updater_node(self, node_id: str):
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.DELETE_UPDATER_NODE, node_id)
+
+    def reserve_host_fetches(
+        self,
+        fetches: dict,
+        interval_sec: float,
+        burst: int,
+        ahead_sec: float,
+    ):
+        """Reserve fetches of hosts given as {host: number of fetches}
+
+        Every host is fetched once per @interval_sec seconds, up to @burst
+        fetches at once after a pause, and not while it is blocked; only the
+        fetches which start within @ahead_sec seconds are reserved. Return
+        {host: (seconds until the first reserved fetch, reserved fetches)}
+        """
+        hosts = sorted(fetches)
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.ADD_FETCH_HOSTS, hosts)
+                execute(
+                    cursor,
+                    queries.RESERVE_HOST_FETCHES,
+                    hosts,
+                    [fetches[host] for host in hosts],
+                    interval_sec,
+                    burst,
+                    ahead_sec,
+                )
+                return {host: (first_sec, count) for host, first_sec, count in cursor}
+
+    def throttle_hosts(self, throttled: dict):
+        """Block hosts given as {host: seconds} from fetches for that long"""
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(
+                    cursor,
+                    queries.THROTTLE_HOSTS,
+                    list(throttled),
+                    list(throttled.values()),
+                )
+
+    def blocked_hosts(self, hosts: List[str]):
+        """Return {host: seconds it is blocked for} of the blocked @hosts"""
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.GET_BLOCKED_HOSTS, hosts)
+                return dict(cursor.fetchall())
+
+    def list_update_chains(self, feed_url: Optional[str] = None):
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.LIST_UPDATE_CHAINS, feed_url)
+                return update_chains_result(cursor.fetchall())
+
+    def put_updates(self, updates: List[dict]):
+        """Store the updates of many feeds, release their update leases and
+        schedule the next updates
+
+        Updates are dicts with the feed_url, etag, modified, entries, the time
+        of the next update in epoch seconds (next_update_at), the update lease
+        token, body_hash, declared_interval_sec and the number of updates in a
+        row without new items (unchanged_count). Entries are item records with
+        the ITEM_FIELDS and undated (see parsing.entry_record); they are
+        copied into a staging table and inserted from there by a single query
+        (see PUT_UPDATES in queries.py). Return {feed_url: number of new
+        items} of the feeds found.
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.CREATE_STAGED_ITEMS)
+                run_query_hooks(queries.COPY_STAGED_ITEMS)
+                cursor.copy_expert(queries.COPY_STAGED_ITEMS, staged_items(updates))
+                execute(
+                    cursor,
+                    queries.PUT_UPDATES,
+                    *(
+                        [update[field] for update in updates]
+                        for field in (
+                            "feed_url",
+                            "etag",
+                            "modified",
+                            "next_update_at",
+                            "token",
+                            "body_hash",
+                            "declared_interval_sec",
+                            "unchanged_count",
+                        )
+                    ),
+                )
+                return {feed_url: inserted for feed_url, inserted, _ in cursor}
+
+    def record_failure(
         self,
         feed_url: str,
-        etag: Optional[str],
-        modified: Optional[str],
-        entries: List[str],
+        max_fail_count: int,
+        retry_sec: float,
+        token: str,
     ):
-        entries = sorted(entries, key=lambda entry: entry["published"])
+        """Count a failed update of a feed, release the update lease @token
+        and schedule a retry in @retry_sec seconds
+
+        After @max_fail_count failures in a row the feed is marked as failed and
+        is not updated any more. Return True if the feed is failed now.
+        """
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                feed_id = self.get_feed_id(cursor, feed_url)
-                query = """INSERT INTO FeedItems (feed_id, published, entry) VALUES %s
-                ON CONFLICT DO NOTHING"""
-                execute_values(
+                execute(
                     cursor,
-                    query,
-                    [
-                        (feed_id, entry["published"], entry["content"])
-                        for entry in entries
-                    ],
+                    queries.RECORD_FAILURE,
+                    feed_url,
+                    max_fail_count,
+                    retry_sec,
+                    token,
                 )
-                if etag is not None or modified is not None:
-                    etag_query = "etag = %s , " if etag is not None else ""
-                    modified_query = "modified = %s , " if modified is not None else ""
-                    values = tuple(
-                        (x for x in (etag, modified, feed_id) if x is not None)
-                    )
-                    query = f"""UPDATE Feeds SET {etag_query} {modified_query} failed = false
-                                WHERE feed_id = %s"""
-                    cursor.execute(query, values)
+                result = cursor.fetchone()
+                return result is not None and result[0]
 
-    def set_failed(self, feed_url):
+    def postpone_updates(self, postponed: List[tuple]):
+        """Put off updates given as (feed_url, token, delay_sec): release the
+        update leases and schedule the next updates in delay_sec seconds,
+        without counting failures
+        """
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("""UPDATE Feeds SET failed = true""")
+                execute(
+                    cursor,
+                    queries.POSTPONE_UPDATES,
+                    [feed_url for feed_url, _, _ in postponed],
+                    [token for _, token, _ in postponed],
+                    [delay_sec for _, _, delay_sec in postponed],
+                )
+
+    def move_feed(self, feed_url: str, token: str, new_url: str):
+        """Move a feed permanently redirected to @new_url there, with the
+        update lease @token held
+
+        Return whether the feed was moved, and the id of the feed known by
+        @new_url if any (to merge the feed into)
+        """
+        try:
+            with self.conn() as conn:
+                with conn.cursor() as cursor:
+                    execute(cursor, queries.MOVE_FEED, feed_url, token, new_url)
+                    moved, taken_feed_id = cursor.fetchone()
+                    return moved, taken_feed_id
+        except psycopg2.errors.UniqueViolation:
+            # Followed by the new url right before; merged on the next update
+            return False, None
+
+    def merge_feed(
+        self,
+        feed_url: str,
+        token: str,
+        target_feed_id: Optional[int] = None,
+        body_hash: Optional[str] = None,
+        fingerprints: Sequence[str] = (),
+    ):
+        """Merge a feed into a duplicate, with the update lease @token held
+
+        The duplicate is feed @target_feed_id, or another feed with @body_hash
+        which stores the new entries of the feed (@fingerprints) and its items.
+        The followers and the aliases of the feed are moved to the duplicate,
+        and the feed is deleted with its items (see FIND_MERGE_TARGET in
+        queries.py), by several statements in a transaction rather than one
+        (see the queries module docstring). Return the url of the duplicate,
+        None if not merged.
+        """
+        try:
+            with self.conn() as conn:
+                with conn.cursor() as cursor:
+                    execute(
+                        cursor,
+                        queries.FIND_MERGE_TARGET,
+                        feed_url,
+                        token,
+                        target_feed_id,
+                        body_hash,
+                        list(fingerprints),
+                    )
+                    row = cursor.fetchone()
+                    if row is None:
+                        return None
+                    feed_id, target_feed_id = row
+                    execute(cursor, queries.LOCK_FEEDS, [feed_id, target_feed_id])
+                    urls = dict(cursor.fetchall())
+                    if len(urls) < 2:
+                        # Deleted meanwhile
+                        return None
+                    execute(cursor, queries.MOVE_FOLLOWERS, feed_id, target_feed_id)
+                    execute(
+                        cursor, queries.MOVE_ALIASES, feed_id, target_feed_id, feed_url
+                    )
+                    execute(cursor, queries.DELETE_FEED, feed_id)
+                    return urls[target_feed_id]
+        except psycopg2.errors.ForeignKeyViolation:
+            # Items were stored or the feed was followed concurrently; merged
+            # on the next update
+            return None
 
     def list_all_feeds(self):
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT feed_url FROM Feeds")
+                execute(cursor, queries.LIST_ALL_FEEDS)
                 return [res[0] for res in cursor.fetchall()]
 
-    def get_feed_items(self, username: str, feed_url: str, unread_only: bool):
+    def get_feed_items(
+        self,
+        username: str,
+        feed_url: str,
+        unread_only: bool,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+        include_content: bool = False,
+    ):
+        """List items of a followed feed ordered by publishing time
+
+        Returns at most @limit items following the @after page cursor, and the
+        cursor of the next page (None if this page is the last one). The item
+        content is only included when asked for, as it is the bulk of an item.
+        """
+        after_published, after_item_id = decode_cursor(after)
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                user_id = self.get_user_id(cursor, username)
-                feed_id = self.get_feed_id(cursor, feed_url)
-                cursor.execute(
-                    """SELECT last_read_item_id FROM UserFeeds
-                                  WHERE user_id = %s AND feed_id = %s""",
-                    (user_id, feed_id),
+                execute(
+                    cursor,
+                    queries.GET_FEED_ITEMS,
+                    username,
+                    feed_url,
+                    unread_only,
+                    after_published,
+                    after_item_id,
+                    page_size(limit),
+                    include_content,
+                    None,
+                    None,
+                    None,
                 )
-                last_read = cursor.fetchone()
-                if last_read is None:
-                    # Feed not found for particular user
-                    raise FeedNotFound(feed_url)
-                last_read = last_read[0]
-                last_read_query = "AND item_id > %s" if unread_only else ""
-                if unread_only:
-                    last_read_query = "AND item_id > %s"
-                else:
-                    last_read_query = ""
-                    last_read = None
-                values = tuple((x for x in (feed_id, last_read) if x is not None))
-                cursor.execute(
-                    f"""SELECT item_id, entry FROM FeedItems
-                    WHERE feed_id = %s {last_read_query}
-                    ORDER BY published""",
-                    values,
+                return feed_items_result(
+                    cursor.fetchall(), username, feed_url, limit, include_content
                 )
-                items = [{"id": res[0], "content": res[1]} for res in cursor.fetchall()]
-                cursor.execute(
-                    "SELECT failed FROM Feeds WHERE feed_id = %s", (feed_id,)
+
+    def iter_feed_items(
+        self,
+        username: str,
+        feed_url: str,
+        unread_only: bool,
+        after: Optional[str] = None,
+        include_content: bool = False,
+    ):
+        """Stream items of a followed feed through a server-side cursor
+
+        The first value generated is {"failed": bool}, the items follow
+        """
+        after_published, after_item_id = decode_cursor(after)
+        with self.conn() as conn:
+            with conn.cursor(name="feed_items") as cursor:
+                cursor.itersize = STREAM_BATCH_SIZE
+                execute(
+                    cursor,
+                    queries.GET_FEED_ITEMS,
+                    username,
+                    feed_url,
+                    unread_only,
+                    after_published,
+                    after_item_id,
+                    None,
+                    include_content,
+                    None,
+                    None,
+                    None,
                 )
-                failed = cursor.fetchone()[0]
-                return {"items": items, "failed": failed}
+                first = cursor.fetchone()
+                check_feed_items_row(first, username, feed_url)
+                yield {"failed": first[2]}
+                if first[FEED_ITEMS_COLUMN] is not None:
+                    for row in itertools.chain([first], cursor):
+                        yield make_item(row[FEED_ITEMS_COLUMN:], include_content)
+
+    def get_all_items(
+        self,
+        username: str,
+        unread_only: bool,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+        include_content: bool = False,
+    ):
+        """List items of all followed feeds ordered by publishing time
 
-    def get_all_items(self, username: str, unread_only: bool):
+        Paginated the same way as get_feed_items
+        """
+        after_published, after_item_id = decode_cursor(after)
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                user_id = self.get_user_id(cursor, username)
-                unread_query = (
-                    "AND items.item_id > feeds.last_read_item_id" if unread_only else ""
+                execute(
+                    cursor,
+                    queries.GET_ALL_ITEMS,
+                    username,
+                    unread_only,
+                    after_published,
+                    after_item_id,
+                    page_size(limit),
+                    include_content,
+                    None,
+                    None,
                 )
-                cursor.execute(
-                    f"""
-                    SELECT items.item_id, items.entry
-                    FROM UserFeeds feeds
-                    JOIN FeedItems items ON feeds.feed_id = items.feed_id
-                    WHERE feeds.user_id = %s
-                    {unread_query}
-                    ORDER BY items.published
-                """,
-                    (user_id,),
+                return all_items_result(
+                    cursor.fetchall(), username, limit, include_content
                 )
-                items = [{"id": res[0], "content": res[1]} for res in cursor.fetchall()]
-                cursor.execute(
-                    """
-                    SELECT Feeds.feed_url
-                    FROM Feeds
-                    JOIN UserFeeds ON Feeds.feed_id = UserFeeds.feed_id
-                    WHERE UserFeeds.user_id = %s AND Feeds.failed = true""",
-                    (user_id,),
+
+    def iter_all_items(
+        self,
+        username: str,
+        unread_only: bool,
+        after: Optional[str] = None,
+        include_content: bool = False,
+    ):
+        """Stream items of all followed feeds through a server-side cursor
+
+        The first value generated is {"failed": [failed_feed_url]}, the items follow
+        """
+        after_published, after_item_id = decode_cursor(after)
+        with self.conn() as conn:
+            with conn.cursor(name="all_items") as cursor:
+                cursor.itersize = STREAM_BATCH_SIZE
+                execute(
+                    cursor,
+                    queries.GET_ALL_ITEMS,
+                    username,
+                    unread_only,
+                    after_published,
+                    after_item_id,
+                    None,
+                    include_content,
+                    None,
+                    None,
                 )
-                failed_ids = [res[0] for res in cursor.fetchall()]
-                return {"items": items, "failed": failed_ids}
+                first = cursor.fetchone()
+                if first is None:
+                    raise UserNotFound(username)
+                yield {"failed": list(first[1])}
+                if first[ALL_ITEMS_COLUMN] is not None:
+                    for row in itertools.chain([first], cursor):
+                        yield make_item(row[ALL_ITEMS_COLUMN:], include_content)
 
     def mark_as_read(self, username: str, feed_url: str, item_id: int):
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                user_id = self.get_user_id(cursor, username)
-                feed_id = self.get_feed_id(cursor, feed_url)
-                cursor.execute(
-                    """UPDATE UserFeeds SET last_read_item_id = %s
-                    WHERE user_id = %s AND feed_id = %s""",
-                    (item_id, user_id, feed_id),
+                execute(
+                    cursor, queries.MARK_AS_READ, username, feed_url, item_id, None, None
                 )
+                check_mark_as_read_result(cursor.fetchone(), username, feed_url)
 
-    def request_feed_update(self, feed_url: str):
+    def mark_as_read_batch(self, marks):
+        """Mark items as read in bulk: up to item_id for (username, feed_url, item_id)
+
+        Marks of unknown users and not followed feeds are skipped; return
+        {"users_not_found": [username], "feeds_not_found": [(username, feed_url)]}
+        """
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(
+                    cursor, queries.MARK_AS_READ_BATCH, *mark_as_read_batch_args(marks)
+                )
+                return mark_as_read_batch_result(cursor.fetchall())
+
+    def backfill_items(self, batch_size: int, convert):
+        """Convert the entry JSON of a batch of items stored before the item
+        columns into the columns
+
+        @convert turns (entry dict, published) into an item record.
+        Return the numbers of converted items and of deleted duplicates, both
+        0 when there is nothing left to convert.
+        """
         with self.conn() as conn:
             with conn.cursor() as cursor:
-                feed_id = self.get_feed_id(cursor, feed_url)
-                cursor.execute(
-                    """UPDATE Feeds SET failed = false
-                    WHERE feed_id = %s AND failed = true
-                    RETURNING failed""",
-                    (feed_id,),
+                execute(cursor, queries.GET_ITEMS_TO_BACKFILL, batch_size)
+                item_ids = []
+                items = []
+                duplicates = []
+                seen = set()
+                for item_id, feed_id, published, entry in cursor.fetchall():
+                    item = convert(json.loads(entry), published)
+                    key = (feed_id, published, item["fingerprint"])
+                    if key in seen:
+                        duplicates.append(item_id)
+                    seen.add(key)
+                    item_ids.append(item_id)
+                    items.append(item)
+                if not items:
+                    return 0, 0
+                execute(
+                    cursor,
+                    queries.BACKFILL_ITEMS,
+                    item_ids,
+                    *item_columns(items),
+                    duplicates,
                 )
-                was_failed = cursor.fetchone() is not None
+                return cursor.fetchone()
+
+    def request_feed_update(self, feed_url: str):
+        """Reset the failed state of a feed, return True if it was failed"""
+        with self.conn() as conn:
+            with conn.cursor() as cursor:
+                execute(cursor, queries.REQUEST_FEED_UPDATE, feed_url)
+                feed_id, was_failed = cursor.fetchone()
+                if feed_id is None:
+                    raise FeedNotFound(feed_url)
                 return was_failed
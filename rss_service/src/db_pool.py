@@ -0,0 +1,219 @@
+import collections
+import threading
+import time
+from typing import Optional
+
+import psycopg2
+import psycopg2.extensions
+
+import metrics
+
+
+class PoolTimeout(Exception):
+    def __init__(self, timeout_sec):
+        super().__init__(f"No database connection available in {timeout_sec}s")
+
+
+class PoolClosed(Exception):
+    def __init__(self):
+        super().__init__("Connection pool is closed")
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections
+
+    Unlike psycopg2's SimpleConnectionPool, which is not thread-safe and fails
+    right away when all the connections are in use, getconn() waits up to
+    @checkout_timeout_sec for a connection to be returned. Connections older
+    than @max_lifetime_sec are closed instead of being reused, and connections
+    idle for @validate_idle_sec are checked with a query before reuse, so that
+    the ones dropped by the server or the network are replaced. Connections are
+    returned outside of a transaction (rolled back if needed).
+    """
+
+    def __init__(
+        self,
+        min_size: int,
+        max_size: int,
+        checkout_timeout_sec: float,
+        max_lifetime_sec: float,
+        validate_idle_sec: float,
+        backend: str = "sync",
+        **connect_args,
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout_sec = checkout_timeout_sec
+        self.max_lifetime_sec = max_lifetime_sec
+        self.validate_idle_sec = validate_idle_sec
+        self.backend = backend
+        self.connect_args = connect_args
+        self.cond = threading.Condition()
+        # Idle connections, the most recently returned last: (connection,
+        # opened at, returned at)
+        self.idle = collections.deque()
+        # Connection: opened at, for the connections in use
+        self.in_use = {}
+        # Connections open or being opened
+        self.size = 0
+        self.waiting = 0
+        self.closed = False
+        self.stats = {
+            "opened": 0,
+            "closed": 0,
+            "broken": 0,
+            "expired": 0,
+            "timeouts": 0,
+        }
+        metrics.DB_POOL_CONNECTIONS.labels(backend, "max").inc(max_size)
+        for _ in range(min_size):
+            self.putconn(self.reserve_and_open())
+
+    def count(self, event: str, n: int = 1):
+        """Count a pool event; the lock must be held"""
+        self.stats[event] += n
+        metrics.DB_POOL_EVENTS.labels(self.backend, event).inc(n)
+
+    def reserve_and_open(self):
+        with self.cond:
+            self.size += 1
+        return self.open()
+
+    def open(self):
+        """Open a connection reserved in size"""
+        try:
+            conn = psycopg2.connect(**self.connect_args)
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.count("opened")
+            self.in_use[conn] = time.monotonic()
+        return conn
+
+    def discard(self, conn, reason: str):
+        """Close a connection not to be reused; the lock must be held"""
+        self.size -= 1
+        self.count(reason)
+        self.cond.notify()
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def expired(self, opened_at: float):
+        return time.monotonic() - opened_at >= self.max_lifetime_sec
+
+    def alive(self, conn):
+        """Check an idle connection with a query"""
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout_sec: Optional[float] = None):
+        """Take a connection, waiting for one up to @timeout_sec
+
+        Raises PoolTimeout if none is available in time
+        """
+        if timeout_sec is None:
+            timeout_sec = self.checkout_timeout_sec
+        deadline = time.monotonic() + timeout_sec
+        while True:
+            with self.cond:
+                conn = self.take(deadline, timeout_sec)
+            if conn is None:
+                return self.open()
+            conn, opened_at, returned_at = conn
+            if time.monotonic() - returned_at < self.validate_idle_sec:
+                return conn
+            # Checked outside of the lock, as it takes a round trip
+            if self.alive(conn):
+                return conn
+            with self.cond:
+                del self.in_use[conn]
+                self.discard(conn, "broken")
+
+    def take(self, deadline: float, timeout_sec: float):
+        """Take an idle connection, or None after reserving a new one
+
+        The lock must be held
+        """
+        while True:
+            if self.closed:
+                raise PoolClosed()
+            while self.idle:
+                conn, opened_at, returned_at = self.idle.pop()
+                if conn.closed:
+                    self.discard(conn, "broken")
+                elif self.expired(opened_at):
+                    self.discard(conn, "expired")
+                else:
+                    self.in_use[conn] = opened_at
+                    return conn, opened_at, returned_at
+            if self.size < self.max_size:
+                self.size += 1
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.count("timeouts")
+                raise PoolTimeout(timeout_sec)
+            self.waiting += 1
+            metrics.DB_POOL_CONNECTIONS.labels(self.backend, "waiting").inc()
+            try:
+                self.cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+                metrics.DB_POOL_CONNECTIONS.labels(self.backend, "waiting").dec()
+
+    def putconn(self, conn, broken: bool = False):
+        """Return a connection taken with getconn
+
+        A connection in a transaction is rolled back; @broken ones (e.g. after
+        a connection error) are closed
+        """
+        if not broken and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                broken = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+        with self.cond:
+            opened_at = self.in_use.pop(conn)
+            if broken or conn.closed:
+                self.discard(conn, "broken")
+            elif self.closed:
+                self.discard(conn, "closed")
+            elif self.expired(opened_at):
+                self.discard(conn, "expired")
+            else:
+                self.idle.append((conn, opened_at, time.monotonic()))
+                self.cond.notify()
+
+    def closeall(self):
+        """Close the idle connections; the ones in use are closed when returned"""
+        with self.cond:
+            self.closed = True
+            while self.idle:
+                self.discard(self.idle.pop()[0], "closed")
+            self.cond.notify_all()
+        metrics.DB_POOL_CONNECTIONS.labels(self.backend, "max").dec(self.max_size)
+
+    def pool_stats(self):
+        with self.cond:
+            return {
+                "max_size": self.max_size,
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": len(self.in_use),
+                "waiting": self.waiting,
+                **self.stats,
+            }
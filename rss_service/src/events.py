@@ -0,0 +1,149 @@
+import asyncio
+import contextlib
+import logging
+
+import asyncpg
+
+import queries
+
+# Wait before listening again after losing the listening connection
+RECONNECT_SEC = 5
+# The listening connection is checked this often, as a connection dropped by
+# the network may only be noticed on the next query
+PING_INTERVAL_SEC = 30
+
+
+class Subscription:
+    """New items notifications of a set of feeds for a single waiter"""
+
+    def __init__(self, events):
+        self.events = events
+        self.feed_ids = set()
+        # Feed ids notified since the last wait
+        self.notified = set()
+        self.event = asyncio.Event()
+
+    def follow(self, feed_ids):
+        """Get notified of @feed_ids only"""
+        feed_ids = set(feed_ids)
+        for feed_id in self.feed_ids - feed_ids:
+            self.events.unregister(feed_id, self)
+        for feed_id in feed_ids - self.feed_ids:
+            self.events.register(feed_id, self)
+        self.feed_ids = feed_ids
+
+    def notify(self, feed_id):
+        self.notified.add(feed_id)
+        self.event.set()
+
+    async def wait(self, timeout_sec: float):
+        """Wait for notifications, return the notified feed ids, empty on timeout
+
+        Notifications which came since the previous wait are returned at once
+        """
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout_sec)
+        except asyncio.TimeoutError:
+            return set()
+        self.event.clear()
+        notified, self.notified = self.notified, set()
+        return notified
+
+    def close(self):
+        self.follow(())
+
+
+class FeedEvents:
+    """Fans out the new items notifications of the updater in the service
+
+    A single connection per process listens on NEW_ITEMS_CHANNEL (see
+    queries.py), and the notifications are passed to the subscriptions of the
+    notified feeds, so waiting clients hold no database connections. When the
+    connection is lost, all the subscriptions are notified once listening
+    again, as notifications may have been missed. The urls of the feeds purged
+    by the compaction job (FEEDS_PURGED_CHANNEL) are passed to the
+    @on_feed_purged coroutine function, if any. start() must be called from
+    the running event loop.
+    """
+
+    def __init__(self, connect_args: dict, on_feed_purged=None):
+        self.connect_args = connect_args
+        self.on_feed_purged = on_feed_purged
+        # Feed id: subscriptions
+        self.subscriptions = {}
+        self.task = None
+        # Running on_feed_purged calls
+        self.purges = set()
+
+    def register(self, feed_id: int, subscription: Subscription):
+        self.subscriptions.setdefault(feed_id, set()).add(subscription)
+
+    def unregister(self, feed_id: int, subscription: Subscription):
+        subscriptions = self.subscriptions.get(feed_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[feed_id]
+
+    @contextlib.contextmanager
+    def subscribe(self):
+        subscription = Subscription(self)
+        try:
+            yield subscription
+        finally:
+            subscription.close()
+
+    def on_notification(self, conn, pid, channel, payload):
+        feed_id = int(payload)
+        for subscription in self.subscriptions.get(feed_id, ()):
+            subscription.notify(feed_id)
+
+    def on_purge_notification(self, conn, pid, channel, payload):
+        purge = asyncio.create_task(self.on_feed_purged(payload))
+        self.purges.add(purge)
+        purge.add_done_callback(self.purges.discard)
+
+    def notify_all(self):
+        for feed_id, subscriptions in self.subscriptions.items():
+            for subscription in subscriptions:
+                subscription.notify(feed_id)
+
+    async def listen(self):
+        """Listen until the connection is lost"""
+        conn = await asyncpg.connect(**self.connect_args)
+        try:
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda conn: closed.set())
+            await conn.add_listener(queries.NEW_ITEMS_CHANNEL, self.on_notification)
+            if self.on_feed_purged is not None:
+                await conn.add_listener(
+                    queries.FEEDS_PURGED_CHANNEL, self.on_purge_notification
+                )
+            logging.info(f"Listening for {queries.NEW_ITEMS_CHANNEL} notifications")
+            self.notify_all()
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(closed.wait(), PING_INTERVAL_SEC)
+                except asyncio.TimeoutError:
+                    await conn.execute("SELECT 1", timeout=PING_INTERVAL_SEC)
+        finally:
+            await conn.close(timeout=RECONNECT_SEC)
+
+    async def run(self):
+        while True:
+            try:
+                await self.listen()
+            except Exception as e:
+                logging.error(f"Lost the new items notifications connection: {e}")
+            await asyncio.sleep(RECONNECT_SEC)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,157 @@
+import aiohttp
+import asyncio
+import atexit
+import threading
+import time
+from typing import List, Optional
+
+import metrics
+
+# Connections kept open to all the hosts and to a single host; these are also
+# the limits of concurrent requests
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 4
+CONNECT_TIMEOUT_SEC = 5
+# Timeout of a whole request, including the wait for a free connection
+REQUEST_TIMEOUT_SEC = 20
+# Redirects which move a feed for good
+PERMANENT_REDIRECTS = {301, 308}
+
+
+class FetchError(Exception):
+    def __init__(self, url, status, retry_after=None):
+        super().__init__(f"Fetching {url} failed with status {status}")
+        self.status = status
+        # The Retry-After header of the response, if any
+        self.retry_after = retry_after
+
+
+class Fetcher:
+    """Fetches feeds concurrently over pooled HTTP connections
+
+    Runs an asyncio event loop with a single aiohttp session in a background
+    thread, so it is usable from sync code (e.g. dramatiq actors running in
+    threads) and the connections are reused across calls. The loop is started
+    on the first fetch and stopped by close() or at exit.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = MAX_CONNECTIONS,
+        max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST,
+        connect_timeout_sec: float = CONNECT_TIMEOUT_SEC,
+        request_timeout_sec: float = REQUEST_TIMEOUT_SEC,
+    ):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = aiohttp.ClientTimeout(
+            total=request_timeout_sec, sock_connect=connect_timeout_sec
+        )
+        self.loop = None
+        self.session = None
+        self.lock = threading.Lock()
+
+    def run(self, coro):
+        """Run a coroutine in the fetcher loop, wait for the result"""
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self.loop.run_forever, name="fetcher", daemon=True
+                ).start()
+                self.session = asyncio.run_coroutine_threadsafe(
+                    self.create_session(), self.loop
+                ).result()
+                atexit.register(self.close)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def create_session(self):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+            ),
+            timeout=self.timeout,
+        )
+
+    def close(self):
+        with self.lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+    async def fetch(
+        self, url: str, etag: Optional[str] = None, modified: Optional[str] = None
+    ):
+        """Conditionally fetch a feed
+
+        Return a dict with the status, the etag, modified and Cache-Control
+        values of the response, the url the feed is permanently redirected to
+        (None if it isn't) and the body, None if not modified. Raises
+        FetchError on error statuses and aiohttp/asyncio exceptions on
+        connection errors and timeouts.
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+        start_time = time.monotonic()
+        status = "error"
+        try:
+            result = await self.request(url, headers)
+            status = result["status"]
+            return result
+        except FetchError as e:
+            status = e.status
+            raise
+        finally:
+            metrics.FETCH_SECONDS.labels(status).observe(time.monotonic() - start_time)
+
+    async def request(self, url: str, headers: dict):
+        async with self.session.get(url, headers=headers) as resp:
+            if resp.status >= 400:
+                raise FetchError(url, resp.status, resp.headers.get("Retry-After"))
+            content = None if resp.status == 304 else await resp.read()
+            return {
+                "status": resp.status,
+                "etag": resp.headers.get("ETag"),
+                "modified": resp.headers.get("Last-Modified"),
+                "cache_control": resp.headers.get("Cache-Control"),
+                "moved_to": self.moved_to(resp),
+                # What feedparser needs to resolve relative links and decode the body
+                "headers": {
+                    "content-location": str(resp.url),
+                    "content-type": resp.headers.get("Content-Type", ""),
+                    "content-language": resp.headers.get("Content-Language", ""),
+                },
+                "content": content,
+            }
+
+    @staticmethod
+    def moved_to(resp):
+        """Url of a response reached only by permanent redirects, None if it
+        wasn't redirected or some redirect is temporary
+        """
+        if not resp.history or any(
+            redirect.status not in PERMANENT_REDIRECTS for redirect in resp.history
+        ):
+            return None
+        return str(resp.url)
+
+    async def fetch_many(self, feeds: List[dict]):
+        """Fetch feeds given as dicts with url, etag and modified concurrently
+
+        Return fetch results in the order of the feeds, with exceptions in
+        place of the failed fetches
+        """
+        return await asyncio.gather(
+            *(self.fetch(feed["url"], feed["etag"], feed["modified"]) for feed in feeds),
+            return_exceptions=True,
+        )
+
+    def fetch_all(self, feeds: List[dict]):
+        """Sync version of fetch_many"""
+        return self.run(self.fetch_many(feeds))
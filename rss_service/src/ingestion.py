@@ -0,0 +1,119 @@
+import atexit
+import logging
+import threading
+import time
+
+import metrics
+
+
+class UpdatesWriter:
+    """Write-behind buffer of the feed updates of an updater process
+
+    The updates (see db.DB.put_updates) of all the actor threads are written
+    in batches: every @flush_interval_sec by a background thread, or once
+    @max_feeds feeds or @max_entries entries are pending by the thread which
+    filled the buffer. A failed batch is written feed by feed, so that a bad
+    update fails alone. Updates are written at least once: a feed keeps its
+    update lease and schedule until its update is written, so the updates
+    lost with the process or failed to write are dispatched and fetched again
+    once their leases expire; the urls of the failed ones are passed to
+    @on_lost, if given. The background thread is started by the first update,
+    and close() (called at exit) writes the pending updates.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_feeds: int,
+        max_entries: int,
+        flush_interval_sec: float,
+        on_lost=None,
+    ):
+        self.db = db
+        self.max_feeds = max_feeds
+        self.max_entries = max_entries
+        self.flush_interval_sec = flush_interval_sec
+        self.on_lost = on_lost
+        # Feed url: update
+        self.pending = {}
+        self.pending_entries = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.closed = threading.Event()
+
+    def add(self, update: dict):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="updates-writer", daemon=True
+                )
+                self.thread.start()
+                atexit.register(self.close)
+            previous = self.pending.pop(update["feed_url"], None)
+            if previous is not None:
+                # Its lease is lost, but the entries are still new
+                self.pending_entries -= len(previous["entries"])
+                update = {**update, "entries": previous["entries"] + update["entries"]}
+            self.pending[update["feed_url"]] = update
+            self.pending_entries += len(update["entries"])
+            full = (
+                len(self.pending) >= self.max_feeds
+                or self.pending_entries >= self.max_entries
+            )
+        if full:
+            self.flush()
+
+    def take(self):
+        with self.lock:
+            updates = list(self.pending.values())
+            self.pending = {}
+            self.pending_entries = 0
+        return updates
+
+    def flush(self):
+        with self.flush_lock:
+            updates = self.take()
+            if not updates:
+                return
+            start_time = time.monotonic()
+            try:
+                inserted = self.db.put_updates(updates)
+            except Exception as e:
+                logging.error(f"Failed to write {len(updates)} feed updates: {e}")
+                inserted = self.write_one_by_one(updates)
+            metrics.UPDATE_STAGE_SECONDS.labels("write").observe(
+                time.monotonic() - start_time
+            )
+            metrics.WRITE_BATCH_FEEDS.observe(len(updates))
+            for update in updates:
+                if update["feed_url"] in inserted:
+                    count = inserted[update["feed_url"]]
+                    metrics.ENTRIES.labels("inserted").inc(count)
+                    metrics.ENTRIES.labels("deduplicated").inc(
+                        len(update["entries"]) - count
+                    )
+
+    def write_one_by_one(self, updates):
+        inserted = {}
+        lost = []
+        for update in updates:
+            try:
+                inserted.update(self.db.put_updates([update]))
+            except Exception as e:
+                logging.error(f"Failed to write an update of {update['feed_url']}: {e}")
+                lost.append(update["feed_url"])
+        if lost and self.on_lost is not None:
+            self.on_lost(lost)
+        return inserted
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval_sec):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Failed to flush feed updates: {e}")
+
+    def close(self):
+        self.closed.set()
+        self.flush()
@@ -0,0 +1,137 @@
+"""Database maintenance jobs
+
+Run `python3 jobs.py backfill-items` to convert the items stored as the entry
+JSON (before schema version 6) into the item columns,
+`python3 jobs.py reconcile-unread-counts` to fix the unread counts of the user
+feeds (counted for the first time after schema version 8), and
+`python3 jobs.py compact-items` to delete the items and the feeds beyond the
+retention limits (see db.py). With --repeat-sec the job is run again every
+that many seconds.
+"""
+import argparse
+import logging
+import os
+import time
+
+import db as db_handler
+import parsing
+
+BACKFILL_BATCH_SIZE = 500
+RECONCILE_BATCH_SIZE = 1000
+# Feeds checked and items deleted by a compaction statement, and feeds purged
+COMPACT_FEEDS_BATCH_SIZE = 100
+COMPACT_ITEMS_BATCH_SIZE = 1000
+PURGE_FEEDS_BATCH_SIZE = 100
+
+
+def convert_entry(entry: dict, published: int):
+    fingerprint = parsing.entry_fingerprint(entry, published)
+    return parsing.entry_record(entry, published, fingerprint)
+
+
+def backfill_items(db, batch_size: int = BACKFILL_BATCH_SIZE):
+    """Convert the entry JSON of all the items left into the item columns
+
+    Converted items which turn out to be duplicates are deleted.
+    Every batch is committed separately, so the job can be interrupted and
+    run again. Return the numbers of converted and deleted items.
+    """
+    total_converted, total_deleted = 0, 0
+    while True:
+        converted, deleted = db.backfill_items(batch_size, convert_entry)
+        if converted == 0 and deleted == 0:
+            break
+        total_converted += converted
+        total_deleted += deleted
+        logging.info(
+            f"Backfilled items: {total_converted} converted, "
+            f"{total_deleted} duplicates deleted"
+        )
+    return total_converted, total_deleted
+
+
+def reconcile_unread_counts(db, batch_size: int = RECONCILE_BATCH_SIZE):
+    """Recount the unread items of all the user feeds, fix the counts which drifted
+
+    Every batch is committed separately. Return the number of fixed counts.
+    """
+    total_fixed, after = 0, (0, 0)
+    while after is not None:
+        fixed, after = db.reconcile_unread_counts(after, batch_size)
+        total_fixed += fixed
+    logging.info(f"Reconciled unread counts: {total_fixed} fixed")
+    return total_fixed
+
+
+def compact_items(
+    db,
+    max_age_days: float = db_handler.RETENTION_MAX_AGE_DAYS,
+    max_items_per_feed: int = db_handler.RETENTION_MAX_ITEMS_PER_FEED,
+    purge_orphans: bool = db_handler.RETENTION_PURGE_ORPHANS,
+):
+    """Delete the items beyond the retention limits, then the feeds nobody
+    follows, 0 limits are no limits
+
+    Items are deleted in small batches, every one committed separately, so
+    that the job doesn't hold locks for long. Return the numbers of deleted
+    items and feeds.
+    """
+    published_before = (
+        int(time.time() - max_age_days * 24 * 3600) if max_age_days else None
+    )
+    total_deleted, after = 0, 0
+    while after is not None:
+        deleted, last = db.compact_items(
+            after,
+            COMPACT_FEEDS_BATCH_SIZE,
+            COMPACT_ITEMS_BATCH_SIZE,
+            published_before,
+            max_items_per_feed or None,
+            purge_orphans,
+        )
+        total_deleted += deleted
+        # A full batch may have left items of the same feeds
+        if deleted < COMPACT_ITEMS_BATCH_SIZE:
+            after = last
+    total_purged = 0
+    if purge_orphans:
+        while True:
+            purged = db.purge_orphan_feeds(PURGE_FEEDS_BATCH_SIZE)
+            total_purged += purged
+            if purged < PURGE_FEEDS_BATCH_SIZE:
+                break
+    logging.info(
+        f"Compacted items: {total_deleted} items and {total_purged} feeds deleted"
+    )
+    return total_deleted, total_purged
+
+
+JOBS = {
+    "backfill-items": backfill_items,
+    "reconcile-unread-counts": reconcile_unread_counts,
+    "compact-items": compact_items,
+}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="RSS reader maintenance jobs")
+    parser.add_argument("job", choices=sorted(JOBS))
+    parser.add_argument(
+        "--repeat-sec", type=float, help="Run the job again every that many seconds"
+    )
+    args = parser.parse_args()
+
+    db = db_handler.DB(
+        os.environ["DBHOST"],
+        os.environ["DBPORT"],
+        os.environ["DBUSER"],
+        os.environ["DBPASSWORD"],
+        create=True,
+    )
+    while True:
+        JOBS[args.job](db)
+        if args.repeat_sec is None:
+            break
+        time.sleep(args.repeat_sec)
+    db.close()
@@ -0,0 +1,178 @@
+"""Prometheus metrics of the service and the updater
+
+The service exposes them on /metrics. The dramatiq workers expose them through
+the dramatiq Prometheus middleware (port 9191), which collects the metrics of
+all the worker processes; for that PROMETHEUS_MULTIPROC_DIR has to be set
+before this module is imported (see docker-compose.yml). The dispatcher serves
+them on METRICS_PORT.
+"""
+import functools
+import inspect
+import time
+
+import prometheus_client
+
+REQUEST_SECONDS = prometheus_client.Histogram(
+    "rss_http_request_duration_seconds",
+    "Time spent handling API requests",
+    ["method", "route", "status"],
+)
+
+DB_METHOD_SECONDS = prometheus_client.Histogram(
+    "rss_db_method_seconds",
+    "Time spent in the DB backend methods",
+    ["backend", "method"],
+)
+DB_POOL_CHECKOUT_SECONDS = prometheus_client.Histogram(
+    "rss_db_pool_checkout_seconds",
+    "Time spent waiting for a connection from the pool",
+    ["backend"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+# Saturation of a pool is in_use / max
+DB_POOL_CONNECTIONS = prometheus_client.Gauge(
+    "rss_db_pool_connections",
+    "Connections of the pools in use and the maximum number of connections, "
+    "and threads waiting for a connection",
+    ["backend", "state"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_EVENTS = prometheus_client.Counter(
+    "rss_db_pool_events",
+    "Connections opened and closed by the pools, by the reason of closing "
+    "(broken, expired, pool closed), and checkout timeouts",
+    ["backend", "event"],
+)
+
+READ_MARKS = prometheus_client.Counter(
+    "rss_read_marks",
+    "Deferred read marks: queued, merged into a pending one, flushed to the "
+    "database, failed to flush (and retried), or written right away when too "
+    "many are pending",
+    ["result"],
+)
+
+UPDATE_STAGE_SECONDS = prometheus_client.Histogram(
+    "rss_update_stage_seconds",
+    "Time spent in the stages of batch feed updates",
+    ["stage"],
+)
+FETCH_SECONDS = prometheus_client.Histogram(
+    "rss_fetch_seconds",
+    "Time spent fetching a feed, by response status",
+    ["status"],
+)
+# The 304 ratio is not_modified / all
+FEED_FETCHES = prometheus_client.Counter(
+    "rss_feed_fetches",
+    "Fetched feeds: not modified (304), unchanged body, changed, throttled by "
+    "the host (429) or failed",
+    ["result"],
+)
+POSTPONED_UPDATES = prometheus_client.Counter(
+    "rss_postponed_updates",
+    "Feed updates put off by the per-host rate limits: by the dispatcher as "
+    "the host is busy, by the workers as the host is blocked or as it "
+    "throttled the fetch",
+    ["reason"],
+)
+WRITE_BATCH_FEEDS = prometheus_client.Histogram(
+    "rss_write_batch_feeds",
+    "Feed updates written to the database in a batch",
+    buckets=(1, 5, 10, 50, 100, 250, 500, 1000),
+)
+PARSE_SECONDS = prometheus_client.Histogram(
+    "rss_parse_seconds",
+    "Time spent parsing a feed body",
+)
+ENTRIES = prometheus_client.Counter(
+    "rss_entries",
+    "Entries of the parsed feeds: inserted, dropped as already stored by the "
+    "fingerprints cache or as older than the retention limit, or deduplicated "
+    "by the database",
+    ["result"],
+)
+FEED_URL_CHANGES = prometheus_client.Counter(
+    "rss_feed_url_changes",
+    "Feeds moved to the url they are permanently redirected to, and feeds "
+    "merged into a duplicate found by the redirect or by the same content",
+    ["change"],
+)
+UPDATE_LAG_SECONDS = prometheus_client.Histogram(
+    "rss_update_lag_seconds",
+    "Delay of the feed updates behind their schedule",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+UPDATE_INTERVAL_SECONDS = prometheus_client.Histogram(
+    "rss_update_interval_seconds",
+    "Time until the next update of the updated feeds, and until the retry of "
+    "the failed ones",
+    ["result"],
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600, 24 * 3600),
+)
+UPDATE_BACKLOG = prometheus_client.Gauge(
+    "rss_update_backlog",
+    "Feeds overdue for an update, by whether their update is in flight, and "
+    "update messages in the queues",
+    ["state"],
+)
+UPDATER_NODES = prometheus_client.Gauge(
+    "rss_updater_nodes",
+    "Live updater nodes sharing the feeds, as seen by this dispatcher",
+)
+UPDATER_SHARD_SHARE = prometheus_client.Gauge(
+    "rss_updater_shard_share",
+    "Part of the feeds dispatched by this dispatcher",
+)
+SHARD_REBALANCES = prometheus_client.Counter(
+    "rss_shard_rebalances",
+    "Changes of the updater nodes seen by this dispatcher",
+)
+
+
+def timed(method, histogram):
+    """Wrap a sync or async function to observe its run time into @histogram"""
+    if inspect.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start_time = time.monotonic()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - start_time)
+
+    else:
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start_time = time.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - start_time)
+
+    return wrapper
+
+
+def time_db_methods(backend: str, untimed=()):
+    """Class decorator timing the public methods of a DB backend
+
+    The (async) generator methods, which stream results, are not timed, as
+    their time depends on the consumer; neither are the methods in @untimed
+    """
+
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if (
+                name.startswith("_")
+                or name in untimed
+                or not inspect.isfunction(method)
+                or inspect.isgeneratorfunction(method)
+                or inspect.isasyncgenfunction(method)
+            ):
+                continue
+            setattr(cls, name, timed(method, DB_METHOD_SECONDS.labels(backend, name)))
+        return cls
+
+    return decorate
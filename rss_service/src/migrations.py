@@ -0,0 +1,554 @@
+"""Versioned database schema migrations
+
+Every migration is a list of statements applied once, in the order of
+MIGRATIONS; applied versions are recorded in the SchemaVersions table.
+Migrations are historical records: never edit an applied migration,
+add a new one instead.
+
+Run `python3 migrations.py` to apply pending migrations (the service also does
+it on startup) and `python3 migrations.py --check-plans` to check that the hot
+queries are served by the expected indexes.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import queries
+
+# Arbitrary key for the advisory lock which serializes concurrent migrations
+MIGRATIONS_LOCK_KEY = 0x55C0DE
+# FeedItems is split into this many partitions by the feed id hash
+FEED_ITEMS_PARTITIONS = 16
+FEED_ITEMS_COLUMNS = (
+    "item_id, feed_id, published, entry, fingerprint, "
+    "guid, title, link, author, summary, content"
+)
+
+MIGRATIONS = [
+    (
+        1,
+        "Initial schema",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS Feeds (
+                feed_id SERIAL PRIMARY KEY,
+                feed_url VARCHAR(255) UNIQUE,
+                etag VARCHAR(255),
+                modified VARCHAR(255),
+                failed BOOLEAN DEFAULT false
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS FeedItems (
+                item_id SERIAL PRIMARY KEY,
+                feed_id INTEGER,
+                published INTEGER,
+                entry VARCHAR(65536),
+                FOREIGN KEY (feed_id) REFERENCES Feeds (feed_id),
+                UNIQUE(feed_id, published, entry)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS Users (
+                user_id SERIAL PRIMARY KEY,
+                username VARCHAR(255) UNIQUE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS UserFeeds (
+                user_feed_id SERIAL PRIMARY KEY,
+                user_id INTEGER,
+                feed_id INTEGER,
+                last_read_item_id INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES Users (user_id),
+                FOREIGN KEY (feed_id) REFERENCES Feeds (feed_id),
+                UNIQUE(user_id, feed_id)
+            )
+            """,
+        ],
+    ),
+    (
+        2,
+        "Deduplicate items by content hash, add indexes for the item listings",
+        [
+            # A b-tree over the whole entry is huge and slow to maintain
+            """
+            ALTER TABLE FeedItems
+            ADD COLUMN entry_hash UUID GENERATED ALWAYS AS (md5(entry)::uuid) STORED
+            """,
+            """
+            ALTER TABLE FeedItems
+            DROP CONSTRAINT IF EXISTS feeditems_feed_id_published_entry_key
+            """,
+            """
+            ALTER TABLE FeedItems ADD CONSTRAINT feeditems_dedup_key
+            UNIQUE (feed_id, published, entry_hash)
+            """,
+            # Items of a feed in the page order
+            """
+            CREATE INDEX feeditems_feed_published_idx
+            ON FeedItems (feed_id, published, item_id)
+            """,
+            # Unread items of a feed
+            """
+            CREATE INDEX feeditems_feed_item_idx
+            ON FeedItems (feed_id, item_id) INCLUDE (published)
+            """,
+            # Feeds followed by a user, including the read pointers so that
+            # the unread items lookup doesn't need to visit the table
+            """
+            CREATE UNIQUE INDEX userfeeds_user_feed_key
+            ON UserFeeds (user_id, feed_id) INCLUDE (last_read_item_id)
+            """,
+            """
+            ALTER TABLE UserFeeds
+            DROP CONSTRAINT IF EXISTS userfeeds_user_id_feed_id_key
+            """,
+            # Followers of a feed
+            "CREATE INDEX userfeeds_feed_idx ON UserFeeds (feed_id)",
+            "CREATE INDEX feeds_failed_idx ON Feeds (feed_id) WHERE failed",
+        ],
+    ),
+    (
+        3,
+        "Schedule feed updates in the database",
+        [
+            """
+            ALTER TABLE Feeds
+            ADD COLUMN next_update_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            ADD COLUMN fail_count INTEGER NOT NULL DEFAULT 0
+            """,
+            """
+            CREATE INDEX feeds_next_update_idx
+            ON Feeds (next_update_at) WHERE NOT failed
+            """,
+        ],
+    ),
+    (
+        4,
+        "Lease feed updates so that every feed has a single update chain",
+        [
+            """
+            CREATE TABLE FeedLeases (
+                feed_id INTEGER PRIMARY KEY REFERENCES Feeds (feed_id) ON DELETE CASCADE,
+                token UUID NOT NULL,
+                owner VARCHAR(255) NOT NULL,
+                acquired_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+            )
+            """,
+        ],
+    ),
+    (
+        5,
+        "Fingerprint feed items and bodies to skip unchanged ones on ingestion",
+        [
+            # Filled on ingestion, so NULL for the items stored before
+            "ALTER TABLE FeedItems ADD COLUMN fingerprint UUID",
+            "ALTER TABLE Feeds ADD COLUMN body_hash UUID",
+        ],
+    ),
+    (
+        6,
+        "Store items in columns instead of the entry JSON",
+        [
+            # The entry JSON of the items stored before is converted into the
+            # columns by the backfill job (see jobs.py)
+            """
+            ALTER TABLE FeedItems
+            ADD COLUMN guid TEXT,
+            ADD COLUMN title TEXT,
+            ADD COLUMN link TEXT,
+            ADD COLUMN author TEXT,
+            ADD COLUMN summary TEXT,
+            ADD COLUMN content BYTEA
+            """,
+            # Items are deduplicated by fingerprints now
+            """
+            DELETE FROM FeedItems USING FeedItems other
+            WHERE FeedItems.feed_id = other.feed_id
+                AND FeedItems.published = other.published
+                AND FeedItems.fingerprint = other.fingerprint
+                AND FeedItems.item_id > other.item_id
+            """,
+            """
+            ALTER TABLE FeedItems ADD CONSTRAINT feeditems_fingerprint_key
+            UNIQUE (feed_id, published, fingerprint)
+            """,
+            "ALTER TABLE FeedItems DROP CONSTRAINT feeditems_dedup_key",
+            "ALTER TABLE FeedItems DROP COLUMN entry_hash",
+            # Items left for the backfill job
+            """
+            CREATE INDEX feeditems_backfill_idx
+            ON FeedItems (item_id) WHERE entry IS NOT NULL
+            """,
+        ],
+    ),
+    (
+        7,
+        "Version users and feeds to validate cached responses",
+        [
+            # Bumped on every change of what the item listings of a user or a
+            # feed return (see queries.py)
+            "ALTER TABLE Users ADD COLUMN version BIGINT NOT NULL DEFAULT 0",
+            "ALTER TABLE Feeds ADD COLUMN version BIGINT NOT NULL DEFAULT 0",
+        ],
+    ),
+    (
+        8,
+        "Count unread items per user feed",
+        [
+            # Counted for the existing user feeds by
+            # `python3 jobs.py reconcile-unread-counts`
+            "ALTER TABLE UserFeeds ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0",
+        ],
+    ),
+    (
+        9,
+        "Keep what the polling intervals of the feeds are learned from",
+        [
+            # Updates in a row without new items, and the update interval the
+            # feed asks for by its ttl or sy:updatePeriod (see scheduling.py)
+            """
+            ALTER TABLE Feeds
+            ADD COLUMN unchanged_count INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN declared_interval_sec INTEGER
+            """,
+        ],
+    ),
+    (
+        10,
+        "Partition feed items by feed",
+        [
+            # Every feed is in a single partition, so the per-feed listings and
+            # the retention deletes (see jobs.py compact-items) touch a single
+            # small index and table; the indexes are built after the copy.
+            # The primary key has to include the partition key.
+            """
+            CREATE TABLE FeedItemsPartitioned (
+                item_id INTEGER NOT NULL DEFAULT nextval('feeditems_item_id_seq'),
+                feed_id INTEGER NOT NULL,
+                published INTEGER,
+                entry VARCHAR(65536),
+                fingerprint UUID,
+                guid TEXT,
+                title TEXT,
+                link TEXT,
+                author TEXT,
+                summary TEXT,
+                content BYTEA
+            ) PARTITION BY HASH (feed_id)
+            """,
+            *(
+                f"""
+                CREATE TABLE FeedItems_{i} PARTITION OF FeedItemsPartitioned
+                FOR VALUES WITH (MODULUS {FEED_ITEMS_PARTITIONS}, REMAINDER {i})
+                """
+                for i in range(FEED_ITEMS_PARTITIONS)
+            ),
+            f"""
+            INSERT INTO FeedItemsPartitioned ({FEED_ITEMS_COLUMNS})
+            SELECT {FEED_ITEMS_COLUMNS} FROM FeedItems
+            """,
+            "ALTER SEQUENCE feeditems_item_id_seq OWNED BY NONE",
+            "DROP TABLE FeedItems",
+            "ALTER TABLE FeedItemsPartitioned RENAME TO FeedItems",
+            "ALTER SEQUENCE feeditems_item_id_seq OWNED BY FeedItems.item_id",
+            # Also serves the unread items of a feed, instead of
+            # feeditems_feed_item_idx
+            """
+            ALTER TABLE FeedItems ADD CONSTRAINT feeditems_pkey
+            PRIMARY KEY (feed_id, item_id) INCLUDE (published)
+            """,
+            """
+            ALTER TABLE FeedItems ADD CONSTRAINT feeditems_fingerprint_key
+            UNIQUE (feed_id, published, fingerprint)
+            """,
+            """
+            ALTER TABLE FeedItems ADD CONSTRAINT feeditems_feed_id_fkey
+            FOREIGN KEY (feed_id) REFERENCES Feeds (feed_id)
+            """,
+            """
+            CREATE INDEX feeditems_feed_published_idx
+            ON FeedItems (feed_id, published, item_id)
+            """,
+            """
+            CREATE INDEX feeditems_backfill_idx
+            ON FeedItems (item_id) WHERE entry IS NOT NULL
+            """,
+            "ANALYZE FeedItems",
+        ],
+    ),
+    (
+        11,
+        "Add feed aliases and look up feeds by body hash",
+        [
+            # Other urls of the feeds: the urls followed before normalization,
+            # the urls permanently redirected from and the urls of the merged
+            # duplicates. An alias is never the url of a feed.
+            """
+            CREATE TABLE FeedAliases (
+                alias_url VARCHAR(255) PRIMARY KEY,
+                feed_id INTEGER NOT NULL REFERENCES Feeds (feed_id) ON DELETE CASCADE
+            )
+            """,
+            "CREATE INDEX feedaliases_feed_idx ON FeedAliases (feed_id)",
+            # Feeds with the same content are found by their body hash
+            "CREATE INDEX feeds_body_hash_idx ON Feeds (body_hash)",
+        ],
+    ),
+    (
+        12,
+        "Add updater nodes",
+        [
+            # Live dispatchers, which share the feeds (see sharding.py)
+            """
+            CREATE TABLE UpdaterNodes (
+                node_id VARCHAR(255) PRIMARY KEY,
+                started_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                heartbeat_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+            )
+            """,
+        ],
+    ),
+    (
+        13,
+        "Rate limit fetches per host",
+        [
+            # See RESERVE_HOST_FETCHES in queries.py
+            """
+            CREATE TABLE FetchHosts (
+                host VARCHAR(255) PRIMARY KEY,
+                next_fetch_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT '-infinity',
+                blocked_until TIMESTAMP WITH TIME ZONE
+            )
+            """,
+        ],
+    ),
+]
+
+FEED_ITEMS_INDEXES = {"feeditems_feed_published_idx", "feeditems_pkey"}
+# Users and feeds are looked up by name, then by id (given or looked up)
+USERS_INDEXES = {"users_username_key", "users_pkey"}
+FEEDS_INDEXES = {"feeds_feed_url_key", "feeds_pkey"}
+FEED_ALIASES_INDEXES = {"feedaliases_pkey"}
+
+# Hot queries with sample arguments and the indexes each table is expected
+# to be accessed by
+EXPECTED_PLANS = [
+    (
+        "feed items",
+        queries.GET_FEED_ITEMS,
+        ("user", "http://feed", False, None, None, 101, False, None, None, None),
+        {
+            "users": USERS_INDEXES,
+            "feeds": FEEDS_INDEXES,
+            "feedaliases": FEED_ALIASES_INDEXES,
+            "userfeeds": {"userfeeds_user_feed_key"},
+            "feeditems": {"feeditems_feed_published_idx"},
+        },
+    ),
+    (
+        "feed items by cached ids",
+        queries.GET_FEED_ITEMS,
+        ("user", "http://feed", False, None, None, 101, False, 1, 1, None),
+        {"users": {"users_pkey"}, "feeds": {"feeds_pkey"}},
+    ),
+    (
+        "unread feed items",
+        queries.GET_FEED_ITEMS,
+        ("user", "http://feed", True, None, None, 101, False, None, None, None),
+        {"feeditems": FEED_ITEMS_INDEXES},
+    ),
+    (
+        "feed items page",
+        queries.GET_FEED_ITEMS,
+        ("user", "http://feed", False, 1000, 1000, 101, False, 1, 1, None),
+        {"feeditems": {"feeditems_feed_published_idx"}},
+    ),
+    (
+        "all items",
+        queries.GET_ALL_ITEMS,
+        ("user", False, None, None, 101, False, None, None),
+        {
+            "users": USERS_INDEXES,
+            "userfeeds": {"userfeeds_user_feed_key"},
+            "feeditems": FEED_ITEMS_INDEXES,
+        },
+    ),
+    (
+        "all unread items",
+        queries.GET_ALL_ITEMS,
+        ("user", True, None, None, 101, False, 1, None),
+        {"userfeeds": {"userfeeds_user_feed_key"}, "feeditems": FEED_ITEMS_INDEXES},
+    ),
+    (
+        "due feeds",
+        queries.CLAIM_DUE_FEEDS,
+        (1000, 2, 60, "dispatcher", "{(0,1000000000]}"),
+        {"feeds": {"feeds_next_update_idx"}, "userfeeds": {"userfeeds_feed_idx"}},
+    ),
+    (
+        "mark as read",
+        queries.MARK_AS_READ,
+        ("user", "http://feed", 1000, None, None),
+        {
+            "users": USERS_INDEXES,
+            "feeds": FEEDS_INDEXES,
+            "feedaliases": FEED_ALIASES_INDEXES,
+            "userfeeds": {"userfeeds_user_feed_key"},
+        },
+    ),
+    (
+        "unread counts",
+        queries.UNREAD_COUNTS,
+        ("user", None),
+        {"users": USERS_INDEXES, "userfeeds": {"userfeeds_user_feed_key"}},
+    ),
+    (
+        # The batch is scanned by the (user_id, feed_id) key; the update looks
+        # the batch rows up by both columns, through either index. The feed_id
+        # index can't serve the batch scan by an index condition, so it would
+        # still be reported as scanned without an index.
+        "reconcile unread counts",
+        queries.RECONCILE_UNREAD_COUNTS,
+        (0, 0, 1000),
+        {
+            "userfeeds": {"userfeeds_user_feed_key", "userfeeds_feed_idx"},
+            "feeditems": FEED_ITEMS_INDEXES,
+        },
+    ),
+    (
+        "mark as read in bulk",
+        queries.MARK_AS_READ_BATCH,
+        (["user", "user"], ["http://feed", "http://feed2"], [1000, 1000]),
+        {
+            "users": USERS_INDEXES,
+            "feeds": FEEDS_INDEXES,
+            "feedaliases": FEED_ALIASES_INDEXES,
+            "userfeeds": {"userfeeds_user_feed_key"},
+        },
+    ),
+    (
+        "compact items",
+        queries.COMPACT_ITEMS,
+        (0, 100, 1000, 1600000000, 10000, True),
+        {
+            "feeds": {"feeds_pkey"},
+            "userfeeds": {"userfeeds_feed_idx"},
+            "feeditems": FEED_ITEMS_INDEXES,
+        },
+    ),
+]
+
+
+def migrate(cursor):
+    """Apply pending migrations, return the resulting schema version"""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS SchemaVersions (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+        )
+        """
+    )
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+    cursor.execute("SELECT COALESCE(max(version), 0) FROM SchemaVersions")
+    current_version = cursor.fetchone()[0]
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logging.info(f"Applying migration {version}: {description}")
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute(
+            "INSERT INTO SchemaVersions (version, description) VALUES (%s, %s)",
+            (version, description),
+        )
+        current_version = version
+    logging.info(f"Schema version: {current_version}")
+    return current_version
+
+
+def table_scans(plan):
+    """Yield (table, index name or None) for the scans in an EXPLAIN (FORMAT JSON) plan
+
+    Index scans without an index condition read the whole index, so they are
+    reported like sequential scans, with no index
+    """
+    # Data modifying nodes like Update have a relation name too
+    if "Relation Name" in plan and plan["Node Type"].endswith("Scan"):
+        index_scans = [plan]
+        if plan["Node Type"] == "Bitmap Heap Scan":
+            index_scans = plan["Plans"]
+        indexes = [scan.get("Index Name") for scan in index_scans if "Index Cond" in scan]
+        yield plan["Relation Name"], indexes[0] if indexes else None
+    for subplan in plan.get("Plans", []):
+        yield from table_scans(subplan)
+
+
+def check_query_plans(cursor):
+    """Check that the hot queries are served by the expected indexes
+
+    Sequential scans are disabled for the check, so that the result doesn't
+    depend on how much data is in the tables: on a small table the planner
+    rightly prefers a sequential scan. The plans still depend on the table
+    statistics though, so run it against a database with representative data.
+    Return a list of problems found.
+    """
+    import db as db_handler
+
+    problems = []
+    # Partitions and their indexes are reported by their parents
+    cursor.execute(
+        "SELECT inhrelid::regclass::text, inhparent::regclass::text FROM pg_inherits"
+    )
+    parents = dict(cursor.fetchall())
+    cursor.execute("SET LOCAL enable_seqscan = off")
+    for name, query, args, expected_indexes in EXPECTED_PLANS:
+        db_handler.execute(cursor, "EXPLAIN (FORMAT JSON) " + query, *args)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        for table, index in table_scans(plan[0]["Plan"]):
+            table, index = parents.get(table, table), parents.get(index, index)
+            if table in expected_indexes and index not in expected_indexes[table]:
+                problems.append(
+                    f"{name}: {table} is scanned "
+                    + (f"by index {index}" if index else "without an index")
+                    + f", expected one of {sorted(expected_indexes[table])}"
+                )
+    cursor.execute("RESET enable_seqscan")
+    return problems
+
+
+if __name__ == "__main__":
+    import db as db_handler
+
+    parser = argparse.ArgumentParser(description="RSS reader schema migrations")
+    parser.add_argument(
+        "--check-plans",
+        action="store_true",
+        help="Check that the hot queries use the expected indexes",
+    )
+    args = parser.parse_args()
+
+    db = db_handler.DB(
+        os.environ["DBHOST"],
+        os.environ["DBPORT"],
+        os.environ["DBUSER"],
+        os.environ["DBPASSWORD"],
+        create=True,
+    )
+    if args.check_plans:
+        with db.conn() as conn:
+            with conn.cursor() as cursor:
+                problems = check_query_plans(cursor)
+        for problem in problems:
+            logging.error(problem)
+        if problems:
+            sys.exit(1)
+        logging.info("All the hot queries use the expected indexes")
@@ -0,0 +1,57 @@
+import xml.etree.ElementTree as ElementTree
+
+
+class InvalidOpml(Exception):
+    def __init__(self, reason):
+        super().__init__(f"Invalid OPML document: {reason}")
+
+
+class FeedUrlsParser:
+    """Incremental parser of the feed urls of an OPML subscription list
+
+    The document is fed in chunks as it is received, and the feed urls (the
+    xmlUrl attributes of the outlines, at any depth of the category outlines)
+    are taken as the outlines are parsed; parsed elements are cleared, so the
+    whole document is never held in memory. Raises InvalidOpml on malformed
+    documents and on documents of more than @max_feeds feeds.
+    """
+
+    def __init__(self, max_feeds: int):
+        self.max_feeds = max_feeds
+        self.parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self.feed_urls = {}
+        self.root = None
+
+    def feed(self, chunk: bytes):
+        try:
+            self.parser.feed(chunk)
+            self.read_events()
+        except ElementTree.ParseError as e:
+            raise InvalidOpml(e)
+
+    def close(self):
+        """Finish parsing, return the unique feed urls in the document order"""
+        try:
+            self.parser.close()
+            self.read_events()
+        except ElementTree.ParseError as e:
+            raise InvalidOpml(e)
+        if self.root is None or self.root.tag != "opml":
+            raise InvalidOpml("no opml element")
+        return list(self.feed_urls)
+
+    def read_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                if self.root is None:
+                    self.root = element
+                continue
+            if element.tag == "outline":
+                # Some exporters lowercase the attribute
+                feed_url = element.get("xmlUrl") or element.get("xmlurl")
+                if feed_url:
+                    self.feed_urls[feed_url.strip()] = None
+                    if len(self.feed_urls) > self.max_feeds:
+                        raise InvalidOpml(f"more than {self.max_feeds} feeds")
+            # Only the elements being parsed are kept
+            element.clear()
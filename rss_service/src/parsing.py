@@ -0,0 +1,181 @@
+import concurrent.futures
+import feedparser
+import hashlib
+import io
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+import zlib
+from typing import FrozenSet, List, Optional
+
+import scheduling
+
+# A feed taking longer to parse is considered failed
+PARSE_TIMEOUT_SEC = 30
+CONTENT_COMPRESSION_LEVEL = 6
+
+
+# Entry fields identifying an entry and its version
+FINGERPRINT_FIELDS = ("id", "link", "published", "updated", "title", "summary")
+
+
+def entry_fingerprint(entry, published: int):
+    """Hash of the identity and the version of an entry, as a UUID string
+
+    Much cheaper to compute than the serialized entry
+    """
+    digest = hashlib.md5(str(published).encode())
+    for field in FINGERPRINT_FIELDS:
+        digest.update(b"\0" + str(entry.get(field, "")).encode())
+    for content in entry.get("content", []):
+        digest.update(b"\0" + str(content.get("value", "")).encode())
+    return str(uuid.UUID(bytes=digest.digest()))
+
+
+def entry_content(entry):
+    """The main content of an entry: the first HTML one, else the first one"""
+    contents = entry.get("content") or []
+    for content in contents:
+        if content.get("type") == "text/html":
+            return content.get("value")
+    return contents[0].get("value") if contents else None
+
+
+def entry_record(entry, published: int, fingerprint: str, undated: bool = False):
+    """Item record of an entry with the columns stored in FeedItems
+
+    Works on feedparser entries as well as on their JSON dumps. @undated
+    entries are published at the time they were first seen.
+    """
+    content = entry_content(entry)
+    return {
+        "published": published,
+        "fingerprint": fingerprint,
+        "undated": undated,
+        "guid": entry.get("id"),
+        "title": entry.get("title"),
+        "link": entry.get("link"),
+        "author": entry.get("author"),
+        "summary": entry.get("summary"),
+        "content": zlib.compress(content.encode(), CONTENT_COMPRESSION_LEVEL)
+        if content
+        else None,
+    }
+
+
+def parse_entries(content: bytes, headers: dict, known: FrozenSet[str] = frozenset()):
+    """Parse a feed body into the entry records stored by db.DB.put_updates
+
+    Entries with fingerprints in @known are already stored, so they are
+    skipped before building the records. Entries without a publish date are
+    published when they were updated, else when they are first seen. Return
+    {"entries": new entry records, "fingerprints": fingerprints of all the
+    entries of the feed, "declared_interval_sec": the update interval the feed
+    asks for (see scheduling.declared_interval_sec), "seconds": time spent
+    parsing}. Runs in the parse worker processes, so it only gets and returns
+    picklable values
+    """
+    start_time = time.monotonic()
+    feed = feedparser.parse(io.BytesIO(content), response_headers=headers)
+    entries = []
+    fingerprints = []
+    first_seen = int(time.time())
+    for entry in feed.entries:
+        published_parsed = entry.get("published_parsed") or entry.get("updated_parsed")
+        if published_parsed is not None:
+            published = int(time.mktime(published_parsed))
+            fingerprint = entry_fingerprint(entry, published)
+        else:
+            # The fingerprint must not change on every fetch, so it doesn't
+            # depend on the first seen time (see queries.PUT_UPDATES)
+            published = first_seen
+            fingerprint = entry_fingerprint(entry, 0)
+        fingerprints.append(fingerprint)
+        if fingerprint not in known:
+            entries.append(
+                entry_record(
+                    entry, published, fingerprint, undated=published_parsed is None
+                )
+            )
+    return {
+        "entries": entries,
+        "fingerprints": fingerprints,
+        "declared_interval_sec": scheduling.declared_interval_sec(feed.feed),
+        "seconds": time.monotonic() - start_time,
+    }
+
+
+class Parser:
+    """Parses fetched feeds in a pool of worker processes
+
+    feedparser is pure Python and holds the GIL, so parsing in the dramatiq
+    worker threads serializes them. With 0 workers the feeds are parsed in the
+    calling thread. The pool is started on the first parse and restarted if a
+    worker process dies.
+    """
+
+    def __init__(self, workers: int, timeout_sec: float = PARSE_TIMEOUT_SEC):
+        self.workers = workers
+        self.timeout_sec = timeout_sec
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # The workers are spawned rather than forked from a process
+                # running threads (dramatiq workers, the fetcher loop)
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self.pool
+
+    def reset_pool(self, pool):
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def parse_all(self, payloads: List[Optional[tuple]]):
+        """Parse payloads given as parse_entries arguments, None for unchanged feeds
+
+        Return parse_entries results in the order of the payloads, None for
+        the unchanged feeds and exceptions for the feeds failed to parse
+        """
+        if self.workers == 0:
+            results = []
+            for payload in payloads:
+                try:
+                    results.append(parse_entries(*payload) if payload else None)
+                except Exception as e:
+                    results.append(e)
+            return results
+        pool = self.get_pool()
+        futures = [
+            pool.submit(parse_entries, *payload) if payload else None
+            for payload in payloads
+        ]
+        deadline = time.monotonic() + self.timeout_sec
+        results = []
+        for future in futures:
+            if future is None:
+                results.append(None)
+                continue
+            try:
+                results.append(future.result(max(0, deadline - time.monotonic())))
+            except concurrent.futures.process.BrokenProcessPool as e:
+                logging.error("Parse worker died, restarting the parse pool")
+                self.reset_pool(pool)
+                results.append(e)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+                self.pool = None
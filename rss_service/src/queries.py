@@ -0,0 +1,1096 @@
+"""SQL statements shared by the sync (psycopg2) and async (asyncpg) DB backends
+
+Queries are written with asyncpg-style positional placeholders ($1, $2, ...);
+the sync backend converts them to the psycopg2 format (see db.to_pyformat).
+
+Every API operation is a single statement, so it takes a single round trip.
+Merging duplicate feeds (see FIND_MERGE_TARGET) is an exception: it
+takes a transaction of several statements, as both feeds must be locked
+before anything is moved, and all the parts of a single statement see the
+snapshot taken before the locks. It is not an API operation but a rare step
+of a feed update.
+Statements that look up a user or a feed by name return the looked up id
+(NULL when not found) along with the result, so that the caller can tell
+what is missing. The hot ones also take the ids when they are known (cached,
+see cache.IdCache), which saves the lookups by name: with the id given the
+lookup subquery in COALESCE is not run.
+
+Feeds are looked up by url among the feed urls, then among their aliases
+(FeedAliases): the urls the feeds were followed by before normalization,
+redirected from, or merged from (see FIND_MERGE_TARGET).
+
+Users and feeds have version counters, bumped by every change of what the
+listings of the user (follows, read items) or of the feed (items, failed
+status) return. The listings return the version of their result and take the
+version of a cached result: when it is still current, the items are not
+queried at all.
+"""
+
+INSERT_USER = """
+    INSERT INTO Users (username) VALUES ($1)
+    ON CONFLICT DO NOTHING
+    RETURNING user_id
+"""
+
+# Returns user id, whether the feed was created, whether the user started
+# following it and the feed id. $2 is the normalized url of the followed url
+# $3 (see db.canonical_feed_url). A feed known by url $3, or by alias $3 or
+# $2, is followed; otherwise a feed of url $2 is followed, with alias $3 if
+# that is different. The feed is upserted with DO UPDATE rather than DO
+# NOTHING so that it is returned even when it is inserted concurrently.
+FOLLOW_FEED = """
+    WITH u AS (
+        SELECT user_id FROM Users WHERE username = $1
+    ), known AS (
+        SELECT COALESCE(
+            (SELECT feed_id FROM Feeds WHERE feed_url = $3),
+            (SELECT feed_id FROM FeedAliases WHERE alias_url = $3),
+            (SELECT feed_id FROM FeedAliases WHERE alias_url = $2)
+        ) AS feed_id
+    ), f AS (
+        INSERT INTO Feeds (feed_url)
+        SELECT $2 FROM u, known WHERE known.feed_id IS NULL
+        ON CONFLICT (feed_url) DO UPDATE SET feed_url = EXCLUDED.feed_url
+        RETURNING feed_id, xmax = 0 AS created
+    ), feed AS (
+        SELECT feed_id, created FROM f
+        UNION ALL
+        SELECT feed_id, false FROM known WHERE feed_id IS NOT NULL
+    ), aliased AS (
+        INSERT INTO FeedAliases (alias_url, feed_id)
+        SELECT $3, feed_id FROM f WHERE $3 <> $2
+        ON CONFLICT DO NOTHING
+    ), uf AS (
+        INSERT INTO UserFeeds (user_id, feed_id, unread_count)
+        SELECT u.user_id, feed.feed_id,
+            (SELECT count(*) FROM FeedItems WHERE FeedItems.feed_id = feed.feed_id)
+        FROM u, feed
+        ON CONFLICT DO NOTHING
+        RETURNING user_id
+    ), bumped AS (
+        UPDATE Users SET version = version + 1
+        FROM uf WHERE Users.user_id = uf.user_id
+    )
+    SELECT
+        (SELECT user_id FROM u),
+        COALESCE((SELECT created FROM feed), false),
+        EXISTS (SELECT 1 FROM uf),
+        (SELECT feed_id FROM feed)
+"""
+
+# Returns user id and whether the feed was followed
+UNFOLLOW_FEED = """
+    WITH u AS (
+        SELECT user_id FROM Users WHERE username = $1
+    ), deleted AS (
+        DELETE FROM UserFeeds USING u
+        WHERE UserFeeds.user_id = u.user_id
+            AND UserFeeds.feed_id = COALESCE(
+                (SELECT feed_id FROM Feeds WHERE feed_url = $2),
+                (SELECT feed_id FROM FeedAliases WHERE alias_url = $2)
+            )
+        RETURNING UserFeeds.user_id
+    ), bumped AS (
+        UPDATE Users SET version = version + 1
+        FROM deleted WHERE Users.user_id = deleted.user_id
+    )
+    SELECT (SELECT user_id FROM u), EXISTS (SELECT 1 FROM deleted)
+"""
+
+# Bulk FOLLOW_FEED of urls $3 normalized to $2 (arrays of the same length,
+# without duplicate urls $3). The new feeds are upserted in the url order, so
+# that concurrent imports lock them in the same order. Returns a row per url
+# $3 with the user id, the url and whether the user started following it (by
+# the first of the urls of the same feed; the others are already followed), a
+# single row with NULL url when there are no urls, and no rows when the user
+# doesn't exist.
+FOLLOW_FEEDS = """
+    WITH u AS (
+        SELECT user_id FROM Users WHERE username = $1
+    ), urls AS (
+        SELECT given, canonical, COALESCE(
+            (SELECT feed_id FROM Feeds WHERE feed_url = given),
+            (SELECT feed_id FROM FeedAliases WHERE alias_url = given),
+            (SELECT feed_id FROM FeedAliases WHERE alias_url = canonical)
+        ) AS known_feed_id, n
+        FROM unnest($2::varchar[], $3::varchar[])
+            WITH ORDINALITY AS t (canonical, given, n)
+    ), f AS (
+        INSERT INTO Feeds (feed_url)
+        SELECT DISTINCT urls.canonical FROM u, urls
+        WHERE urls.known_feed_id IS NULL
+        ORDER BY urls.canonical
+        ON CONFLICT (feed_url) DO UPDATE SET feed_url = EXCLUDED.feed_url
+        RETURNING feed_id, feed_url
+    ), resolved AS (
+        SELECT urls.given, urls.n, COALESCE(urls.known_feed_id, f.feed_id) AS feed_id
+        FROM urls
+        LEFT JOIN f ON f.feed_url = urls.canonical AND urls.known_feed_id IS NULL
+    ), targets AS (
+        SELECT given, feed_id,
+            row_number() OVER (PARTITION BY feed_id ORDER BY n) = 1 AS first_url
+        FROM resolved
+    ), aliased AS (
+        INSERT INTO FeedAliases (alias_url, feed_id)
+        SELECT urls.given, f.feed_id
+        FROM urls JOIN f ON f.feed_url = urls.canonical
+        WHERE urls.known_feed_id IS NULL AND urls.given <> urls.canonical
+        ON CONFLICT DO NOTHING
+    ), uf AS (
+        INSERT INTO UserFeeds (user_id, feed_id, unread_count)
+        SELECT u.user_id, targets.feed_id, (
+            SELECT count(*) FROM FeedItems
+            WHERE FeedItems.feed_id = targets.feed_id
+        )
+        FROM u, targets
+        ON CONFLICT DO NOTHING
+        RETURNING feed_id
+    ), bumped AS (
+        UPDATE Users SET version = version + 1
+        FROM u WHERE Users.user_id = u.user_id AND EXISTS (SELECT 1 FROM uf)
+    )
+    SELECT u.user_id, targets.given, uf.feed_id IS NOT NULL AND targets.first_url
+    FROM u
+    LEFT JOIN targets ON true
+    LEFT JOIN uf ON uf.feed_id = targets.feed_id
+"""
+
+# Bulk UNFOLLOW_FEED of feeds $2 (an array of urls). Returns a row per
+# unfollowed feed with the user id and the url, a single row with NULL url
+# when none is, and no rows when the user doesn't exist.
+UNFOLLOW_FEEDS = """
+    WITH u AS (
+        SELECT user_id FROM Users WHERE username = $1
+    ), urls AS (
+        SELECT given, COALESCE(
+            (SELECT feed_id FROM Feeds WHERE feed_url = given),
+            (SELECT feed_id FROM FeedAliases WHERE alias_url = given)
+        ) AS feed_id
+        FROM unnest($2::varchar[]) AS given
+    ), deleted AS (
+        DELETE FROM UserFeeds USING u, urls
+        WHERE UserFeeds.user_id = u.user_id AND UserFeeds.feed_id = urls.feed_id
+        RETURNING urls.given
+    ), bumped AS (
+        UPDATE Users SET version = version + 1
+        FROM u WHERE Users.user_id = u.user_id AND EXISTS (SELECT 1 FROM deleted)
+    )
+    SELECT u.user_id, deleted.given FROM u LEFT JOIN deleted ON true
+"""
+
+# Returns a row per followed feed with the user id, the version of the list,
+# the feed url and id, or a single row with NULL feed url when the user follows
+# nothing or the list version is $3. $2 is the user id if known.
+LIST_FEEDS = """
+    SELECT u.user_id, concat_ws('.', u.user_id, u.version), Feeds.feed_url,
+        Feeds.feed_id
+    FROM Users u
+    LEFT JOIN UserFeeds ON UserFeeds.user_id = u.user_id
+        AND concat_ws('.', u.user_id, u.version) IS DISTINCT FROM $3
+    LEFT JOIN Feeds ON Feeds.feed_id = UserFeeds.feed_id
+    WHERE u.user_id = COALESCE(
+        $2::integer, (SELECT user_id FROM Users WHERE username = $1)
+    )
+"""
+
+# Returns a row per followed feed with the user id, the feed url and the number
+# of unread items of the feed, or a single row with NULL feed url when the user
+# follows nothing. $2 is the user id if known.
+UNREAD_COUNTS = """
+    SELECT u.user_id, Feeds.feed_url, UserFeeds.unread_count
+    FROM Users u
+    LEFT JOIN UserFeeds ON UserFeeds.user_id = u.user_id
+    LEFT JOIN Feeds ON Feeds.feed_id = UserFeeds.feed_id
+    WHERE u.user_id = COALESCE(
+        $2::integer, (SELECT user_id FROM Users WHERE username = $1)
+    )
+"""
+
+# The unread counts are kept up to date by the queries adding items and moving
+# the read pointers, but may drift, e.g. when items are committed out of the
+# item id order. The reconcile job recounts the unread items of the next batch
+# of $3 user feeds after user feed ($1, $2) in the (user_id, feed_id) order
+# and fixes the counts which are off, unless the count or the read pointer
+# changed meanwhile (then it is fixed by the next run). Returns the number of
+# fixed counts and the last user feed of the batch, no rows after the last one.
+RECONCILE_UNREAD_COUNTS = """
+    WITH batch AS (
+        SELECT user_id, feed_id, last_read_item_id, unread_count,
+            (
+                SELECT count(*) FROM FeedItems
+                WHERE FeedItems.feed_id = UserFeeds.feed_id
+                    AND FeedItems.item_id > COALESCE(UserFeeds.last_read_item_id, 0)
+            ) AS actual_count
+        FROM UserFeeds
+        WHERE (user_id, feed_id) > ($1, $2)
+        ORDER BY user_id, feed_id
+        LIMIT $3
+    ), fixed AS (
+        UPDATE UserFeeds SET unread_count = batch.actual_count
+        FROM batch
+        WHERE UserFeeds.user_id = batch.user_id
+            AND UserFeeds.feed_id = batch.feed_id
+            AND UserFeeds.unread_count = batch.unread_count
+            AND UserFeeds.last_read_item_id IS NOT DISTINCT FROM batch.last_read_item_id
+            AND batch.unread_count <> batch.actual_count
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM fixed), user_id, feed_id
+    FROM batch
+    ORDER BY user_id DESC, feed_id DESC
+    LIMIT 1
+"""
+
+GET_FEED_LAST_UPDATED = "SELECT etag, modified FROM Feeds WHERE feed_url = $1"
+
+LIST_ALL_FEEDS = "SELECT feed_url FROM Feeds"
+
+# Item listings return the user id, the failed status of the feeds and the
+# version of the listing, then the item columns: item id, published, guid, title, link, author, summary and
+# compressed content (NULL unless requested). The items come in the
+# (published, item_id) order, which is also the page cursor. The lateral
+# subquery is joined to at most a single row, so the nested loop keeps the
+# order of the items.
+# $3 is true to list unread items only, $4 and $5 are the cursor of the previous
+# page (NULL for the first page), $6 is the page size (NULL for no limit), $7 is
+# true to include the content, $8 and $9 are the user and feed ids if known
+# and $10 is the version of a cached listing, if any.
+# There is a single row with NULL item id when there are no items or the
+# version is $10, and no rows when the user doesn't exist. NULL feed id means
+# the user doesn't follow the feed.
+GET_FEED_ITEMS = """
+    SELECT u.user_id, UserFeeds.feed_id, Feeds.failed,
+        concat_ws('.', u.user_id, u.version, Feeds.feed_id, Feeds.version),
+        items.*
+    FROM Users u
+    LEFT JOIN Feeds ON Feeds.feed_id = COALESCE(
+        $9::integer,
+        (SELECT feed_id FROM Feeds WHERE feed_url = $2),
+        (SELECT feed_id FROM FeedAliases WHERE alias_url = $2)
+    )
+    LEFT JOIN UserFeeds
+        ON UserFeeds.user_id = u.user_id AND UserFeeds.feed_id = Feeds.feed_id
+    LEFT JOIN LATERAL (
+        SELECT item_id, published, guid, title, link, author, summary,
+            CASE WHEN $7 THEN content END
+        FROM FeedItems
+        WHERE feed_id = UserFeeds.feed_id
+            AND item_id > CASE WHEN $3 THEN UserFeeds.last_read_item_id ELSE 0 END
+            AND ($4::integer IS NULL OR (published, item_id) > ($4, $5))
+            AND concat_ws('.', u.user_id, u.version, Feeds.feed_id, Feeds.version)
+                IS DISTINCT FROM $10
+        ORDER BY published, item_id
+        LIMIT $6
+    ) items ON true
+    WHERE u.user_id = COALESCE(
+        $8::integer, (SELECT user_id FROM Users WHERE username = $1)
+    )
+"""
+
+# Same as GET_FEED_ITEMS for all the followed feeds; the failed status is the
+# list of failed feed urls. The version is made of the user version and the
+# sum of the versions of the followed feeds: the set of the feeds is fixed by
+# the user version, and feed versions only grow. These are computed in a
+# materialized CTE to make sure they are computed once rather than for every
+# item. $2 to $6 are as $3 to $7 in GET_FEED_ITEMS, $7 is the user id if known
+# and $8 is the version of a cached listing, if any.
+GET_ALL_ITEMS = """
+    WITH u AS MATERIALIZED (
+        SELECT user_id, ARRAY(
+            SELECT Feeds.feed_url FROM Feeds
+            JOIN UserFeeds ON Feeds.feed_id = UserFeeds.feed_id
+            WHERE UserFeeds.user_id = Users.user_id AND Feeds.failed = true
+        ) AS failed,
+        concat_ws('.', user_id, version, (
+            SELECT COALESCE(sum(Feeds.version), 0) FROM Feeds
+            JOIN UserFeeds ON Feeds.feed_id = UserFeeds.feed_id
+            WHERE UserFeeds.user_id = Users.user_id
+        )) AS version
+        FROM Users
+        WHERE user_id = COALESCE(
+            $7::integer, (SELECT user_id FROM Users WHERE username = $1)
+        )
+    )
+    SELECT u.user_id, u.failed, u.version, items.*
+    FROM u
+    LEFT JOIN LATERAL (
+        SELECT FeedItems.item_id, FeedItems.published, FeedItems.guid,
+            FeedItems.title, FeedItems.link, FeedItems.author, FeedItems.summary,
+            CASE WHEN $6 THEN FeedItems.content END
+        FROM UserFeeds
+        JOIN FeedItems ON UserFeeds.feed_id = FeedItems.feed_id
+        WHERE UserFeeds.user_id = u.user_id
+            AND FeedItems.item_id > CASE
+                WHEN $2 THEN UserFeeds.last_read_item_id ELSE 0
+            END
+            AND (
+                $3::integer IS NULL
+                OR (FeedItems.published, FeedItems.item_id) > ($3, $4)
+            )
+            AND u.version IS DISTINCT FROM $8
+        ORDER BY FeedItems.published, FeedItems.item_id
+        LIMIT $5
+    ) items ON true
+"""
+
+# Returns user id and feed id, feed id is NULL if the user doesn't follow the feed.
+# $4 and $5 are the user and feed ids if known. The read pointer never moves
+# back: marks older than the last read item change nothing, so that delayed or
+# reordered marks don't bring back read items.
+MARK_AS_READ = """
+    WITH u AS (
+        SELECT user_id FROM Users
+        WHERE user_id = COALESCE(
+            $4::integer, (SELECT user_id FROM Users WHERE username = $1)
+        )
+    ), uf AS (
+        SELECT UserFeeds.feed_id FROM UserFeeds, u
+        WHERE UserFeeds.user_id = u.user_id
+            AND UserFeeds.feed_id = COALESCE(
+                $5::integer,
+                (SELECT feed_id FROM Feeds WHERE feed_url = $2),
+                (SELECT feed_id FROM FeedAliases WHERE alias_url = $2)
+            )
+    ), updated AS (
+        UPDATE UserFeeds SET last_read_item_id = $3,
+            unread_count = (
+                SELECT count(*) FROM FeedItems
+                WHERE FeedItems.feed_id = uf.feed_id AND FeedItems.item_id > $3
+            )
+        FROM u, uf
+        WHERE UserFeeds.user_id = u.user_id AND UserFeeds.feed_id = uf.feed_id
+            AND COALESCE(UserFeeds.last_read_item_id, 0) < $3
+        RETURNING 1
+    ), bumped AS (
+        UPDATE Users SET version = version + 1
+        FROM u WHERE Users.user_id = u.user_id AND EXISTS (SELECT 1 FROM updated)
+    )
+    SELECT (SELECT user_id FROM u), (SELECT feed_id FROM uf)
+"""
+
+# Mark items as read in bulk: up to item ids $3 of feeds $2 for users $1
+# (arrays of the same length). Marks of the same user and feed are merged to
+# the greatest item id. Returns the marks with the user id and the feed id if
+# the feed is followed by the user, NULLs for unknown users and not followed
+# feeds.
+MARK_AS_READ_BATCH = """
+    WITH marks AS (
+        SELECT username, feed_url, max(item_id) AS item_id
+        FROM unnest($1::text[], $2::text[], $3::integer[])
+            AS m(username, feed_url, item_id)
+        GROUP BY username, feed_url
+    ), targets AS (
+        SELECT marks.*, Users.user_id, UserFeeds.feed_id
+        FROM marks
+        LEFT JOIN Users ON Users.username = marks.username
+        LEFT JOIN UserFeeds ON UserFeeds.user_id = Users.user_id
+            AND UserFeeds.feed_id = COALESCE(
+                (SELECT feed_id FROM Feeds WHERE feed_url = marks.feed_url),
+                (SELECT feed_id FROM FeedAliases WHERE alias_url = marks.feed_url)
+            )
+    ), updated AS (
+        UPDATE UserFeeds SET last_read_item_id = targets.item_id,
+            unread_count = (
+                SELECT count(*) FROM FeedItems
+                WHERE FeedItems.feed_id = targets.feed_id
+                    AND FeedItems.item_id > targets.item_id
+            )
+        FROM targets
+        WHERE UserFeeds.user_id = targets.user_id
+            AND UserFeeds.feed_id = targets.feed_id
+            AND COALESCE(UserFeeds.last_read_item_id, 0) < targets.item_id
+        RETURNING UserFeeds.user_id
+    ), bumped AS (
+        UPDATE Users SET version = version + 1
+        WHERE user_id IN (SELECT user_id FROM updated)
+    )
+    SELECT username, feed_url, user_id, feed_id FROM targets
+"""
+
+# Returns feed id and whether the feed was failed. A failed feed is scheduled
+# for an update right away.
+REQUEST_FEED_UPDATE = """
+    WITH f AS (
+        SELECT feed_id, failed FROM Feeds
+        WHERE feed_id = COALESCE(
+            (SELECT feed_id FROM Feeds WHERE feed_url = $1),
+            (SELECT feed_id FROM FeedAliases WHERE alias_url = $1)
+        )
+    ), updated AS (
+        UPDATE Feeds SET failed = false, fail_count = 0, next_update_at = now(),
+            version = version + 1
+        FROM f WHERE Feeds.feed_id = f.feed_id AND f.failed
+        RETURNING 1
+    )
+    SELECT (SELECT feed_id FROM f), EXISTS (SELECT 1 FROM updated)
+"""
+
+# Feed updates are scheduled by the next_update_at time of the feeds. Every
+# dispatched update holds a lease on the feed (a FeedLeases row), identified by
+# a random token, so that there is a single update in flight for every feed.
+# Feeds due within $2 seconds and not leased are claimed by the dispatcher in
+# batches of $1; the lease is owned by $4 and expires $3 seconds after the due
+# time: unless the update is started by then, the feed is considered lost and
+# is dispatched again. Feeds nobody follows are not updated. With several
+# dispatchers, each one claims the feeds whose id hashes are in its shard $5
+# (an int8multirange, see sharding.py), NULL for all the feeds.
+# Returns feed urls, lease tokens and the number of seconds until the feeds are due.
+CLAIM_DUE_FEEDS = """
+    WITH due AS (
+        SELECT Feeds.feed_id, Feeds.feed_url, Feeds.next_update_at FROM Feeds
+        LEFT JOIN FeedLeases ON FeedLeases.feed_id = Feeds.feed_id
+        WHERE NOT Feeds.failed
+            AND Feeds.next_update_at <= now() + make_interval(secs => $2)
+            AND (FeedLeases.expires_at IS NULL OR FeedLeases.expires_at < now())
+            AND EXISTS (SELECT 1 FROM UserFeeds WHERE UserFeeds.feed_id = Feeds.feed_id)
+            AND (
+                $5::int8multirange IS NULL
+                OR $5::int8multirange @> hashint4(Feeds.feed_id)::bigint
+            )
+        ORDER BY Feeds.next_update_at
+        LIMIT $1
+        FOR UPDATE OF Feeds SKIP LOCKED
+    ), leased AS (
+        INSERT INTO FeedLeases (feed_id, token, owner, expires_at)
+        SELECT feed_id, gen_random_uuid(), $4,
+            GREATEST(next_update_at, now()) + make_interval(secs => $3)
+        FROM due
+        ON CONFLICT (feed_id) DO UPDATE
+        SET token = EXCLUDED.token, owner = EXCLUDED.owner,
+            acquired_at = now(), expires_at = EXCLUDED.expires_at
+        WHERE FeedLeases.expires_at < now()
+        RETURNING feed_id, token
+    )
+    SELECT due.feed_url, leased.token::text,
+        GREATEST(0, extract(epoch FROM due.next_update_at - now()))::float
+    FROM due JOIN leased ON leased.feed_id = due.feed_id
+"""
+
+# Takes over the update leases of feeds $1 with tokens $2 for updates by $3,
+# which must be done within $4 seconds. Returns urls, etag, modified and body
+# hash of the feeds whose leases are not lost, with fingerprints of at most $6
+# latest items of the feeds whose $5 flag is set, the number of seconds the
+# updates are late and the feed ids, and what the next updates are scheduled
+# by: the failures and the updates without new items in a row, the declared
+# update interval and the publish times of at most $7 latest items.
+START_UPDATES = """
+    UPDATE FeedLeases
+    SET owner = $3, expires_at = now() + make_interval(secs => $4)
+    FROM Feeds, unnest($1::varchar[], $2::uuid[], $5::boolean[])
+        AS l (feed_url, token, load_fingerprints)
+    WHERE FeedLeases.feed_id = Feeds.feed_id
+        AND Feeds.feed_url = l.feed_url AND FeedLeases.token = l.token
+    RETURNING Feeds.feed_url, Feeds.etag, Feeds.modified, Feeds.body_hash::text,
+        CASE WHEN l.load_fingerprints THEN ARRAY(
+            SELECT fingerprint::text FROM FeedItems
+            WHERE FeedItems.feed_id = Feeds.feed_id AND fingerprint IS NOT NULL
+            ORDER BY item_id DESC
+            LIMIT $6
+        ) END,
+        GREATEST(0, extract(epoch FROM now() - Feeds.next_update_at))::float,
+        Feeds.feed_id, Feeds.fail_count, Feeds.unchanged_count,
+        Feeds.declared_interval_sec,
+        ARRAY(
+            SELECT published FROM FeedItems
+            WHERE FeedItems.feed_id = Feeds.feed_id
+            ORDER BY item_id DESC
+            LIMIT $7
+        )
+"""
+
+# Numbers of the feeds overdue for an update which are not leased (waiting for
+# the dispatcher) and which are (dispatched or being updated), of shard $1 as
+# in CLAIM_DUE_FEEDS
+COUNT_OVERDUE_FEEDS = """
+    SELECT
+        count(*) FILTER (
+            WHERE FeedLeases.expires_at IS NULL OR FeedLeases.expires_at < now()
+        ),
+        count(*) FILTER (WHERE FeedLeases.expires_at >= now())
+    FROM Feeds
+    LEFT JOIN FeedLeases ON FeedLeases.feed_id = Feeds.feed_id
+    WHERE NOT Feeds.failed
+        AND Feeds.next_update_at <= now()
+        AND EXISTS (SELECT 1 FROM UserFeeds WHERE UserFeeds.feed_id = Feeds.feed_id)
+        AND (
+            $1::int8multirange IS NULL
+            OR $1::int8multirange @> hashint4(Feeds.feed_id)::bigint
+        )
+"""
+
+# Dispatcher $1 heartbeats; dispatchers without a heartbeat for $2 seconds
+# are gone and deleted. Returns the ids of the live dispatchers.
+UPDATER_NODE_HEARTBEAT = """
+    WITH beat AS (
+        INSERT INTO UpdaterNodes (node_id) VALUES ($1)
+        ON CONFLICT (node_id) DO UPDATE SET heartbeat_at = now()
+    ), gone AS (
+        DELETE FROM UpdaterNodes
+        WHERE heartbeat_at < now() - make_interval(secs => $2) AND node_id <> $1
+        RETURNING node_id
+    )
+    SELECT node_id FROM UpdaterNodes
+    WHERE node_id NOT IN (SELECT node_id FROM gone)
+    UNION
+    SELECT $1
+"""
+
+# Dispatcher $1 stops, so that its feeds are taken over right away
+DELETE_UPDATER_NODE = "DELETE FROM UpdaterNodes WHERE node_id = $1"
+
+# Fetches of every host are rate limited for all the dispatchers and workers
+# by the generic cell rate algorithm, a token bucket kept as a single time per
+# host: next_fetch_at is when the host is free for another fetch at the rate
+# of one per $3 seconds, and after a pause up to $4 fetches may start at once.
+# Hosts which asked to back off are not fetched until blocked_until.
+# Hosts $1 must have been added with ADD_FETCH_HOSTS first, in the same
+# transaction, and $2 fetches of them are reserved, only the ones which start
+# within $5 seconds. Returns the hosts, the number of seconds until the first
+# reserved fetch (negative if it could have started already) and the numbers
+# of the reserved fetches, which follow each other every $3 seconds.
+RESERVE_HOST_FETCHES = """
+    WITH slots AS (
+        SELECT FetchHosts.host, wanted.fetches,
+            GREATEST(
+                FetchHosts.next_fetch_at,
+                FetchHosts.blocked_until,
+                now() - make_interval(secs => $3 * ($4 - 1))
+            ) AS first_at
+        FROM FetchHosts
+        JOIN unnest($1::varchar[], $2::integer[]) AS wanted (host, fetches)
+            ON wanted.host = FetchHosts.host
+        ORDER BY FetchHosts.host
+        FOR UPDATE OF FetchHosts
+    ), reserved AS (
+        SELECT host, first_at,
+            LEAST(
+                fetches,
+                GREATEST(
+                    0, floor((extract(epoch FROM now() - first_at) + $5) / $3) + 1
+                )
+            )::integer AS fetches
+        FROM slots
+    )
+    UPDATE FetchHosts
+    SET next_fetch_at = reserved.first_at + make_interval(secs => $3 * reserved.fetches)
+    FROM reserved
+    WHERE FetchHosts.host = reserved.host
+    RETURNING FetchHosts.host, extract(epoch FROM reserved.first_at - now())::float,
+        reserved.fetches
+"""
+ADD_FETCH_HOSTS = """
+    INSERT INTO FetchHosts (host) SELECT unnest($1::varchar[])
+    ON CONFLICT (host) DO NOTHING
+"""
+
+# Hosts $1 asked to back off (e.g. answered 429) for $2 seconds
+THROTTLE_HOSTS = """
+    INSERT INTO FetchHosts (host, blocked_until)
+    SELECT host, now() + make_interval(secs => sec)
+    FROM unnest($1::varchar[], $2::float8[]) AS t (host, sec)
+    ON CONFLICT (host) DO UPDATE
+    SET blocked_until = GREATEST(FetchHosts.blocked_until, EXCLUDED.blocked_until)
+"""
+
+# Which of hosts $1 are blocked (see THROTTLE_HOSTS), for how many seconds
+GET_BLOCKED_HOSTS = """
+    SELECT host, extract(epoch FROM blocked_until - now())::float FROM FetchHosts
+    WHERE host = ANY($1::varchar[]) AND blocked_until > now()
+"""
+
+# Update chains (leases) of feed $1, by its url or an alias, of all the feeds
+# when $1 is NULL
+LIST_UPDATE_CHAINS = """
+    SELECT Feeds.feed_url, FeedLeases.expires_at >= now(),
+        FeedLeases.owner, FeedLeases.acquired_at, FeedLeases.expires_at,
+        Feeds.next_update_at, Feeds.failed
+    FROM Feeds
+    LEFT JOIN FeedLeases ON FeedLeases.feed_id = Feeds.feed_id
+    WHERE $1::varchar IS NULL OR Feeds.feed_id = COALESCE(
+        (SELECT feed_id FROM Feeds WHERE feed_url = $1),
+        (SELECT feed_id FROM FeedAliases WHERE alias_url = $1)
+    )
+    ORDER BY Feeds.feed_id
+"""
+
+# Channel notified by PUT_UPDATES with the feed id when new items of a feed are
+# stored, once they are committed
+NEW_ITEMS_CHANNEL = "new_items"
+
+# Items of the updates stored by PUT_UPDATES are copied into this table first,
+# with the numbers of their updates. It is private to the connection and
+# emptied on commit.
+CREATE_STAGED_ITEMS = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS StagedItems (
+        update_no BIGINT NOT NULL,
+        published INTEGER,
+        fingerprint UUID,
+        guid TEXT,
+        title TEXT,
+        link TEXT,
+        author TEXT,
+        summary TEXT,
+        content BYTEA,
+        undated BOOLEAN NOT NULL DEFAULT false
+    ) ON COMMIT DELETE ROWS
+"""
+COPY_STAGED_ITEMS = """
+    COPY StagedItems (
+        update_no, published, fingerprint, guid, title, link, author, summary, content,
+        undated
+    ) FROM STDIN
+"""
+
+# Stores the updates of many feeds at once. The updates come as arrays of the
+# feed urls ($1), etag ($2), modified ($3), the times of the next updates in
+# epoch seconds ($4), lease tokens ($5), body hashes ($6), declared update
+# intervals ($7) and numbers of updates in a row without new items ($8), and
+# their items in StagedItems, numbered by the position of the update in the
+# arrays (from 1). The items are deduplicated by their fingerprints; the
+# fingerprints of undated items don't include their publish times, which are the
+# times they were first seen, so they are not stored again under any other
+# publish time. etag, modified, body hash and the declared update interval are
+# updated only when given. The update leases are released, the counts of updates
+# without new items are set and the next updates are scheduled; nothing is
+# scheduled for the feeds whose leases are lost, as other updates of them are
+# dispatched then. Feed versions are bumped when there are new items or the
+# feeds are no longer failed, lease or not, and the unread counts of the
+# followers grow by the new items. New items are notified on NEW_ITEMS_CHANNEL.
+# Returns the urls of the feeds found and the numbers of their new items.
+PUT_UPDATES = """
+    WITH updates AS (
+        SELECT Feeds.feed_id, u.*
+        FROM unnest(
+            $1::varchar[], $2::text[], $3::text[], $4::float8[], $5::uuid[],
+            $6::uuid[], $7::integer[], $8::integer[]
+        ) WITH ORDINALITY AS u (
+            feed_url, etag, modified, next_update_at, token, body_hash,
+            declared_interval_sec, unchanged_count, update_no
+        )
+        JOIN Feeds ON Feeds.feed_url = u.feed_url
+    ), inserted AS (
+        INSERT INTO FeedItems (
+            feed_id, published, fingerprint, guid, title, link, author, summary, content
+        )
+        SELECT DISTINCT ON (updates.feed_id, s.published, s.fingerprint)
+            updates.feed_id, s.published, s.fingerprint, s.guid, s.title, s.link,
+            s.author, s.summary, s.content
+        FROM StagedItems AS s
+        JOIN updates ON updates.update_no = s.update_no
+        WHERE NOT s.undated OR NOT EXISTS (
+            SELECT 1 FROM FeedItems
+            WHERE FeedItems.feed_id = updates.feed_id
+                AND FeedItems.fingerprint = s.fingerprint
+        )
+        ORDER BY updates.feed_id, s.published, s.fingerprint
+        ON CONFLICT ON CONSTRAINT feeditems_fingerprint_key DO NOTHING
+        RETURNING feed_id, item_id
+    ), counted AS (
+        UPDATE UserFeeds
+        SET unread_count = unread_count + unread.count
+        FROM (
+            SELECT UserFeeds.user_feed_id, count(*) FROM UserFeeds
+            JOIN inserted ON inserted.feed_id = UserFeeds.feed_id
+                AND inserted.item_id > COALESCE(UserFeeds.last_read_item_id, 0)
+            GROUP BY UserFeeds.user_feed_id
+        ) AS unread
+        WHERE UserFeeds.user_feed_id = unread.user_feed_id
+    ), released AS (
+        DELETE FROM FeedLeases USING updates
+        WHERE FeedLeases.feed_id = updates.feed_id AND FeedLeases.token = updates.token
+        RETURNING FeedLeases.feed_id
+    ), s AS (
+        SELECT updates.*,
+            updates.feed_id IN (SELECT feed_id FROM released) AS released,
+            updates.feed_id IN (SELECT feed_id FROM inserted) AS inserted
+        FROM updates
+    ), updated AS (
+        UPDATE Feeds
+        SET etag = CASE
+                WHEN s.released THEN COALESCE(s.etag, Feeds.etag) ELSE Feeds.etag
+            END,
+            modified = CASE
+                WHEN s.released THEN COALESCE(s.modified, Feeds.modified)
+                ELSE Feeds.modified
+            END,
+            body_hash = CASE
+                WHEN s.released THEN COALESCE(s.body_hash, Feeds.body_hash)
+                ELSE Feeds.body_hash
+            END,
+            declared_interval_sec = CASE
+                WHEN s.released
+                THEN COALESCE(s.declared_interval_sec, Feeds.declared_interval_sec)
+                ELSE Feeds.declared_interval_sec
+            END,
+            failed = failed AND NOT s.released,
+            fail_count = CASE WHEN s.released THEN 0 ELSE fail_count END,
+            unchanged_count = CASE
+                WHEN s.released THEN s.unchanged_count ELSE Feeds.unchanged_count
+            END,
+            next_update_at = CASE
+                WHEN s.released THEN to_timestamp(s.next_update_at)
+                ELSE Feeds.next_update_at
+            END,
+            version = version + (s.inserted OR (failed AND s.released))::integer
+        FROM s
+        WHERE Feeds.feed_id = s.feed_id AND (s.released OR s.inserted)
+    ), notified AS (
+        SELECT pg_notify('new_items', s.feed_id::text) FROM s WHERE s.inserted
+    )
+    SELECT s.feed_url, count(inserted.item_id), (SELECT count(*) FROM notified)
+    FROM s
+    LEFT JOIN inserted ON inserted.feed_id = s.feed_id
+    GROUP BY s.feed_url
+"""
+
+# After $2 failed updates in a row the feed is marked as failed, otherwise
+# the next update is scheduled in $3 seconds. Like in PUT_UPDATES, the lease
+# with token $4 is released.
+# Returns whether the feed is failed now.
+RECORD_FAILURE = """
+    WITH released AS (
+        DELETE FROM FeedLeases USING Feeds
+        WHERE FeedLeases.feed_id = Feeds.feed_id
+            AND Feeds.feed_url = $1 AND FeedLeases.token = $4::uuid
+        RETURNING FeedLeases.feed_id
+    )
+    UPDATE Feeds
+    SET fail_count = fail_count + 1,
+        failed = fail_count + 1 >= $2,
+        version = version + (NOT failed AND fail_count + 1 >= $2)::integer,
+        next_update_at = now() + make_interval(secs => $3)
+    FROM released
+    WHERE Feeds.feed_id = released.feed_id
+    RETURNING failed
+"""
+
+# Updates of feeds $1 with lease tokens $2 are put off for $3 seconds: the
+# next updates are scheduled then and the leases released, like in
+# RECORD_FAILURE but without counting a failure
+POSTPONE_UPDATES = """
+    WITH released AS (
+        DELETE FROM FeedLeases
+        USING Feeds, unnest($1::varchar[], $2::uuid[], $3::float8[])
+            AS p (feed_url, token, delay_sec)
+        WHERE FeedLeases.feed_id = Feeds.feed_id
+            AND Feeds.feed_url = p.feed_url AND FeedLeases.token = p.token
+        RETURNING FeedLeases.feed_id, p.delay_sec
+    )
+    UPDATE Feeds
+    SET next_update_at = now() + make_interval(secs => released.delay_sec)
+    FROM released
+    WHERE Feeds.feed_id = released.feed_id
+"""
+
+# A feed permanently redirected to url $3 is moved there while the update
+# lease with token $2 is held: $3 becomes the url of the feed and the old url
+# $1 an alias, unless $3 is the url or an alias of another feed (then the feeds
+# are merged, see FIND_MERGE_TARGET). The versions of the feed and of its
+# followers are bumped, as their listings show the url. Returns whether the
+# feed was moved and the id of the feed known by url $3, if any.
+MOVE_FEED = """
+    WITH f AS (
+        SELECT Feeds.feed_id FROM Feeds
+        JOIN FeedLeases ON FeedLeases.feed_id = Feeds.feed_id
+        WHERE Feeds.feed_url = $1 AND FeedLeases.token = $2::uuid
+    ), taken AS (
+        SELECT COALESCE(
+            (SELECT feed_id FROM Feeds WHERE feed_url = $3),
+            (SELECT feed_id FROM FeedAliases WHERE alias_url = $3)
+        ) AS feed_id
+    ), moved AS (
+        UPDATE Feeds SET feed_url = $3, version = version + 1
+        FROM f, taken
+        WHERE Feeds.feed_id = f.feed_id
+            AND (taken.feed_id IS NULL OR taken.feed_id = f.feed_id)
+        RETURNING Feeds.feed_id
+    ), bumped AS (
+        UPDATE Users SET version = version + 1
+        FROM UserFeeds, moved
+        WHERE UserFeeds.feed_id = moved.feed_id AND Users.user_id = UserFeeds.user_id
+    ), unaliased AS (
+        DELETE FROM FeedAliases USING moved
+        WHERE FeedAliases.alias_url = $3 AND FeedAliases.feed_id = moved.feed_id
+    ), aliased AS (
+        INSERT INTO FeedAliases (alias_url, feed_id)
+        SELECT $1, feed_id FROM moved
+    )
+    SELECT EXISTS (SELECT 1 FROM moved), (SELECT feed_id FROM taken)
+"""
+
+# Duplicate feeds are merged into one, the target: a feed redirected to the url
+# of another feed, or with the same content (body hash) as another feed. Of the
+# feeds with the same content, an https feed is kept over a plain http one,
+# then the oldest feed, and the merged feed must have the same items: the
+# target stores all of its new entries and of its items published since the
+# oldest item of the target, by the fingerprints alone (those of dated items
+# include the publish times, and undated items are published when each feed
+# first saw them). A merge can't be undone, so bodies which only happen to be
+# the same (placeholders) are not enough.
+# A merge takes a transaction of the statements below: the target is found and
+# both feeds are locked in the feed id order, then the followers and the
+# aliases of the merged feed are moved to the target and the merged feed is
+# deleted with its items. The items of the target are the same, so the read
+# pointers of the followers are moved to the latest target item matching an
+# item they have read (by the fingerprint).
+
+# Returns the id of feed $1 whose update lease with token $2 is held and the
+# id of the target: feed $3, or the first other feed with body hash $4 in the
+# order above which stores the entries with fingerprints $5. No rows when
+# there is nothing to merge.
+FIND_MERGE_TARGET = """
+    WITH f AS (
+        SELECT Feeds.feed_id, Feeds.feed_url NOT LIKE 'https:%' AS insecure
+        FROM Feeds
+        JOIN FeedLeases ON FeedLeases.feed_id = Feeds.feed_id
+        WHERE Feeds.feed_url = $1 AND FeedLeases.token = $2::uuid
+    )
+    SELECT f.feed_id, target.feed_id
+    FROM f
+    JOIN LATERAL (
+        SELECT feed_id FROM Feeds
+        WHERE feed_id = $3::integer AND feed_id <> f.feed_id
+        UNION ALL
+        (
+            SELECT t.feed_id FROM Feeds t
+            WHERE t.body_hash = $4::uuid
+                AND (t.feed_url NOT LIKE 'https:%', t.feed_id) < (f.insecure, f.feed_id)
+                AND NOT EXISTS (
+                    SELECT 1 FROM unnest($5::uuid[]) AS entry (fingerprint)
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM FeedItems
+                        WHERE FeedItems.feed_id = t.feed_id
+                            AND FeedItems.fingerprint = entry.fingerprint
+                    )
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM FeedItems merged
+                    WHERE merged.feed_id = f.feed_id
+                        AND merged.published >= (
+                            SELECT min(published) FROM FeedItems
+                            WHERE FeedItems.feed_id = t.feed_id
+                        )
+                        AND NOT EXISTS (
+                            SELECT 1 FROM FeedItems
+                            WHERE FeedItems.feed_id = t.feed_id
+                                AND FeedItems.fingerprint = merged.fingerprint
+                        )
+                )
+            ORDER BY t.feed_url NOT LIKE 'https:%', t.feed_id
+            LIMIT 1
+        )
+        LIMIT 1
+    ) target ON true
+"""
+
+# Locks feeds $1 (an array of ids); returns their ids and urls
+LOCK_FEEDS = """
+    SELECT feed_id, feed_url FROM Feeds
+    WHERE feed_id = ANY($1::integer[])
+    ORDER BY feed_id
+    FOR UPDATE
+"""
+
+# Moves the followers of feed $1 to feed $2, except for the users following
+# both, and bumps their versions
+MOVE_FOLLOWERS = """
+    WITH moved AS (
+        INSERT INTO UserFeeds (user_id, feed_id, last_read_item_id, unread_count)
+        SELECT UserFeeds.user_id, $2, pointer.item_id, (
+            SELECT count(*) FROM FeedItems
+            WHERE FeedItems.feed_id = $2 AND FeedItems.item_id > pointer.item_id
+        )
+        FROM UserFeeds
+        CROSS JOIN LATERAL (
+            SELECT COALESCE(max(target.item_id), 0) AS item_id
+            FROM FeedItems merged
+            JOIN FeedItems target ON target.feed_id = $2
+                AND target.published = merged.published
+                AND target.fingerprint = merged.fingerprint
+            WHERE merged.feed_id = $1
+                AND merged.item_id <= COALESCE(UserFeeds.last_read_item_id, 0)
+        ) pointer
+        WHERE UserFeeds.feed_id = $1
+        ON CONFLICT DO NOTHING
+    ), deleted AS (
+        DELETE FROM UserFeeds WHERE feed_id = $1
+        RETURNING user_id
+    )
+    UPDATE Users SET version = version + 1
+    FROM deleted WHERE Users.user_id = deleted.user_id
+"""
+
+# Makes url $3 and the aliases of feed $1 aliases of feed $2 and notifies
+# them on FEEDS_PURGED_CHANNEL
+MOVE_ALIASES = """
+    WITH moved AS (
+        INSERT INTO FeedAliases (alias_url, feed_id)
+        SELECT alias_url, $2 FROM FeedAliases WHERE feed_id = $1
+        UNION ALL
+        SELECT $3, $2
+        ON CONFLICT (alias_url) DO UPDATE SET feed_id = EXCLUDED.feed_id
+        RETURNING alias_url
+    )
+    SELECT count(pg_notify('feeds_purged', alias_url)) FROM moved
+"""
+
+# Deletes feed $1 with its items
+DELETE_FEED = """
+    WITH items AS (
+        DELETE FROM FeedItems WHERE feed_id = $1
+    )
+    DELETE FROM Feeds WHERE feed_id = $1
+"""
+
+# The backfill job converts the entry JSON of the items stored before the item
+# columns. Takes the next batch of $1 items to convert.
+GET_ITEMS_TO_BACKFILL = """
+    SELECT item_id, feed_id, published, entry FROM FeedItems
+    WHERE entry IS NOT NULL
+    ORDER BY item_id
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+"""
+
+# Fills the item columns of items $1 from the arrays $2 to $9 (the columns of
+# StagedItems) and drops the entry JSON. Items $10 are duplicates and are
+# deleted, as are the items which turn out to duplicate already stored ones.
+# Bumps the versions of the feeds of the items.
+# Returns the numbers of converted and deleted items.
+BACKFILL_ITEMS = """
+    WITH c AS (
+        SELECT c.*, FeedItems.feed_id,
+            EXISTS (
+                SELECT 1 FROM FeedItems other
+                WHERE other.feed_id = FeedItems.feed_id
+                    AND other.published = c.published
+                    AND other.fingerprint = c.fingerprint
+                    AND other.item_id <> c.item_id
+            ) OR c.item_id = ANY($10) AS duplicate
+        FROM unnest(
+            $1::integer[], $2::integer[], $3::uuid[], $4::text[], $5::text[],
+            $6::text[], $7::text[], $8::text[], $9::bytea[]
+        ) AS c (item_id, published, fingerprint, guid, title, link, author, summary, content)
+        JOIN FeedItems ON FeedItems.item_id = c.item_id AND FeedItems.entry IS NOT NULL
+    ), deleted AS (
+        DELETE FROM FeedItems USING c
+        WHERE FeedItems.feed_id = c.feed_id AND FeedItems.item_id = c.item_id
+            AND c.duplicate
+        RETURNING 1
+    ), converted AS (
+        UPDATE FeedItems
+        SET fingerprint = c.fingerprint, guid = c.guid, title = c.title,
+            link = c.link, author = c.author, summary = c.summary,
+            content = c.content, entry = NULL
+        FROM c
+        WHERE FeedItems.feed_id = c.feed_id AND FeedItems.item_id = c.item_id
+            AND NOT c.duplicate
+        RETURNING 1
+    ), bumped AS (
+        UPDATE Feeds SET version = version + 1
+        WHERE feed_id IN (SELECT feed_id FROM c)
+    )
+    SELECT (SELECT count(*) FROM converted), (SELECT count(*) FROM deleted)
+"""
+
+# Channel notified with the urls and the aliases of the feeds purged by
+# PURGE_ORPHAN_FEEDS or merged into other feeds (MOVE_ALIASES), so that their
+# ids are no longer cached
+FEEDS_PURGED_CHANNEL = "feeds_purged"
+
+# The compaction job deletes the items beyond the retention limits of the next
+# batch of $2 feeds after feed $1: the items published before $4 (epoch
+# seconds), all but the latest $5 items of every feed in the listing order and
+# all the items of the feeds nobody follows if $6 is set; $4 and $5 are NULL
+# for no limit. At most $3 items are deleted at once. The unread counts of the
+# followers shrink by the deleted unread items, and the versions of the feeds
+# are bumped. Returns the number of deleted items and the last feed of the
+# batch, NULL after the last one. The doomed items are looked up feed by feed
+# and deleted by id arrays (item ids come from one sequence, so they are
+# unique across the feeds), which keeps every step on the feed_id indexes
+# whatever the row estimates of the batch are.
+COMPACT_ITEMS = """
+    WITH f AS (
+        SELECT Feeds.feed_id, $6 AND follower.user_id IS NULL AS orphan
+        FROM Feeds
+        LEFT JOIN LATERAL (
+            SELECT user_id FROM UserFeeds
+            WHERE UserFeeds.feed_id = Feeds.feed_id
+            LIMIT 1
+        ) follower ON true
+        WHERE Feeds.feed_id > $1
+        ORDER BY Feeds.feed_id
+        LIMIT $2
+    ), doomed AS (
+        SELECT f.feed_id, items.item_id
+        FROM f
+        LEFT JOIN LATERAL (
+            SELECT published, item_id FROM FeedItems
+            WHERE FeedItems.feed_id = f.feed_id
+            ORDER BY published DESC, item_id DESC
+            OFFSET $5 - 1
+            LIMIT 1
+        ) oldest_kept ON $5::integer IS NOT NULL AND NOT f.orphan
+        CROSS JOIN LATERAL (
+            SELECT item_id FROM FeedItems
+            WHERE FeedItems.feed_id = f.feed_id
+                AND (
+                    f.orphan
+                    OR FeedItems.published < $4
+                    OR (FeedItems.published, FeedItems.item_id)
+                        < (oldest_kept.published, oldest_kept.item_id)
+                )
+            LIMIT $3
+        ) items
+        LIMIT $3
+    ), deleted AS (
+        DELETE FROM FeedItems
+        WHERE feed_id = ANY(ARRAY(SELECT DISTINCT feed_id FROM doomed))
+            AND item_id = ANY(ARRAY(SELECT item_id FROM doomed))
+        RETURNING feed_id, item_id
+    ), counted AS (
+        UPDATE UserFeeds
+        SET unread_count = GREATEST(0, unread_count - (
+            SELECT count(*) FROM deleted
+            WHERE deleted.feed_id = UserFeeds.feed_id
+                AND deleted.item_id > COALESCE(UserFeeds.last_read_item_id, 0)
+        ))
+        WHERE UserFeeds.feed_id = ANY(ARRAY(SELECT DISTINCT feed_id FROM deleted))
+    ), bumped AS (
+        UPDATE Feeds SET version = version + 1
+        WHERE feed_id = ANY(ARRAY(SELECT DISTINCT feed_id FROM deleted))
+    )
+    SELECT (SELECT count(*) FROM deleted), max(feed_id) FROM f
+"""
+
+# Deletes at most $1 feeds nobody follows which have no items left (deleted by
+# COMPACT_ITEMS before) and notifies them on FEEDS_PURGED_CHANNEL. Feeds being
+# followed concurrently are locked by the foreign key checks of FOLLOW_FEED and
+# skipped; a follow which looked a feed up right before it was purged fails its
+# foreign key check and is run again (see db.DB.fetch_follow). Returns the
+# number of purged feeds.
+PURGE_ORPHAN_FEEDS = """
+    WITH orphans AS (
+        SELECT feed_id FROM Feeds
+        WHERE NOT EXISTS (
+                SELECT 1 FROM UserFeeds WHERE UserFeeds.feed_id = Feeds.feed_id
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM FeedItems WHERE FeedItems.feed_id = Feeds.feed_id
+            )
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ), purged AS (
+        DELETE FROM Feeds USING orphans
+        WHERE Feeds.feed_id = orphans.feed_id
+        RETURNING Feeds.feed_id, Feeds.feed_url
+    ), notified AS (
+        SELECT pg_notify('feeds_purged', url) FROM (
+            SELECT feed_url AS url FROM purged
+            UNION ALL
+            SELECT FeedAliases.alias_url FROM FeedAliases
+            JOIN purged ON purged.feed_id = FeedAliases.feed_id
+        ) urls
+    )
+    SELECT (SELECT count(*) FROM purged), (SELECT count(*) FROM notified)
+"""
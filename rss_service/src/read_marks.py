@@ -0,0 +1,102 @@
+import asyncio
+import logging
+
+import metrics
+
+# When flushes fall behind (or fail) and this many times the flush size of user
+# feeds are pending, new marks are written right away instead of queued
+MAX_PENDING_FACTOR = 4
+
+
+def log_dropped(result):
+    """Log the marks of a mark_as_read_batch result which weren't written"""
+    for username in result["users_not_found"]:
+        logging.warning(f"Read marks dropped, no user found: {username}")
+    for username, feed_url in result["feeds_not_found"]:
+        logging.warning(
+            f"Read mark dropped, feed not followed by {username}: {feed_url}"
+        )
+
+
+class ReadMarksBuffer:
+    """Write-behind buffer of read marks for the service
+
+    Marks are merged per user and feed to the greatest item id and written in
+    batches by mark_as_read_batch every @flush_interval_sec, or once
+    @max_size user feeds are pending. Marks of a failed flush are merged back
+    and retried with the next one; since the read pointers never move back,
+    merging and reordering marks is safe. Marks of other user feeds are
+    written right away once MAX_PENDING_FACTOR * @max_size are pending, so
+    that the callers wait for the database rather than the buffer growing
+    without bound. start() must be called from the running event loop, and
+    close() flushes the pending marks.
+    """
+
+    def __init__(self, db, max_size: int, flush_interval_sec: float):
+        self.db = db
+        self.max_size = max_size
+        self.flush_interval_sec = flush_interval_sec
+        # (username, feed url): item id
+        self.pending = {}
+        self.flush_lock = asyncio.Lock()
+        self.task = None
+        # Flushes started when the buffer fills up
+        self.flushes = set()
+
+    async def add(self, username: str, feed_url: str, item_id: int):
+        key = (username, feed_url)
+        if key in self.pending:
+            metrics.READ_MARKS.labels("merged").inc()
+            item_id = max(item_id, self.pending[key])
+        elif len(self.pending) >= MAX_PENDING_FACTOR * self.max_size:
+            result = await self.db.mark_as_read_batch([(username, feed_url, item_id)])
+            metrics.READ_MARKS.labels("written").inc()
+            log_dropped(result)
+            return
+        else:
+            metrics.READ_MARKS.labels("queued").inc()
+        self.pending[key] = item_id
+        if len(self.pending) >= self.max_size and not self.flushes:
+            flush = asyncio.create_task(self.flush())
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+
+    def merge(self, marks):
+        for key, item_id in marks.items():
+            self.pending[key] = max(item_id, self.pending.get(key, item_id))
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            marks, self.pending = self.pending, {}
+            try:
+                result = await self.db.mark_as_read_batch(
+                    [(*key, item_id) for key, item_id in marks.items()]
+                )
+            except Exception as e:
+                logging.error(f"Failed to write {len(marks)} read marks: {e}")
+                metrics.READ_MARKS.labels("failed").inc(len(marks))
+                self.merge(marks)
+                return
+        metrics.READ_MARKS.labels("flushed").inc(len(marks))
+        log_dropped(result)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_sec)
+            await self.flush()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            # Not in the middle of a flush, which would lose the marks taken
+            async with self.flush_lock:
+                self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
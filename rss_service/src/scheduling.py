@@ -0,0 +1,155 @@
+import email.utils
+import random
+import re
+import time
+from typing import List, Optional
+
+# Feeds are polled within these bounds, whatever they publish or declare
+MIN_INTERVAL_SEC = 60
+MAX_INTERVAL_SEC = 24 * 3600
+# Publish times of this many latest items of a feed are used to learn its rate
+PUBLISH_HISTORY = 20
+# A feed is polled this many times per expected new item
+POLLS_PER_ITEM = 2
+# The interval grows by this factor with every update in a row without new
+# items (304, unchanged body or nothing new in it)
+UNCHANGED_BACKOFF = 1.5
+# Failed updates are retried in RETRY_BACKOFF ^ (failures - 1) minimum
+# intervals, randomized down to half of that
+RETRY_BACKOFF = 2
+
+# sy:updatePeriod values of the RSS syndication module
+UPDATE_PERIODS_SEC = {
+    "hourly": 3600,
+    "daily": 24 * 3600,
+    "weekly": 7 * 24 * 3600,
+    "monthly": 30 * 24 * 3600,
+    "yearly": 365 * 24 * 3600,
+}
+
+
+def max_age_sec(cache_control: Optional[str]):
+    """max-age of a Cache-Control header, None if absent or not cacheable"""
+    if not cache_control:
+        return None
+    directives = [d.strip().lower() for d in cache_control.split(",")]
+    if "no-cache" in directives or "no-store" in directives:
+        return None
+    for directive in directives:
+        match = re.fullmatch(r"max-age\s*=\s*\"?(\d+)\"?", directive)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def retry_after_sec(retry_after: Optional[str], now: Optional[float] = None):
+    """Seconds to wait by a Retry-After header, given as seconds or as an HTTP
+    date, None if absent or invalid
+    """
+    if not retry_after:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return int(retry_after)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0, retry_at.timestamp() - (time.time() if now is None else now))
+
+
+def declared_interval_sec(feed: dict):
+    """Update interval a parsed feed asks for by its RSS ttl (minutes) or
+    sy:updatePeriod / sy:updateFrequency, None if it doesn't
+    """
+    try:
+        ttl = int(feed.get("ttl", ""))
+        if ttl > 0:
+            return ttl * 60
+    except ValueError:
+        pass
+    period = UPDATE_PERIODS_SEC.get(str(feed.get("sy_updateperiod", "")).strip())
+    if period is None:
+        return None
+    try:
+        frequency = max(1, int(feed.get("sy_updatefrequency", 1)))
+    except ValueError:
+        frequency = 1
+    return period // frequency
+
+
+def publish_gap_sec(published: List[int], now: float):
+    """Expected time between new items of a feed from the publish times of its
+    latest items, None if there are none
+
+    That is the mean gap between the items, but at least the time since the
+    latest one, so that feeds which stopped publishing slow down
+    """
+    if not published:
+        return None
+    published = sorted(published)
+    since_latest = max(0, now - published[-1])
+    if len(published) < 2:
+        return since_latest
+    mean_gap = (published[-1] - published[0]) / (len(published) - 1)
+    return max(mean_gap, since_latest)
+
+
+class PollingPolicy:
+    """Chooses when every feed is updated next
+
+    A feed is polled POLLS_PER_ITEM times per item it is expected to publish,
+    learned from the publish times of its latest items, and less often with
+    every update in a row without new items. The publisher's hints (the
+    Cache-Control max-age of the response, the ttl or the syndication module
+    period of the feed) are respected as the lower bound of the interval
+    unless the feed is seen to publish more often than that. Failed updates
+    are retried with exponential backoff and jitter, so that failures of a
+    host don't come back all at once. All intervals are clamped between
+    @min_interval_sec and @max_interval_sec.
+    """
+
+    def __init__(
+        self,
+        min_interval_sec: float = MIN_INTERVAL_SEC,
+        max_interval_sec: float = MAX_INTERVAL_SEC,
+    ):
+        self.min_interval_sec = min_interval_sec
+        self.max_interval_sec = max_interval_sec
+
+    def clamp(self, interval_sec: float):
+        return min(self.max_interval_sec, max(self.min_interval_sec, interval_sec))
+
+    def next_update_sec(
+        self,
+        published: List[int],
+        unchanged_count: int,
+        hints_sec: List[Optional[float]] = (),
+        now: Optional[float] = None,
+    ):
+        """Seconds until the next update of a feed after a successful one
+
+        @published are the publish times (epoch seconds) of its latest items,
+        @unchanged_count the number of updates in a row without new items,
+        including this one, and @hints_sec the intervals asked for by the
+        publisher (None for the missing ones)
+        """
+        gap_sec = publish_gap_sec(published, time.time() if now is None else now)
+        if gap_sec is None:
+            interval_sec = self.min_interval_sec
+        else:
+            interval_sec = gap_sec / POLLS_PER_ITEM
+        interval_sec *= UNCHANGED_BACKOFF ** min(unchanged_count, 100)
+        for hint_sec in hints_sec:
+            if hint_sec is not None:
+                floor_sec = hint_sec if gap_sec is None else min(hint_sec, gap_sec)
+                interval_sec = max(interval_sec, floor_sec)
+        return self.clamp(interval_sec)
+
+    def retry_sec(self, fail_count: int):
+        """Seconds until the retry of a feed which failed @fail_count times in
+        a row, including this one
+        """
+        backoff_sec = self.min_interval_sec * RETRY_BACKOFF ** min(fail_count - 1, 100)
+        backoff_sec = min(self.max_interval_sec, backoff_sec)
+        return random.uniform(backoff_sec / 2, backoff_sec)
@@ -1,20 +1,226 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Body, FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional
+import contextvars
+import functools
+import hashlib
+import json
 import os
+import prometheus_client
+import time
 
+import async_db
+import cache
 import db as db_handler
-import updater
+import events
+import jobs
+import metrics
+import opml
+import read_marks
 
 
-db = db_handler.DB(
+# Migrations are applied with the sync driver once on startup; the request
+# handlers then use the async backend so that queries don't block the event loop
+db_handler.DB(
     os.environ["DBHOST"],
     os.environ["DBPORT"],
     os.environ["DBUSER"],
     os.environ["DBPASSWORD"],
     create=True,
+).close()
+
+# User and feed ids cached by name; with ID_CACHE_URL (redis://... or
+# memory://) the cached ids are shared with the other API replicas
+ID_CACHE_SIZE = int(os.environ.get("ID_CACHE_SIZE", async_db.ID_CACHE_SIZE))
+ID_CACHE_TTL_SEC = float(os.environ.get("ID_CACHE_TTL_SEC", async_db.ID_CACHE_TTL_SEC))
+ID_CACHE_URL = os.environ.get("ID_CACHE_URL")
+
+db = async_db.AsyncDB(
+    os.environ["DBHOST"],
+    os.environ["DBPORT"],
+    os.environ["DBUSER"],
+    os.environ["DBPASSWORD"],
+    id_cache_size=ID_CACHE_SIZE,
+    id_cache_ttl_sec=ID_CACHE_TTL_SEC,
+    id_cache_backend=cache.make_backend(ID_CACHE_URL),
 )
 
+MAX_PAGE_SIZE = 1000
+
+# Most feeds followed or unfollowed by a bulk request or an OPML import, and
+# the largest OPML document imported
+MAX_BULK_FEEDS = int(os.environ.get("MAX_BULK_FEEDS", 10000))
+MAX_OPML_SIZE = int(os.environ.get("MAX_OPML_SIZE", 10 << 20))
+
+# Longest wait of a long-poll listing (see cached_listing), and the interval
+# of the keepalive comments of /events, which also refresh the followed feeds
+MAX_WAIT_SEC = 60
+EVENTS_KEEPALIVE_SEC = 15
+
+# Notifications of new items for the long-poll listings and /events, and of
+# the purged feeds whose ids are cached
+feed_events = events.FeedEvents(db.connect_args, on_feed_purged=db.forget_feed)
+
+# Responses of the listings cached in memory, validated by the versions of the
+# users and the feeds (see queries.py): at most RESPONSE_CACHE_MAX_BYTES of
+# response bodies, and at most RESPONSE_CACHE_SIZE responses; larger responses
+# than RESPONSE_CACHE_MAX_BODY are not cached
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 256 << 20))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 10000))
+RESPONSE_CACHE_MAX_BODY = int(os.environ.get("RESPONSE_CACHE_MAX_BODY", 1 << 20))
+
+# Deferred read marks (see /mark_read) are written this often, or once this
+# many user feeds have pending marks
+MARK_READ_FLUSH_INTERVAL_SEC = float(os.environ.get("MARK_READ_FLUSH_INTERVAL_SEC", 1))
+MARK_READ_BUFFER_SIZE = int(os.environ.get("MARK_READ_BUFFER_SIZE", 10000))
+
+# Report the number of database queries made by a request in the X-Query-Count
+# response header, for tests
+QUERY_COUNT_HEADER = os.environ.get("QUERY_COUNT_HEADER") == "1"
+
 app = FastAPI()
 
+# Listing request key: (ETag, response body)
+response_cache = cache.LRUCache(
+    RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES
+)
+
+deferred_read_marks = read_marks.ReadMarksBuffer(
+    db, MARK_READ_BUFFER_SIZE, MARK_READ_FLUSH_INTERVAL_SEC
+)
+
+request_query_count = contextvars.ContextVar("request_query_count", default=None)
+
+
+def count_request_query(query):
+    counter = request_query_count.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+if QUERY_COUNT_HEADER:
+    db_handler.query_hooks.append(count_request_query)
+
+    @app.middleware("http")
+    async def query_count_header(request, call_next):
+        # A mutable counter, so that the changes made in the request handler
+        # context are seen here
+        counter = [0]
+        request_query_count.set(counter)
+        response = await call_next(request)
+        response.headers["X-Query-Count"] = str(counter[0])
+        return response
+
+
+@app.middleware("http")
+async def observe_request_time(request, call_next):
+    start_time = time.monotonic()
+    response = await call_next(request)
+    # Set by the router on the request scope; labelled by the route path
+    # rather than the request path, to keep the number of labels bounded
+    endpoint = request.scope.get("endpoint")
+    metrics.REQUEST_SECONDS.labels(
+        request.method,
+        route_paths().get(endpoint, "unmatched"),
+        response.status_code,
+    ).observe(time.monotonic() - start_time)
+    return response
+
+
+@functools.lru_cache(maxsize=None)
+def route_paths():
+    """Route paths by the endpoint functions"""
+    return {
+        route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")
+    }
+
+
+def make_etag(key: tuple, version: str):
+    """Strong ETag of a listing: the version of its data and a digest of the request"""
+    digest = hashlib.md5(repr(key).encode()).hexdigest()[:16]
+    return f'"{version}-{digest}"'
+
+
+def etag_version(key: tuple, etag: Optional[str]):
+    """Version of a listing from its ETag, None if the ETag isn't for this request"""
+    if not etag:
+        return None
+    version, _, _ = etag.strip('"').rpartition("-")
+    return version if version and make_etag(key, version) == etag else None
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]):
+    if not if_none_match:
+        return False
+    etags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in etags or etag in etags or "W/" + etag in etags
+
+
+async def cached_listing(request: Request, key: tuple, load):
+    """Respond with a listing, cached and validated by the version of its data
+
+    @load is awaited with the version of the cached response (or of the one
+    the client has, by its If-None-Match header) and returns the listing with
+    its current version; the listing is not queried when the version is the
+    same. Responds with 304 to a conditional request for the current version.
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    cached = response_cache.get(key)
+    known_version = etag_version(key, cached[0] if cached else if_none_match)
+    result = await load(known_version)
+    version = result.pop("version")
+    etag = make_etag(key, version)
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    if cached and cached[0] == etag:
+        body = cached[1]
+    else:
+        body = JSONResponse(result).body
+        if len(body) <= RESPONSE_CACHE_MAX_BODY:
+            response_cache.put(key, (etag, body), len(body))
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+async def long_poll_listing(
+    request: Request, key: tuple, load, username: str, wait_sec: float, feed_url=None
+):
+    """Respond as cached_listing, waiting up to @wait_sec for new items when
+    the listing is not modified
+
+    The followed feeds (only @feed_url if given) are subscribed to before the
+    listing is queried, so no new items are missed, and the listing is checked
+    again on every notification of new items; responds with 304 if it is
+    still not modified after the wait.
+    """
+    deadline = time.monotonic() + wait_sec
+    with feed_events.subscribe() as subscription:
+        feeds = await db.followed_feeds(username)
+        subscription.follow(
+            feed_id for url, feed_id in feeds.items() if feed_url in (None, url)
+        )
+        while True:
+            response = await cached_listing(request, key, load)
+            remaining = deadline - time.monotonic()
+            if response.status_code != 304 or remaining <= 0:
+                return response
+            if not await subscription.wait(remaining):
+                return response
+
+
+@app.on_event("startup")
+async def startup():
+    await db.connect()
+    deferred_read_marks.start()
+    feed_events.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await feed_events.close()
+    await deferred_read_marks.close()
+    await db.close()
+
 
 @app.get("/healthcheck")
 def healthcheck():
@@ -22,29 +228,37 @@ def healthcheck():
     return {"message": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """Metrics in the Prometheus text format (see metrics.py)"""
+    return Response(
+        prometheus_client.generate_latest(),
+        headers={"Content-Type": prometheus_client.CONTENT_TYPE_LATEST},
+    )
+
+
 @app.post("/add_user")
-def add_user(username: str):
+async def add_user(username: str):
     """Add new user
 
     Return codes: 200 on success, 400 when user already exists
     """
     try:
-        db.add_user(username)
+        await db.add_user(username)
     except db_handler.UserAlreadyExists:
         raise HTTPException(status_code=400, detail="User already exists")
     return {"message": "User added successfully"}
 
 
 @app.post("/follow")
-def follow_feed(username: str, feed_url: str):
+async def follow_feed(username: str, feed_url: str):
     """Follow a feed
     
     Following the same feed more than once has no effect
     Return code: 200 on success, 500 when user is not found
     """
     try:
-        new_follow, new_feed = db.follow_feed(username, feed_url)
-        updater.start_updating_feed(feed_url)
+        new_follow, new_feed = await db.follow_feed(username, feed_url)
     except db_handler.UserNotFound as e:
         # User management is out of scope of this service so missing user is some kind
         # internal logic error or a race condition
@@ -56,13 +270,13 @@ def follow_feed(username: str, feed_url: str):
 
 
 @app.post("/unfollow")
-def unfollow_feed(username: str, feed_url: str):
+async def unfollow_feed(username: str, feed_url: str):
     """Unfollow a feed
 
     Return code: 200 on success, 500 when user not found, 400 when feed not followed
     """
     try:
-        unfollowed = db.unfollow_feed(username, feed_url)
+        unfollowed = await db.unfollow_feed(username, feed_url)
     except db_handler.UserNotFound:
         raise HTTPException(status_code=500, detail="User not found")
     if not unfollowed:
@@ -70,60 +284,285 @@ def unfollow_feed(username: str, feed_url: str):
     return {"message": "Feed unfollowed"}
 
 
+def check_bulk_size(feed_urls: List[str]):
+    if len(feed_urls) > MAX_BULK_FEEDS:
+        raise HTTPException(
+            status_code=400, detail=f"More than {MAX_BULK_FEEDS} feeds"
+        )
+
+
+@app.post("/follow_bulk")
+async def follow_feeds(username: str, feed_urls: List[str] = Body(...)):
+    """Follow many feeds at once
+
+    Same as /follow for every url of the JSON array, in a single query. New feeds
+    are fetched for the first time with the next batch of due feeds, right away.
+    Return code: 200 on success, 500 when user is not found, 400 when there are
+    more than MAX_BULK_FEEDS urls
+    Return content: {"followed": [feed_url], "already_followed": [feed_url],
+                     "invalid": [feed_url]}; invalid urls are empty or too long
+    """
+    check_bulk_size(feed_urls)
+    try:
+        return await db.follow_feeds(username, feed_urls)
+    except db_handler.UserNotFound:
+        raise HTTPException(status_code=500, detail="User not found")
+
+
+@app.post("/unfollow_bulk")
+async def unfollow_feeds(username: str, feed_urls: List[str] = Body(...)):
+    """Unfollow many feeds at once
+
+    Same as /unfollow for every url of the JSON array, in a single query; the feeds
+    not followed are skipped and listed in the response
+    Return code: 200 on success, 500 when user is not found, 400 when there are
+    more than MAX_BULK_FEEDS urls
+    Return content: {"unfollowed": [feed_url], "not_followed": [feed_url]}
+    """
+    check_bulk_size(feed_urls)
+    try:
+        return await db.unfollow_feeds(username, feed_urls)
+    except db_handler.UserNotFound:
+        raise HTTPException(status_code=500, detail="User not found")
+
+
+@app.post("/import_opml")
+async def import_opml(request: Request, username: str):
+    """Follow the feeds of an OPML subscription list (the request body)
+
+    The document is parsed as it is received and the feeds are followed as with
+    /follow_bulk.
+    Return code: 200 on success, 500 when user is not found, 400 when the document
+    is invalid or lists more than MAX_BULK_FEEDS feeds, 413 when it is larger
+    than MAX_OPML_SIZE
+    Return content: as for /follow_bulk
+    """
+    parser = opml.FeedUrlsParser(MAX_BULK_FEEDS)
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > MAX_OPML_SIZE:
+                raise HTTPException(status_code=413, detail="Document too large")
+            parser.feed(chunk)
+        feed_urls = parser.close()
+    except opml.InvalidOpml as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        return await db.follow_feeds(username, feed_urls)
+    except db_handler.UserNotFound:
+        raise HTTPException(status_code=500, detail="User not found")
+
+
 @app.get("/feeds")
-async def list_feeds(username: str):
+async def list_feeds(request: Request, username: str):
     """List user's feeds
-    
-    Return code: 200 on success, 500 when user not found
+
+    The listings (/feeds, /feed_items and /all_items) come with an ETag;
+    a request with If-None-Match of the current ETag gets 304.
+
+    Return code: 200 on success, 304 when not modified, 500 when user not found
     Return content: {"feeds": [feed_url]}
     """
     try:
-        feeds = db.list_feeds(username)
+        return await cached_listing(
+            request,
+            ("feeds", username),
+            lambda known_version: db.list_feeds(username, known_version),
+        )
+    except db_handler.UserNotFound:
+        raise HTTPException(status_code=500, detail="User not found")
+
+
+@app.get("/unread_counts")
+async def unread_counts(username: str):
+    """Get the number of unread items of every followed feed and in total
+
+    Return code: 200 on success, 500 when user not found
+    """
+    try:
+        return await db.unread_counts(username)
     except db_handler.UserNotFound:
         raise HTTPException(status_code=500, detail="User not found")
-    return {"feeds": feeds}
 
 
 @app.get("/feed_items")
-async def list_feed_items(username: str, feed_url: str, unread_only: bool = False):
+async def list_feed_items(
+    request: Request,
+    username: str,
+    feed_url: str,
+    unread_only: bool = False,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    stream: bool = False,
+    include_content: bool = False,
+    wait: float = Query(0, ge=0, le=MAX_WAIT_SEC),
+):
     """List user's items filtered by feed, possibly unread only
 
-    Return code: 200 on success, 500 when user not found, 400 when feed not followed
-    Return content: {"items": [{"id": id, "content": content}], "failed": bool}.
-                    Item content is json encoded entry object from feedparser.
+    Items are ordered by publishing time. When @limit is given, at most @limit items
+    are returned along with the cursor of the next page, which is passed as @after
+    to get the next page. With @stream all the items following @after are streamed
+    as NDJSON: the first line is {"failed": bool}, then an item per line.
+    Streamed items are not cached and come without an ETag.
+    With @wait, a request with If-None-Match of the current ETag (long poll) waits up
+    to @wait seconds for new items before responding with 304.
+
+    Return code: 200 on success, 304 when not modified, 500 when user not found,
+                 400 when feed not followed or the page cursor is invalid
+    Return content: {"items": [item], "failed": bool, "next_cursor": cursor or null}.
+                    An item is {"id": id, "published": unix time, "guid": guid,
+                    "title": title, "link": link, "author": author, "summary": summary},
+                    plus "content" (the main content of the entry) with @include_content.
     """
     try:
-        items = db.get_feed_items(username, feed_url, unread_only)
+        if stream:
+            return await ndjson_response(
+                db.iter_feed_items(
+                    username, feed_url, unread_only, after, include_content
+                )
+            )
+        key = (
+            "feed_items",
+            username,
+            feed_url,
+            unread_only,
+            limit,
+            after,
+            include_content,
+        )
+
+        def load(known_version):
+            return db.get_feed_items(
+                username,
+                feed_url,
+                unread_only,
+                limit,
+                after,
+                include_content,
+                known_version,
+            )
+
+        if wait:
+            return await long_poll_listing(request, key, load, username, wait, feed_url)
+        return await cached_listing(request, key, load)
     except db_handler.UserNotFound:
         raise HTTPException(status_code=500, detail="User not found")
     except db_handler.FeedNotFound:
         raise HTTPException(status_code=400, detail="Feed not found")
-    return {"items": items["items"], "failed": items.get("failed")}
+    except db_handler.InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid page cursor")
 
 
 @app.get("/all_items")
-async def list_all_items(username: str, unread_only: bool = False):
+async def list_all_items(
+    request: Request,
+    username: str,
+    unread_only: bool = False,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    stream: bool = False,
+    include_content: bool = False,
+    wait: float = Query(0, ge=0, le=MAX_WAIT_SEC),
+):
     """List user's items from all feeds, possibly unread only
 
+    Pagination, streaming, caching and long polling work as for /feed_items; when
+    streaming, the first line is {"failed": [failed_feed_url]}.
+
+    Return code: 200 on success, 304 when not modified, 500 when user not found,
+                 400 when the page cursor is invalid
+    Return content: {"items": [item], "failed": [failed_feed_url],
+                     "next_cursor": cursor or null}, with items as for /feed_items.
+    """
+    try:
+        if stream:
+            return await ndjson_response(
+                db.iter_all_items(username, unread_only, after, include_content)
+            )
+        key = ("all_items", username, unread_only, limit, after, include_content)
+
+        def load(known_version):
+            return db.get_all_items(
+                username, unread_only, limit, after, include_content, known_version
+            )
+
+        if wait:
+            return await long_poll_listing(request, key, load, username, wait)
+        return await cached_listing(request, key, load)
+    except db_handler.UserNotFound:
+        raise HTTPException(status_code=500, detail="User not found")
+    except db_handler.InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid page cursor")
+
+
+@app.get("/events")
+async def stream_events(username: str):
+    """Stream Server-Sent Events of new items in the followed feeds
+
+    A "new_items" event comes with {"feeds": [feed_url]} data when new items of the
+    feeds are stored; comment lines are sent as keepalives in between.
+
     Return code: 200 on success, 500 when user not found
-    Return content: {"items": [{"id": id, "content": content}], "failed": [failed_feed_url]}.
-                    Item content is json encoded entry object from feedparser.
     """
     try:
-        items = db.get_all_items(username, unread_only)
+        feeds = await db.followed_feeds(username)
     except db_handler.UserNotFound:
         raise HTTPException(status_code=500, detail="User not found")
-    return {"items": items["items"], "failed": items.get("failed")}
+
+    async def lines(feeds):
+        with feed_events.subscribe() as subscription:
+            while True:
+                subscription.follow(feeds.values())
+                notified = await subscription.wait(EVENTS_KEEPALIVE_SEC)
+                if not notified:
+                    yield ": keepalive\n\n"
+                    try:
+                        feeds = await db.followed_feeds(username)
+                    except db_handler.UserNotFound:
+                        return
+                    continue
+                urls = [url for url, feed_id in feeds.items() if feed_id in notified]
+                yield f"event: new_items\ndata: {json.dumps({'feeds': urls})}\n\n"
+
+    return StreamingResponse(
+        lines(feeds),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+async def ndjson_response(values):
+    """Stream values from an async generator as NDJSON
+
+    The first value is taken before the response starts, so that errors like
+    a missing user are still reported with a proper status code
+    """
+    first = await values.__anext__()
+
+    async def lines():
+        yield json.dumps(first) + "\n"
+        async for value in values:
+            yield json.dumps(value) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @app.post("/mark_read")
-async def mark_as_read(username: str, feed_url: str, item_id: int):
+async def mark_as_read(username: str, feed_url: str, item_id: int, defer: bool = False):
     """Mark items up to @item_id as read
 
-    Return code: 200 on success, 500 when user not found, 400 when feed not found
+    Marking an item older than the last one read has no effect. With @defer
+    the mark is written later, merged with the other marks of the feed, and
+    the user and the feed are not checked
+    Return code: 200 on success (202 when deferred), 500 when user not found,
+    400 when feed not followed
     """
+    if defer:
+        await deferred_read_marks.add(username, feed_url, item_id)
+        return JSONResponse({"message": "Mark queued"}, status_code=202)
     try:
-        db.mark_as_read(username, feed_url, item_id)
+        await db.mark_as_read(username, feed_url, item_id)
     except db_handler.UserNotFound:
         raise HTTPException(status_code=500, detail="User not found")
     except db_handler.FeedNotFound:
@@ -131,6 +570,34 @@ async def mark_as_read(username: str, feed_url: str, item_id: int):
     return {"message": "Marked as read"}
 
 
+class ReadMark(BaseModel):
+    feed_url: str
+    item_id: int
+
+
+@app.post("/mark_read_bulk")
+async def mark_as_read_bulk(username: str, marks: List[ReadMark], defer: bool = False):
+    """Mark items as read in many feeds, up to @item_id in every @feed_url
+
+    Same as /mark_read for every mark, in a single query; the marks of feeds
+    not followed by the user are skipped and listed in the response
+    Return code: 200 on success (202 when deferred), 500 when user not found
+    """
+    if defer:
+        for mark in marks:
+            await deferred_read_marks.add(username, mark.feed_url, mark.item_id)
+        return JSONResponse({"message": "Marks queued"}, status_code=202)
+    result = await db.mark_as_read_batch(
+        [(username, mark.feed_url, mark.item_id) for mark in marks]
+    )
+    if result["users_not_found"]:
+        raise HTTPException(status_code=500, detail="User not found")
+    return {
+        "message": "Marked as read",
+        "feeds_not_found": [feed_url for _, feed_url in result["feeds_not_found"]],
+    }
+
+
 @app.post("/update_feed")
 async def update_feed(feed_url: str):
     """Force update failed feed
@@ -139,15 +606,71 @@ async def update_feed(feed_url: str):
     Return code: 200 on success, 400 when feed not found
     """
     try:
-        need_update = db.request_feed_update(feed_url)
+        need_update = await db.request_feed_update(feed_url)
     except db_handler.FeedNotFound:
         raise HTTPException(status_code=400, detail="Feed not found")
     if need_update:
-        updater.start_updating_feed(feed_url)
         return {"message": "Update requested"}
     return {"message": "Update not needed"}
 
 
+@app.get("/admin/update_chains")
+async def list_update_chains(feed_url: Optional[str] = None):
+    """Report the update chains of the feeds, of a single feed if given
+
+    Every feed is expected to have at most one active update chain: a feed
+    with an active chain holds a lease on its update, owned by the dispatcher
+    until the update starts and by the worker afterwards. Expired leases
+    belong to lost updates which are going to be dispatched again.
+    Return code: 200 on success, 400 when feed not found
+    """
+    chains = await db.list_update_chains(feed_url)
+    if feed_url is not None and not chains["feeds"]:
+        raise HTTPException(status_code=400, detail="Feed not found")
+    return chains
+
+
+@app.get("/admin/cache_stats")
+def cache_stats():
+    """Report the hits and misses of the user and feed id caches
+
+    Hits are served by the in-process cache, backend hits by the shared cache
+    backend (see ID_CACHE_URL).
+    """
+    return db.cache_stats()
+
+
+@app.post("/admin/compact_items")
+def compact_items(
+    max_age_days: float = db_handler.RETENTION_MAX_AGE_DAYS,
+    max_items_per_feed: int = db_handler.RETENTION_MAX_ITEMS_PER_FEED,
+    purge_orphans: bool = db_handler.RETENTION_PURGE_ORPHANS,
+):
+    """Run the compaction job (see jobs.py) now, with the given retention limits
+
+    Deletes the items published more than @max_age_days ago and all but the
+    latest @max_items_per_feed items of every feed (0 for no limit), then the
+    feeds nobody follows if @purge_orphans is set.
+    Return code: 200 on success
+    """
+    # The job runs on the sync backend, in the threadpool of this handler
+    sync_db = db_handler.DB(
+        os.environ["DBHOST"],
+        os.environ["DBPORT"],
+        os.environ["DBUSER"],
+        os.environ["DBPASSWORD"],
+        min_connections=1,
+        max_connections=1,
+    )
+    try:
+        items, feeds = jobs.compact_items(
+            sync_db, max_age_days, max_items_per_feed, purge_orphans
+        )
+    finally:
+        sync_db.close()
+    return {"items_deleted": items, "feeds_deleted": feeds}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="RSS reader service")
 
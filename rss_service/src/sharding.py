@@ -0,0 +1,62 @@
+import bisect
+import hashlib
+from typing import Iterable
+
+# Points of every node on the hash ring; more points share the feeds more
+# evenly between the nodes
+VIRTUAL_NODES = 64
+# Feed ids are hashed by Postgres hashint4(), a signed 32-bit value
+HASH_MIN = -(2**31)
+HASH_MAX = 2**31 - 1
+
+
+def node_point(node_id: str, i: int):
+    """Point @i of a node on the ring, in the range of the feed id hashes"""
+    digest = hashlib.md5(f"{node_id}#{i}".encode()).digest()
+    return int.from_bytes(digest[:4], "big", signed=True)
+
+
+class HashRing:
+    """Consistent hash ring of the updater nodes
+
+    A feed belongs to the node of the first point on the ring at or after the
+    hash of its id, wrapping around. When a node joins or leaves, only the
+    feeds next to its points change hands, about 1 / nodes of them.
+    """
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = VIRTUAL_NODES):
+        self.nodes = frozenset(nodes)
+        self.points = sorted(
+            (node_point(node, i), node)
+            for node in self.nodes
+            for i in range(virtual_nodes)
+        )
+
+    def owner(self, feed_hash: int):
+        """Node of a feed id hash"""
+        i = bisect.bisect_left(self.points, (feed_hash,))
+        return self.points[i % len(self.points)][1]
+
+    def ranges(self, node: str):
+        """Hash ranges (low, high] of the feeds of @node"""
+        ranges = []
+        low = HASH_MIN - 1
+        for point, owner in self.points:
+            if owner == node:
+                if ranges and ranges[-1][1] == low:
+                    ranges[-1] = (ranges[-1][0], point)
+                else:
+                    ranges.append((low, point))
+            low = point
+        if self.points and self.points[0][1] == node:
+            ranges.append((self.points[-1][0], HASH_MAX))
+        return ranges
+
+    def multirange(self, node: str):
+        """ranges() as a Postgres int8multirange literal"""
+        ranges = ",".join(f"({low},{high}]" for low, high in self.ranges(node))
+        return "{" + ranges + "}"
+
+    def share(self, node: str):
+        """Part of the hash space owned by @node"""
+        return sum(high - low for low, high in self.ranges(node)) / 2**32
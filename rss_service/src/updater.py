@@ -1,20 +1,107 @@
-import feedparser
+import contextlib
+import hashlib
 import time
-import threading
+import uuid
 import dramatiq
 from dramatiq.brokers.rabbitmq import RabbitmqBroker
-import json
 import os
 import logging
+import prometheus_client
+import signal
 import sys
 import socket
 
+import cache
 import db as db_handler
+import fetcher as fetcher_module
+import ingestion
+import metrics
+import parsing
+import scheduling
+import sharding
 
-UPDATE_INTERVAL_SEC = 1
-UPDATE_INTERVAL_INCREASE = 1
+# Bounds of the polling intervals of the feeds, which are learned per feed
+# (see scheduling.py)
+UPDATE_MIN_INTERVAL_SEC = float(
+    os.environ.get("UPDATE_MIN_INTERVAL_SEC", scheduling.MIN_INTERVAL_SEC)
+)
+UPDATE_MAX_INTERVAL_SEC = float(
+    os.environ.get("UPDATE_MAX_INTERVAL_SEC", scheduling.MAX_INTERVAL_SEC)
+)
 MAX_FAIL_COUNT = 3
 
+# How often the dispatcher looks for due feeds
+DISPATCH_INTERVAL_SEC = 0.5
+# Feeds due this soon are dispatched with a delay
+DISPATCH_LOOKAHEAD_SEC = 2
+DISPATCH_BATCH_SIZE = 1000
+# A dispatched update not started this long after the feed is due is
+# considered lost (e.g. the message is lost) and the feed is dispatched again
+CLAIM_TIMEOUT_SEC = 60
+# Same for a started update not done in time (e.g. the worker died)
+UPDATE_TIMEOUT_SEC = 60
+
+# Feeds fetched concurrently by a single actor call
+FETCH_BATCH_SIZE = 50
+# Feeds due within this window are fetched together
+FETCH_BATCH_WINDOW_MS = 100
+
+# Concurrency of the update stages: connections of the fetch stage (in total
+# and to a single host) and processes of the parse stage, 0 to parse in the
+# actor threads. The number of actor threads is set by the dramatiq command.
+FETCH_MAX_CONNECTIONS = int(
+    os.environ.get("FETCH_MAX_CONNECTIONS", fetcher_module.MAX_CONNECTIONS)
+)
+FETCH_MAX_CONNECTIONS_PER_HOST = int(
+    os.environ.get(
+        "FETCH_MAX_CONNECTIONS_PER_HOST", fetcher_module.MAX_CONNECTIONS_PER_HOST
+    )
+)
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", 2))
+
+# Fetches of every host are rate limited for all the dispatchers and workers
+# (see RESERVE_HOST_FETCHES in queries.py): one per HOST_FETCH_INTERVAL_SEC (0
+# for no limit), up to HOST_FETCH_BURST at once after a pause. The dispatcher
+# spreads the due feeds of a host over its free time slots, reserved up to
+# HOST_FETCH_AHEAD_SEC ahead (well within CLAIM_TIMEOUT_SEC), and puts off the
+# rest until their slots.
+HOST_FETCH_INTERVAL_SEC = float(os.environ.get("HOST_FETCH_INTERVAL_SEC", 0.5))
+HOST_FETCH_BURST = int(
+    os.environ.get("HOST_FETCH_BURST", fetcher_module.MAX_CONNECTIONS_PER_HOST)
+)
+HOST_FETCH_AHEAD_SEC = 10
+# Hosts answering 429, or 503 with Retry-After, are not fetched for the
+# Retry-After time (HOST_THROTTLE_SEC if not given), and their updates are
+# postponed until then instead of failing
+HOST_THROTTLE_SEC = 60
+
+# Fingerprints of the entries of this many feeds are cached in memory; on a
+# cache miss fingerprints of this many latest items are loaded from the database
+FINGERPRINTS_CACHE_FEEDS = 10000
+FINGERPRINTS_PRELOAD = 500
+
+# The updates of the feeds are written in batches (see ingestion.py) every
+# WRITE_INTERVAL_SEC, or once WRITE_BATCH_FEEDS feeds or WRITE_BATCH_ENTRIES
+# entries are pending; the interval must stay well under UPDATE_TIMEOUT_SEC
+WRITE_INTERVAL_SEC = float(os.environ.get("WRITE_INTERVAL_SEC", 1))
+WRITE_BATCH_FEEDS = int(os.environ.get("WRITE_BATCH_FEEDS", 500))
+WRITE_BATCH_ENTRIES = int(os.environ.get("WRITE_BATCH_ENTRIES", 5000))
+
+# Owner of the update leases taken by this process
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+# Dispatchers share the feeds by consistent hashing of the feed ids (see
+# sharding.py), each one being a node named LEASE_OWNER. A node heartbeats this
+# often and is considered gone without a heartbeat for NODE_TIMEOUT_SEC, when
+# its feeds are taken over by the other nodes.
+NODE_HEARTBEAT_SEC = float(os.environ.get("NODE_HEARTBEAT_SEC", 5))
+NODE_TIMEOUT_SEC = float(os.environ.get("NODE_TIMEOUT_SEC", 15))
+
+# The dispatcher serves the metrics on this port and updates the backlog
+# metrics this often; the workers serve theirs through dramatiq (see metrics.py)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9191))
+METRICS_INTERVAL_SEC = 15
+
 
 dramatiq_broker = RabbitmqBroker(
     host=socket.gethostbyname(
@@ -31,78 +118,429 @@ db = db_handler.DB(
     os.environ["DBPASSWORD"],
 )
 
+fetcher = fetcher_module.Fetcher(FETCH_MAX_CONNECTIONS, FETCH_MAX_CONNECTIONS_PER_HOST)
+parser = parsing.Parser(PARSE_WORKERS)
+policy = scheduling.PollingPolicy(UPDATE_MIN_INTERVAL_SEC, UPDATE_MAX_INTERVAL_SEC)
+# Feed url: (feed id, fingerprints of the stored entries of the feed); the
+# feed id tells the fingerprints of a feed purged and followed again apart
+fingerprints = cache.LRUCache(FINGERPRINTS_CACHE_FEEDS)
+
+
+def forget_fingerprints(urls):
+    """Drop the cached fingerprints of feeds whose updates weren't written"""
+    for url in urls:
+        fingerprints.pop(url)
+
+
+writer = ingestion.UpdatesWriter(
+    db,
+    WRITE_BATCH_FEEDS,
+    WRITE_BATCH_ENTRIES,
+    WRITE_INTERVAL_SEC,
+    on_lost=forget_fingerprints,
+)
+
 logging.basicConfig(level=logging.DEBUG)
 
 
-def get_feed_updates(url, etag=None, modified=None):
-    headers = {}
-    if etag:
-        headers["If-None-Match"] = etag
-    if modified:
-        headers["If-Modified-Since"] = modified
-    feed = feedparser.parse(url, etag=etag, modified=modified, request_headers=headers)
-    if feed.status == 304:
-        entries = []
-    else:
-        entries = feed.entries
-    logging.debug(f"Feed {url}: status {feed.status}, entries: {len(entries)}")
-    return {
-        "etag": feed.get("etag"),
-        "modified": feed.get("modified"),
-        "entries": entries,
-    }
+def record_failure(url, lease_token, feed, error):
+    logging.error(f"Exception while trying to update feed {url}: {error}")
+    retry_sec = policy.retry_sec(feed["fail_count"] + 1)
+    metrics.UPDATE_INTERVAL_SECONDS.labels("failed").observe(retry_sec)
+    failed = db.record_failure(url, MAX_FAIL_COUNT, retry_sec, lease_token)
+    if failed:
+        logging.info(f"Feed failed: {url}")
 
 
-@dramatiq.actor
-def update_feed(url, fail_count):
-    logging.debug(f"Updating feed for {url}, fail count: {fail_count}")
-    start_time = time.monotonic()
-    if fail_count >= MAX_FAIL_COUNT:
-        db.set_failed(url)
-        return
+def throttle_sec(error):
+    """Seconds a failed fetch asks its host to be left alone for, None if
+    the host didn't throttle it
+    """
+    if not isinstance(error, fetcher_module.FetchError):
+        return None
+    retry_sec = scheduling.retry_after_sec(error.retry_after)
+    if error.status == 429 and retry_sec is None:
+        retry_sec = HOST_THROTTLE_SEC
+    if error.status not in (429, 503) or retry_sec is None:
+        return None
+    return policy.clamp(retry_sec)
 
-    try:
-        last_updated = db.get_feed_last_updated(url)
-        if last_updated is None:
-            logging.info(f"Feed is not followed any more: {url}")
-            return
-        updates = get_feed_updates(url, last_updated["etag"], last_updated["modified"])
-        db.put_updates(
-            feed_url=url,
-            etag=updates["etag"],
-            modified=updates["modified"],
-            entries=[
-                {
-                    "published": int(time.mktime(update.published_parsed)),
-                    "content": json.dumps(update),
-                }
-                for update in updates["entries"]
+
+def hash_body(content):
+    return str(uuid.UUID(bytes=hashlib.md5(content).digest()))
+
+
+def resolve_duplicates(url, lease_token, fetched, body_hash, parsed):
+    """Move a feed to the url it is permanently redirected to, and merge it
+    into another feed known by that url or with the same content
+
+    Feeds with the same body are merged only when the body has entries, since
+    empty or error bodies may be the same for different feeds, and when the
+    other feed stores the same items. Return the url to store the updates of
+    the feed under, None if it was merged
+    """
+    moved_to = fetched["moved_to"] and db_handler.canonical_feed_url(
+        fetched["moved_to"]
+    )
+    if moved_to and moved_to != url:
+        moved, target_feed_id = db.move_feed(url, lease_token, moved_to)
+        if moved:
+            logging.info(f"Feed {url} moved to {moved_to}")
+            metrics.FEED_URL_CHANGES.labels("moved").inc()
+            cached = fingerprints.pop(url)
+            if cached is not None:
+                fingerprints.put(moved_to, cached)
+            url = moved_to
+        elif target_feed_id is not None:
+            target_url = db.merge_feed(url, lease_token, target_feed_id=target_feed_id)
+            if target_url is not None:
+                logging.info(f"Feed {url} redirected to {target_url}, merged")
+                metrics.FEED_URL_CHANGES.labels("merged_redirect").inc()
+                fingerprints.pop(url)
+                return None
+    if parsed and parsed["fingerprints"]:
+        target_url = db.merge_feed(
+            url,
+            lease_token,
+            body_hash=body_hash,
+            fingerprints=[
+                entry["fingerprint"] for entry in retained_entries(parsed["entries"])
             ],
         )
-        logging.debug("Successfully stored updates in DB")
+        if target_url is not None:
+            logging.info(f"Feed {url} is the same as {target_url}, merged")
+            metrics.FEED_URL_CHANGES.labels("merged_duplicate").inc()
+            fingerprints.pop(url)
+            return None
+    return url
+
+
+def retained_entries(entries):
+    """Entries not older than the retention age limit"""
+    if not db_handler.RETENTION_MAX_AGE_DAYS:
+        return entries
+    # Older ones would be deleted by the compaction job right away
+    published_before = time.time() - db_handler.RETENTION_MAX_AGE_DAYS * 86400
+    return [entry for entry in entries if entry["published"] >= published_before]
+
+
+def store_feed_updates(
+    url, lease_token, feed, fetched, body_hash, parsed, start_time
+):
+    entries = parsed["entries"] if parsed else []
+    retained = retained_entries(entries)
+    metrics.ENTRIES.labels("expired").inc(len(entries) - len(retained))
+    entries = retained
+    logging.debug(f"Feed {url}: status {fetched['status']}, new entries: {len(entries)}")
+    unchanged_count = 0 if entries else feed["unchanged_count"] + 1
+    declared_interval_sec = (
+        parsed["declared_interval_sec"] if parsed else feed["declared_interval_sec"]
+    )
+    interval_sec = policy.next_update_sec(
+        feed["published"] + [entry["published"] for entry in entries],
+        unchanged_count,
+        [scheduling.max_age_sec(fetched["cache_control"]), declared_interval_sec],
+    )
+    metrics.UPDATE_INTERVAL_SECONDS.labels("updated").observe(interval_sec)
+    writer.add(
+        dict(
+            feed_url=url,
+            etag=fetched["etag"],
+            modified=fetched["modified"],
+            entries=entries,
+            next_update_at=time.time()
+            + max(0, start_time + interval_sec - time.monotonic()),
+            token=lease_token,
+            body_hash=body_hash,
+            declared_interval_sec=parsed["declared_interval_sec"] if parsed else None,
+            unchanged_count=unchanged_count,
+        )
+    )
+    if parsed:
+        fingerprints.put(url, (feed["feed_id"], frozenset(parsed["fingerprints"])))
+        metrics.ENTRIES.labels("known").inc(
+            len(parsed["fingerprints"]) - len(entries)
+        )
+
+
+def count_fetch_results(urls, fetched, body_hashes, parsed, last_updated):
+    for url, result, body_hash, entries in zip(urls, fetched, body_hashes, parsed):
+        if throttle_sec(result) is not None:
+            metrics.FEED_FETCHES.labels("throttled").inc()
+        elif isinstance(result, BaseException):
+            metrics.FEED_FETCHES.labels("failed").inc()
+        elif body_hash is None:
+            metrics.FEED_FETCHES.labels("not_modified").inc()
+        elif body_hash == last_updated[url]["body_hash"]:
+            metrics.FEED_FETCHES.labels("unchanged").inc()
+        else:
+            metrics.FEED_FETCHES.labels("changed").inc()
+        if isinstance(entries, dict):
+            metrics.PARSE_SECONDS.observe(entries["seconds"])
+
+
+@contextlib.contextmanager
+def update_stage(stage, timings):
+    """Time a stage of a batch update into @timings and the stage histogram"""
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[stage] = time.monotonic() - start_time
+        metrics.UPDATE_STAGE_SECONDS.labels(stage).observe(timings[stage])
+
+
+def update_feed_batch(feeds):
+    """Fetch feeds given as (url, lease token) concurrently, store the new
+    entries and schedule the next updates
+
+    The updates are scheduled by the dispatcher (see dispatch_due_feeds), so
+    the actors never wait for the next update themselves. Every update holds
+    a lease on its feed; updates whose leases are lost are duplicates and are
+    dropped. The feeds are fetched by the fetcher loop and parsed by the
+    parse workers, the actor only waits for them and stores the results.
+    Unchanged feed bodies are not parsed, and already stored entries (by the
+    fingerprints cache) are not serialized and sent to the database; the rest
+    are written in batches with the updates of other feeds (see writer). The next
+    updates are scheduled by the polling policy. Feeds permanently redirected
+    are moved, and duplicate feeds are merged (see resolve_duplicates), so
+    that the same content is fetched and stored once. The feeds of blocked
+    hosts are not fetched, and the hosts throttling the fetches get blocked;
+    the updates of both are postponed until the hosts are unblocked.
+    """
+    start_time = time.monotonic()
+    timings = {}
+    tokens = dict(feeds)
+    with update_stage("lease", timings):
+        last_updated = db.start_updates(
+            feeds,
+            LEASE_OWNER,
+            UPDATE_TIMEOUT_SEC,
+            load_fingerprints={url for url in tokens if url not in fingerprints},
+            fingerprints_limit=FINGERPRINTS_PRELOAD,
+            published_limit=scheduling.PUBLISH_HISTORY,
+        )
+    for url in tokens.keys() - last_updated.keys():
+        logging.info(f"Dropping a duplicate update of feed {url}")
+    for url, feed in last_updated.items():
+        metrics.UPDATE_LAG_SECONDS.observe(feed["lag_sec"])
+        if feed["fingerprints"] is not None:
+            fingerprints.put(url, (feed["feed_id"], frozenset(feed["fingerprints"])))
+        elif fingerprints.get(url, (None,))[0] != feed["feed_id"]:
+            # Purged and followed again, with no items yet
+            fingerprints.put(url, (feed["feed_id"], frozenset()))
+    postponed = []
+    with update_stage("throttle", timings):
+        blocked = db.blocked_hosts(
+            list({db_handler.feed_host(url) for url in last_updated})
+        )
+    for url in list(last_updated):
+        blocked_sec = blocked.get(db_handler.feed_host(url))
+        if blocked_sec is not None:
+            postponed.append((url, tokens[url], blocked_sec))
+            del last_updated[url]
+    blocked_count = len(postponed)
+    metrics.POSTPONED_UPDATES.labels("host_blocked").inc(blocked_count)
+    urls = list(last_updated)
+    with update_stage("fetch", timings):
+        fetched = fetcher.fetch_all(
+            [
+                dict(url=url, etag=feed["etag"], modified=feed["modified"])
+                for url, feed in last_updated.items()
+            ]
+        )
+    with update_stage("parse", timings):
+        body_hashes = [
+            hash_body(result["content"])
+            if isinstance(result, dict) and result["content"] is not None
+            else None
+            for result in fetched
+        ]
+        parsed = parser.parse_all(
+            [
+                (
+                    result["content"],
+                    result["headers"],
+                    fingerprints.get(url, (None, frozenset()))[1],
+                )
+                if body_hash is not None and body_hash != last_updated[url]["body_hash"]
+                else None
+                for url, result, body_hash in zip(urls, fetched, body_hashes)
+            ]
+        )
+    count_fetch_results(urls, fetched, body_hashes, parsed, last_updated)
+    throttled = {}
+    with update_stage("store", timings):
+        for url, result, body_hash, entries in zip(urls, fetched, body_hashes, parsed):
+            retry_sec = throttle_sec(result)
+            if retry_sec is not None:
+                logging.info(f"Feed {url} throttled, retrying in {retry_sec:.0f}s")
+                host = db_handler.feed_host(url)
+                throttled[host] = max(retry_sec, throttled.get(host, 0))
+                postponed.append((url, tokens[url], retry_sec))
+                continue
+            try:
+                for error in (result, entries):
+                    if isinstance(error, BaseException):
+                        raise error
+                store_url = resolve_duplicates(
+                    url, tokens[url], result, body_hash, entries
+                )
+                if store_url is None:
+                    continue
+                store_feed_updates(
+                    store_url,
+                    tokens[url],
+                    last_updated[url],
+                    result,
+                    body_hash,
+                    entries,
+                    start_time,
+                )
+            except Exception as e:
+                record_failure(url, tokens[url], last_updated[url], e)
+        if throttled:
+            db.throttle_hosts(throttled)
+            metrics.POSTPONED_UPDATES.labels("throttled").inc(
+                len(postponed) - blocked_count
+            )
+        if postponed:
+            db.postpone_updates(postponed)
+    logging.debug(
+        f"Updated {len(urls)} feeds in {time.monotonic() - start_time:.3f}s: "
+        + ", ".join(f"{stage} {sec:.3f}s" for stage, sec in timings.items())
+    )
+
+
+@dramatiq.actor
+def update_feeds(feeds):
+    """Update a batch of feeds given as [url, lease token] lists"""
+    update_feed_batch([tuple(feed) for feed in feeds])
+
+
+@dramatiq.actor
+def update_feed(url, lease_token):
+    """Update a single feed; kept for the messages enqueued by older dispatchers"""
+    update_feed_batch([(url, lease_token)])
+
+
+def reserve_host_fetches(due_feeds):
+    """Spread the due feeds given as (url, lease token, due in seconds) over
+    the fetch slots of their hosts
 
-        fail_count = 0
-    except Exception as e:
-        logging.error(f"Exception while trying to update feed {url}: {e}")
-        fail_count += 1
+    Return the feeds to dispatch as (url, lease token, delay in seconds); the
+    feeds with no slot reserved, as their hosts are busy, are put off until
+    the slots after the reserved ones
+    """
+    if not HOST_FETCH_INTERVAL_SEC or not due_feeds:
+        return due_feeds
+    hosts = {}
+    for feed in due_feeds:
+        hosts.setdefault(db_handler.feed_host(feed[0]), []).append(feed)
+    reserved = db.reserve_host_fetches(
+        {host: len(feeds) for host, feeds in hosts.items()},
+        HOST_FETCH_INTERVAL_SEC,
+        HOST_FETCH_BURST,
+        HOST_FETCH_AHEAD_SEC,
+    )
+    dispatched = []
+    postponed = []
+    for host, feeds in hosts.items():
+        first_sec, count = reserved[host]
+        for i, (url, lease_token, due_in_sec) in enumerate(feeds):
+            slot_sec = first_sec + i * HOST_FETCH_INTERVAL_SEC
+            if i < count:
+                dispatched.append((url, lease_token, max(due_in_sec, slot_sec)))
+            else:
+                postponed.append((url, lease_token, slot_sec))
+    if postponed:
+        db.postpone_updates(postponed)
+        metrics.POSTPONED_UPDATES.labels("host_busy").inc(len(postponed))
+    return dispatched
+
+
+def dispatch_due_feeds(shard=None):
+    """Enqueue updates of the feeds of @shard which are due soon
 
-    to_sleep = (
-        start_time
-        + UPDATE_INTERVAL_SEC * (UPDATE_INTERVAL_INCREASE**fail_count)
-        - time.monotonic()
+    Feeds due around the same time are batched together, and the batches are
+    delayed until the feeds are due and their hosts' fetch slots (see
+    reserve_host_fetches). Return the number of feeds claimed
+    """
+    due_feeds = db.claim_due_feeds(
+        DISPATCH_BATCH_SIZE,
+        DISPATCH_LOOKAHEAD_SEC,
+        CLAIM_TIMEOUT_SEC,
+        LEASE_OWNER,
+        shard,
     )
-    logging.debug(f"Sleep {to_sleep} sec before updating {url} next time")
-    if to_sleep > 0:
-        time.sleep(to_sleep)
+    batches = {}
+    for url, lease_token, delay_sec in reserve_host_fetches(due_feeds):
+        delay_ms = int(delay_sec * 1000) // FETCH_BATCH_WINDOW_MS * FETCH_BATCH_WINDOW_MS
+        batches.setdefault(delay_ms, []).append((url, lease_token))
+    for delay_ms, feeds in batches.items():
+        for i in range(0, len(feeds), FETCH_BATCH_SIZE):
+            update_feeds.send_with_options(
+                args=(feeds[i : i + FETCH_BATCH_SIZE],), delay=delay_ms
+            )
+    if due_feeds:
+        logging.debug(f"Dispatched {len(due_feeds)} feed updates")
+    return len(due_feeds)
 
-    update_feed.send(url, fail_count)
+
+def update_backlog_metrics(shard=None):
+    waiting, in_flight = db.count_overdue_feeds(shard)
+    metrics.UPDATE_BACKLOG.labels("overdue_waiting").set(waiting)
+    metrics.UPDATE_BACKLOG.labels("overdue_in_flight").set(in_flight)
+    ready, delayed, _ = dramatiq_broker.get_queue_message_counts(
+        update_feeds.queue_name
+    )
+    metrics.UPDATE_BACKLOG.labels("messages_ready").set(ready)
+    metrics.UPDATE_BACKLOG.labels("messages_delayed").set(delayed)
 
 
-def start_updating_feed(url):
-    logging.info(f"Starting feed updates for {url}")
-    update_feed.send(url, 0)
+def update_ring(ring):
+    """Heartbeat, return the hash ring of the live nodes, @ring if unchanged"""
+    nodes = db.updater_node_heartbeat(LEASE_OWNER, NODE_TIMEOUT_SEC)
+    if ring is not None and ring.nodes == nodes:
+        return ring
+    ring = sharding.HashRing(nodes)
+    share = ring.share(LEASE_OWNER)
+    logging.info(
+        f"Updater nodes changed: {len(nodes)} live, "
+        f"dispatching {share:.1%} of the feeds"
+    )
+    metrics.SHARD_REBALANCES.inc()
+    metrics.UPDATER_NODES.set(len(nodes))
+    metrics.UPDATER_SHARD_SHARE.set(share)
+    return ring
+
+
+def run_dispatcher():
+    logging.info(f"Starting feed updates dispatcher {LEASE_OWNER}")
+    prometheus_client.start_http_server(METRICS_PORT)
+    # Leave the ring on docker stop as well, so that the feeds are taken over
+    # without waiting for the node timeout
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    metrics_time = 0
+    try:
+        # Joins the ring, so the shard is known before the first dispatch
+        ring = update_ring(None)
+        shard = ring.multirange(LEASE_OWNER)
+        heartbeat_time = time.monotonic()
+        while True:
+            if time.monotonic() - heartbeat_time >= NODE_HEARTBEAT_SEC:
+                ring = update_ring(ring)
+                shard = ring.multirange(LEASE_OWNER)
+                heartbeat_time = time.monotonic()
+            if time.monotonic() - metrics_time >= METRICS_INTERVAL_SEC:
+                update_backlog_metrics(shard)
+                metrics_time = time.monotonic()
+            if dispatch_due_feeds(shard) < DISPATCH_BATCH_SIZE:
+                time.sleep(DISPATCH_INTERVAL_SEC)
+    finally:
+        db.delete_updater_node(LEASE_OWNER)
+        logging.info(f"Dispatcher {LEASE_OWNER} left")
 
 
 if __name__ == "__main__":
-    for feed in db.list_all_feeds():
-        start_updating_feed(feed)
+    run_dispatcher()
@@ -2,8 +2,12 @@ import pytest
 import requests
 from requests.exceptions import ConnectionError
 import time
+import json
+import concurrent.futures
+import email.utils
 import http.server
 import threading
+import contextlib
 
 HOST = "http://localhost:8000"
 START_TIMEOUT_SEC = 3
@@ -119,6 +123,285 @@ def test_real_feeds(app):
     assert len(resp["items"]) == item_count
 
 
+def test_all_items_pages(app):
+    user = test_users[1]
+    url = "/".join([HOST, "all_items"])
+    resp = requests.get(url, params={"username": user})
+    resp.raise_for_status()
+    item_ids = [item["id"] for item in resp.json()["items"]]
+    assert len(item_ids) > 0
+    paged_ids = []
+    params = {"username": user, "limit": 7}
+    while True:
+        resp = requests.get(url, params=params)
+        resp.raise_for_status()
+        resp = resp.json()
+        assert len(resp["items"]) <= 7
+        paged_ids += [item["id"] for item in resp["items"]]
+        if resp["next_cursor"] is None:
+            break
+        params["after"] = resp["next_cursor"]
+    assert paged_ids == item_ids
+    resp = requests.get(url, params={"username": user, "stream": True})
+    resp.raise_for_status()
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert "failed" in lines[0]
+    assert [item["id"] for item in lines[1:]] == item_ids
+    resp = requests.get(url, params={"username": user, "after": "bad cursor"})
+    assert resp.status_code == 400
+
+
+def test_query_count(app):
+    user = test_users[0]
+    feed = test_feeds[0]
+    requests_to_check = [
+        (requests.get, "feeds", {"username": user}),
+        (requests.get, "feed_items", {"username": user, "feed_url": feed}),
+        (requests.get, "all_items", {"username": user, "unread_only": True}),
+        (requests.get, "all_items", {"username": user, "stream": True}),
+        (requests.post, "mark_read", {"username": user, "feed_url": feed, "item_id": 1}),
+        (requests.post, "follow", {"username": user, "feed_url": feed}),
+        (requests.post, "update_feed", {"feed_url": feed}),
+    ]
+    for method, path, params in requests_to_check:
+        resp = method("/".join([HOST, path]), params=params)
+        resp.raise_for_status()
+        assert resp.headers["X-Query-Count"] == "1", path
+
+
+def test_metrics(app):
+    requests.get("/".join([HOST, "healthcheck"])).raise_for_status()
+    resp = requests.get("/".join([HOST, "metrics"]))
+    resp.raise_for_status()
+    assert (
+        'rss_http_request_duration_seconds_count{method="GET",route="/healthcheck"'
+        in resp.text
+    )
+    assert "rss_db_pool_connections" in resp.text
+
+
+def test_id_cache(app):
+    user = test_users[0]
+    feed = test_feeds[0]
+    url = "/".join([HOST, "admin", "cache_stats"])
+    before = requests.get(url).json()
+    for _ in range(3):
+        requests.get(
+            "/".join([HOST, "feed_items"]), params={"username": user, "feed_url": feed}
+        ).raise_for_status()
+    after = requests.get(url).json()
+    assert after["users"]["hits"] > before["users"]["hits"]
+    assert after["feeds"]["hits"] > before["feeds"]["hits"]
+
+
+def test_response_cache(app):
+    user = "cache_user"
+    feed = test_feeds[1]
+    requests.post(
+        "/".join([HOST, "add_user"]), params={"username": user}
+    ).raise_for_status()
+    follow(user, feed)
+    url = "/".join([HOST, "feed_items"])
+    params = {"username": user, "feed_url": feed}
+    resp = requests.get(url, params=params)
+    resp.raise_for_status()
+    etag = resp.headers["ETag"]
+    resp = requests.get(url, params=params, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+    resp = requests.get(
+        url, params={**params, "unread_only": True}, headers={"If-None-Match": etag}
+    )
+    assert resp.status_code == 200
+    requests.post(
+        "/".join([HOST, "mark_read"]), params={**params, "item_id": 1}
+    ).raise_for_status()
+    resp = requests.get(url, params=params, headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    url = "/".join([HOST, "feeds"])
+    resp = requests.get(url, params={"username": user})
+    etag = resp.headers["ETag"]
+    follow(user, test_feeds[0])
+    resp = requests.get(url, params={"username": user}, headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert test_feeds[0] in resp.json()["feeds"]
+
+
+def test_mark_read_bulk(app):
+    user = "bulk_user"
+    feed = "http://host.docker.internal:5000/feed?unit=second"
+    requests.post(
+        "/".join([HOST, "add_user"]), params={"username": user}
+    ).raise_for_status()
+    follow(user, feed)
+    time.sleep(3)
+    items = get_items(user, feed, False)
+    assert len(items) > 1
+    ids = sorted(item["id"] for item in items)
+    url = "/".join([HOST, "mark_read_bulk"])
+    resp = requests.post(
+        url,
+        params={"username": user},
+        json=[
+            {"feed_url": feed, "item_id": ids[-1]},
+            {"feed_url": feed, "item_id": ids[0]},
+            {"feed_url": test_feeds[0], "item_id": 1},
+        ],
+    )
+    resp.raise_for_status()
+    assert resp.json()["feeds_not_found"] == [test_feeds[0]]
+    unread_ids = {item["id"] for item in get_items(user, feed, True)}
+    assert not unread_ids & set(ids)
+    # The read pointer never moves back
+    mark_as_read(user, feed, ids[0])
+    assert not {item["id"] for item in get_items(user, feed, True)} & set(ids)
+    resp = requests.post(
+        url, params={"username": "no_such_user"}, json=[{"feed_url": feed, "item_id": 1}]
+    )
+    assert resp.status_code == 500
+    # Deferred marks are written shortly
+    latest = max(item["id"] for item in get_items(user, feed, False))
+    resp = requests.post(
+        "/".join([HOST, "mark_read"]),
+        params={"username": user, "feed_url": feed, "item_id": latest, "defer": True},
+    )
+    assert resp.status_code == 202
+    time.sleep(2)
+    assert all(item["id"] > latest for item in get_items(user, feed, True))
+
+
+def test_feed_url_variants(app):
+    user = "variants_user"
+    requests.post(
+        "/".join([HOST, "add_user"]), params={"username": user}
+    ).raise_for_status()
+    follow(user, test_feeds[0])
+    # Same feed: the scheme and the host are case-insensitive, the default port
+    # and the fragment don't matter
+    variant = test_feeds[0].replace("http://abcd.com", "HTTP://ABCD.com:80") + "#top"
+    resp = requests.post(
+        "/".join([HOST, "follow"]), params={"username": user, "feed_url": variant}
+    )
+    resp.raise_for_status()
+    assert resp.json()["message"] == "Feed already followed"
+    assert get_feeds(user) == [test_feeds[0]]
+    assert get_updates(user, variant, False)["items"] == []
+    resp = requests.get(
+        "/".join([HOST, "admin", "update_chains"]), params={"feed_url": variant}
+    )
+    resp.raise_for_status()
+    assert resp.json()["feeds"][0]["feed_url"] == test_feeds[0]
+
+
+def test_bulk_follow(app):
+    user = "opml_user"
+    requests.post(
+        "/".join([HOST, "add_user"]), params={"username": user}
+    ).raise_for_status()
+    follow(user, test_feeds[0])
+    opml = f"""<?xml version="1.0"?>
+<opml version="2.0"><body><outline text="News">
+    <outline type="rss" text="a" xmlUrl="{test_feeds[0]}"/>
+    <outline type="rss" text="b" xmlUrl="{test_feeds[1]}"/>
+</outline></body></opml>"""
+    url = "/".join([HOST, "import_opml"])
+    resp = requests.post(url, params={"username": user}, data=opml.encode())
+    resp.raise_for_status()
+    assert resp.json()["followed"] == [test_feeds[1]]
+    assert resp.json()["already_followed"] == [test_feeds[0]]
+    assert sorted(get_feeds(user)) == sorted(test_feeds)
+    resp = requests.post(url, params={"username": user}, data=b"<opml><body>")
+    assert resp.status_code == 400
+    resp = requests.post(
+        "/".join([HOST, "unfollow_bulk"]),
+        params={"username": user},
+        json=[test_feeds[0], real_feeds[0]],
+    )
+    resp.raise_for_status()
+    assert resp.json() == {
+        "unfollowed": [test_feeds[0]],
+        "not_followed": [real_feeds[0]],
+    }
+    resp = requests.post(
+        "/".join([HOST, "follow_bulk"]), params={"username": user}, json=test_feeds
+    )
+    resp.raise_for_status()
+    assert resp.json()["followed"] == [test_feeds[0]]
+    assert sorted(get_feeds(user)) == sorted(test_feeds)
+    # Spellings of the same feed: only the first one is followed
+    variants = ["http://bulk.example/rss", "HTTP://BULK.example:80/rss"]
+    resp = requests.post(
+        "/".join([HOST, "follow_bulk"]), params={"username": user}, json=variants
+    )
+    resp.raise_for_status()
+    assert resp.json()["followed"] == variants[:1]
+    assert resp.json()["already_followed"] == variants[1:]
+    assert sorted(get_feeds(user)) == sorted(test_feeds + variants[:1])
+    resp = requests.post(
+        "/".join([HOST, "follow_bulk"]),
+        params={"username": "no_such_user"},
+        json=test_feeds,
+    )
+    assert resp.status_code == 500
+
+
+def test_unread_counts(app):
+    user = "count_user"
+    feed = "http://host.docker.internal:5000/feed?unit=second"
+    requests.post(
+        "/".join([HOST, "add_user"]), params={"username": user}
+    ).raise_for_status()
+    url = "/".join([HOST, "unread_counts"])
+    resp = requests.get(url, params={"username": user})
+    resp.raise_for_status()
+    assert resp.json() == {"feeds": {}, "total": 0}
+    follow(user, feed)
+    time.sleep(3)
+    items = get_items(user, feed, False)
+    counts = requests.get(url, params={"username": user}).json()
+    assert counts["feeds"][feed] >= len(items) > 0
+    assert counts["total"] == counts["feeds"][feed]
+    mark_as_read(user, feed, max(item["id"] for item in items))
+    counts = requests.get(url, params={"username": user}).json()
+    # Fetched after the counts, so there may be new items already
+    assert counts["feeds"][feed] <= len(get_items(user, feed, True))
+    resp = requests.get(url, params={"username": "no_such_user"})
+    assert resp.status_code == 500
+
+
+def test_new_items_notifications(app):
+    user = "poll_user"
+    feed = "http://host.docker.internal:5000/feed?unit=second"
+    requests.post(
+        "/".join([HOST, "add_user"]), params={"username": user}
+    ).raise_for_status()
+    follow(user, feed)
+    time.sleep(3)
+    url = "/".join([HOST, "all_items"])
+    params = {"username": user, "unread_only": True}
+    resp = requests.get(url, params=params)
+    resp.raise_for_status()
+    etag = resp.headers["ETag"]
+    # Long poll: waits for the new items of the feed, which come every second
+    start_time = time.monotonic()
+    resp = requests.get(
+        url, params={**params, "wait": 10}, headers={"If-None-Match": etag}
+    )
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    assert time.monotonic() - start_time < 10
+    with requests.get(
+        "/".join([HOST, "events"]), params={"username": user}, stream=True, timeout=10
+    ) as resp:
+        resp.raise_for_status()
+        assert resp.headers["Content-Type"].startswith("text/event-stream")
+        for line in resp.iter_lines():
+            if line.startswith(b"data:"):
+                assert json.loads(line[len(b"data:") :]) == {"feeds": [feed]}
+                break
+
+
 def test_updates(app):
     user = test_users[2]
     feed = "http://host.docker.internal:5000/feed?unit=second"
@@ -141,6 +424,22 @@ def test_updates(app):
         mark_as_read(user, feed, unread_items_value[-1]["id"])
 
 
+def test_update_chains(app):
+    url = "/".join([HOST, "admin", "update_chains"])
+    feed = "http://host.docker.internal:5000/feed?unit=second"
+    follow(test_users[1], feed)
+    for _ in range(10):
+        resp = requests.get(url, params={"feed_url": feed})
+        resp.raise_for_status()
+        assert resp.json()["feeds"][0]["active_chains"] <= 1
+        time.sleep(0.5)
+    resp = requests.get(url)
+    resp.raise_for_status()
+    assert all(chains["active_chains"] <= 1 for chains in resp.json()["feeds"])
+    resp = requests.get(url, params={"feed_url": "http://no.such/feed"})
+    assert resp.status_code == 400
+
+
 def test_linkdown(app):
     class ProxyServer:
         class ProxyHandler(http.server.BaseHTTPRequestHandler):
@@ -200,6 +499,155 @@ def test_linkdown(app):
         check_updates(expect_fail=False, expect_items=True, read=True)
 
 
+def test_conditional_requests(app):
+    etag = '"feed-v1"'
+    # Just published, so that the feed is polled at the minimum interval
+    body = (
+        '<?xml version="1.0"?><rss version="2.0"><channel><title>Static</title>'
+        "<item><title>Only item</title><guid>only</guid>"
+        f"<pubDate>{email.utils.formatdate(usegmt=True)}</pubDate></item>"
+        "</channel></rss>"
+    ).encode()
+    requests_seen = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/rss+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    user = test_users[0]
+    feed = "http://host.docker.internal:5002"
+    with serve(Handler, 5002):
+        follow(user, feed)
+        time.sleep(4)
+    assert len(requests_seen) > 1
+    assert requests_seen[0] is None
+    assert all(seen == etag for seen in requests_seen[1:])
+    update = get_updates(user, feed, False)
+    assert not update["failed"]
+    assert len(update["items"]) == 1
+    assert update["items"][0]["guid"] == "only"
+    assert update["items"][0]["title"] == "Only item"
+    assert "content" not in update["items"][0]
+
+
+def test_throttled_feed(app):
+    body = (
+        b'<?xml version="1.0"?><rss version="2.0"><channel><title>Busy</title>'
+        b"<item><title>Only item</title><guid>only</guid>"
+        b"<pubDate>Mon, 06 Mar 2023 10:00:00 GMT</pubDate></item>"
+        b"</channel></rss>"
+    )
+    requests_seen = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(time.monotonic())
+            # As many 429s as the failures which would fail the feed
+            if len(requests_seen) <= 3:
+                self.send_response(429)
+                self.send_header("Retry-After", "2")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/rss+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    user = "throttled_user"
+    feed = "http://host.docker.internal:5003"
+    requests.post(
+        "/".join([HOST, "add_user"]), params={"username": user}
+    ).raise_for_status()
+    with serve(Handler, 5003):
+        follow(user, feed)
+        time.sleep(10)
+    assert len(requests_seen) > 3
+    # Retry-After is respected
+    seen = requests_seen[:4]
+    assert all(b - a >= 1.5 for a, b in zip(seen, seen[1:]))
+    update = get_updates(user, feed, False)
+    assert not update["failed"]
+    assert len(update["items"]) == 1
+
+
+def test_compact_items(app):
+    # Compacts the items of all the feeds, so it runs after the other tests
+    now = time.time()
+    body = (
+        '<?xml version="1.0"?><rss version="2.0"><channel><title>Long</title>'
+        + "".join(
+            f"<item><title>Item {i}</title><guid>item-{i}</guid>"
+            f"<pubDate>{email.utils.formatdate(now - 60 * (5 - i), usegmt=True)}"
+            "</pubDate></item>"
+            for i in range(5)
+        )
+        + "</channel></rss>"
+    ).encode()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/rss+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    compact_url = "/".join([HOST, "admin/compact_items"])
+    user, other_user = "compact_user", "other_compact_user"
+    for username in (user, other_user):
+        requests.post(
+            "/".join([HOST, "add_user"]), params={"username": username}
+        ).raise_for_status()
+    feed = "http://host.docker.internal:5004"
+    with serve(Handler, 5004):
+        follow(user, feed)
+        time.sleep(3)
+    items = get_items(user, feed, False)
+    assert [item["title"] for item in items] == [f"Item {i}" for i in range(5)]
+    mark_as_read(user, feed, items[0]["id"])
+
+    # All but the latest 2 items are deleted, read or not
+    resp = requests.post(
+        compact_url, params={"max_items_per_feed": 2, "purge_orphans": False}
+    )
+    resp.raise_for_status()
+    assert resp.json()["items_deleted"] >= 3
+    items = get_items(user, feed, False)
+    assert [item["title"] for item in items] == ["Item 3", "Item 4"]
+    unread_counts = get_unread_counts(user)
+    assert unread_counts["feeds"][feed] == len(get_items(user, feed, True)) == 2
+
+    # Feeds nobody follows are purged, but a feed followed again while the
+    # purge runs is followed all the same
+    orphans = [f"http://orphan{i}.example/rss" for i in range(20)]
+    for orphan in orphans:
+        follow(other_user, orphan)
+        unfollow(other_user, orphan)
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        compacted = pool.submit(
+            requests.post,
+            compact_url,
+            params={"max_items_per_feed": 0, "purge_orphans": True},
+        )
+        for orphan in orphans:
+            follow(user, orphan)
+        compacted.result().raise_for_status()
+    assert set(orphans) <= set(get_feeds(user))
+    for orphan in orphans:
+        assert get_items(user, orphan, False) == []
+
+
 def get_feeds(username):
     url = "/".join([HOST, "feeds"])
     resp = requests.get(url, params={"username": username})
@@ -231,3 +679,29 @@ def follow(user, feed):
     requests.post(
         "/".join([HOST, "follow"]), params={"username": user, "feed_url": feed}
     ).raise_for_status()
+
+
+def unfollow(user, feed):
+    requests.post(
+        "/".join([HOST, "unfollow"]), params={"username": user, "feed_url": feed}
+    ).raise_for_status()
+
+
+def get_unread_counts(user):
+    resp = requests.get("/".join([HOST, "unread_counts"]), params={"username": user})
+    resp.raise_for_status()
+    return resp.json()
+
+
+@contextlib.contextmanager
+def serve(handler, port):
+    """Serve requests with @handler on @port in a background thread"""
+    server = http.server.HTTPServer(("", port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
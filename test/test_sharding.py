@@ -0,0 +1,79 @@
+import os
+import random
+import sys
+
+# The test image has sharding.py next to the tests; in the repo it is found in
+# the service sources
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "rss_service", "src"))
+import sharding  # noqa: E402
+
+NODES = ["updater-a", "updater-b", "updater-c"]
+
+
+def sample_hashes(count):
+    rng = random.Random(0)
+    return [rng.randint(sharding.HASH_MIN, sharding.HASH_MAX) for _ in range(count)]
+
+
+def range_owner(ring, feed_hash):
+    owners = [
+        node
+        for node in ring.nodes
+        for low, high in ring.ranges(node)
+        if low < feed_hash <= high
+    ]
+    assert len(owners) == 1
+    return owners[0]
+
+
+def test_ranges_wrap_around():
+    ring = sharding.HashRing(NODES)
+    first_point, first_owner = ring.points[0]
+    last_point = ring.points[-1][0]
+    ranges = ring.ranges(first_owner)
+    # The first node owns the hashes below the first point and, wrapping
+    # around, the ones above the last point
+    assert ranges[0] == (sharding.HASH_MIN - 1, first_point)
+    assert ranges[-1] == (last_point, sharding.HASH_MAX)
+    multirange = ring.multirange(first_owner)
+    assert multirange.startswith(f"{{({sharding.HASH_MIN - 1},{first_point}]")
+    assert multirange.endswith(f"({last_point},{sharding.HASH_MAX}]}}")
+    # The ranges of all the nodes cover the hash space once
+    all_ranges = sorted(r for node in NODES for r in ring.ranges(node))
+    assert all_ranges[0][0] == sharding.HASH_MIN - 1
+    assert all_ranges[-1][1] == sharding.HASH_MAX
+    for (_, high), (low, _) in zip(all_ranges, all_ranges[1:]):
+        assert high == low
+    assert sum(ring.share(node) for node in NODES) == 1
+
+    single = sharding.HashRing(NODES[:1])
+    assert single.share(NODES[0]) == 1
+    assert single.multirange(NODES[0]) == (
+        f"{{({sharding.HASH_MIN - 1},{single.points[-1][0]}],"
+        f"({single.points[-1][0]},{sharding.HASH_MAX}]}}"
+    )
+
+
+def test_owner_agrees_with_ranges():
+    ring = sharding.HashRing(NODES)
+    edges = [sharding.HASH_MIN, sharding.HASH_MAX]
+    for point, _ in ring.points:
+        edges += [point, point + 1]
+    for feed_hash in edges + sample_hashes(1000):
+        if sharding.HASH_MIN <= feed_hash <= sharding.HASH_MAX:
+            assert ring.owner(feed_hash) == range_owner(ring, feed_hash)
+
+
+def test_rebalance_moves_one_node_share():
+    hashes = sample_hashes(20000)
+    ring = sharding.HashRing(NODES)
+    joined = sharding.HashRing(NODES + ["updater-d"])
+    moved = [h for h in hashes if ring.owner(h) != joined.owner(h)]
+    # Only the feeds taken by the new node move, about a quarter of them
+    assert all(joined.owner(h) == "updater-d" for h in moved)
+    assert 0.15 < len(moved) / len(hashes) < 0.35
+    # When a node leaves, only its feeds move
+    left = sharding.HashRing(NODES[1:])
+    assert all(
+        left.owner(h) == ring.owner(h) for h in hashes if ring.owner(h) != NODES[0]
+    )